@@ -51,10 +51,10 @@ def run_processes(server_args, *client_args):
 
     return results
 
-def suite(parties, expr, expected):
+def suite(parties, outputs, expected):
     participants = list(parties.keys())
 
-    prot = ProtocolSpec(expr=expr, participant_ids=participants)
+    prot = ProtocolSpec(outputs=outputs, participant_ids=participants)
     clients = [(name, prot, value_dict) for name, value_dict in parties.items()]
 
     results =  run_processes(participants, *clients)
@@ -84,10 +84,13 @@ def main():
     reimbursement = Scalar(200)
     total_cost = (h1_nb_patients*h1_avg_time + h2_nb_patients*h2_avg_time + h3_nb_patients*h3_avg_time) * day_cost - reimbursement
     expected2 = (1500*3 + 2000*4 + 800*3) * 1500 - 200
-    res1 = suite(parties, total_patients, expected1)
-    res2 = suite(parties, total_cost, expected2)
+    res = suite(
+        parties,
+        {"total_patients": total_patients, "total_cost": total_cost},
+        {"total_patients": expected1, "total_cost": expected2}
+    )
 
-    avg_net_cost = res2/res1
+    avg_net_cost = res["total_cost"]/res["total_patients"]
 
     print("Average patient cost: "+str(avg_net_cost))
 
@@ -0,0 +1,760 @@
+"""
+Compilation of arithmetic expressions into circuits that the SMC parties evaluate.
+
+A circuit is a list of gates in topological order, each gate producing one wire identified
+by its index in the list. Scalars are folded at compile time, so the only gates requiring
+communication are the ones opening masked values: the multiplications between two secret
+wires, the inner products, the squares, the truncations and the bit decompositions of the
+comparisons. These are grouped in layers by depth, so that all the openings of a layer can
+be done in a single round.
+"""
+
+import collections
+import copy
+import hashlib
+import io
+import itertools
+import os
+import struct
+import tempfile
+import threading
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple
+
+from expression import (
+    Expression,
+    Secret,
+    Scalar,
+    AddOp, SubOp, MultOp, TruncOp, LessThanOp, PowOp
+)
+
+
+# Gate operations.
+INPUT = "input"  # Share of a secret, `key` is the ID of the secret.
+CONST = "const"  # Public constant `value`, held by the first party.
+ADD = "add"      # Sum of the wires `a` and `b`.
+SUB = "sub"      # Difference of the wires `a` and `b`.
+SCALE = "scale"  # Product of the wire `a` with the public constant `value`.
+MUL = "mul"      # Product of the wires `a` and `b`, `key` is the ID of the Beaver triplet.
+SQUARE = "square"  # Square of the wire `a`, `key` is the ID of the random pair (r, r^2).
+DOT = "dot"      # Sum of the products of the pairs of wires `args`, `key` is the ID of the inner product triple.
+TRUNC = "trunc"  # Wire `a` divided by 2^`value`, `key` is the ID of the random mask.
+BITDEC = "bitdec"  # Opens the wire `a` plus a mask r of `value` random bits, gives (a + r) >> `value` minus r >> `value`.
+EQBIT = "eqbit"  # 1 if the bit `value` of the value opened by the BITDEC wire `a` is the one of its mask `key`.
+LTBIT = "ltbit"  # 1 if the bit `value` of the value opened by the BITDEC wire `a` is 0 and the one of its mask 1.
+
+# Operations opening masked values, which take one round each.
+OPEN_OPS = (MUL, DOT, SQUARE, TRUNC, BITDEC)
+# Operations using preprocessed random masks (other than Beaver triplets), and their kind.
+RANDOM_KINDS = {DOT: "dot", SQUARE: "square", TRUNC: "trunc", BITDEC: "bits"}
+# Local operations using the value opened by a BITDEC gate.
+BIT_OPS = (EQBIT, LTBIT)
+# The operands of the comparisons must differ by less than 2^COMPARISON_BITS.
+COMPARISON_BITS = 64
+
+
+class Gate:
+    """
+    A gate of a circuit.
+
+    Attributes:
+        op: operation of the gate
+        a: index of the first input wire, if any
+        b: index of the second input wire, if any
+        value: public constant used by the gate, if any
+        key: ID of the secret, of the Beaver triplet or of the random masks used by the
+            gate, if any
+        args: indices of the input wires of gates with more than two inputs, if any
+    """
+    __slots__ = ("op", "a", "b", "value", "key", "args")
+
+    def __init__(
+            self,
+            op: str,
+            a: Optional[int] = None,
+            b: Optional[int] = None,
+            value: Optional[int] = None,
+            key: Optional[str] = None,
+            args: Optional[Tuple[int, ...]] = None
+        ):
+        self.op = op
+        self.a = a
+        self.b = b
+        self.value = value
+        self.key = key
+        self.args = args
+
+    def operands(self) -> Tuple[int, ...]:
+        """
+        Indices of the input wires of the gate.
+        """
+        if self.args is not None:
+            return self.args
+        return tuple(w for w in (self.a, self.b) if w is not None)
+
+    def __repr__(self):
+        args = f", args={self.args}" if self.args is not None else ""
+        return f"Gate({self.op}, a={self.a}, b={self.b}, value={self.value}, key={self.key}{args})"
+
+
+class Circuit:
+    """
+    An arithmetic circuit.
+
+    Attributes:
+        gates: gates of the circuit, in topological order
+        outputs: index of the wire of each named output
+        inputs: IDs of the secrets used by the circuit, in the order their gates are evaluated
+        depth: number of rounds of openings each wire depends on
+        layers: for each depth, the gates opening values at that depth and the local gates
+            of that depth (in topological order), to evaluate in that order
+        levels: for each depth, its local gates grouped in levels of gates independent of
+            each other, each level only depending on the previous ones
+        mul_gates: multiplication gates, layer by layer, each one requiring a Beaver triplet
+        random_gates: inner product, square, truncation and bit decomposition gates, layer
+            by layer, each one requiring preprocessed random masks
+    """
+
+    def __init__(self, gates: List[Gate], outputs: Dict[str, int]):
+        self.gates = gates
+        self.outputs = outputs
+        self.inputs = [gate.key for gate in gates if gate.op == INPUT]
+
+        self.depth: List[int] = []
+        for gate in gates:
+            operands = [self.depth[w] for w in gate.operands()]
+            depth = max(operands, default=0)
+            self.depth.append(depth + 1 if gate.op in OPEN_OPS else depth)
+
+        self.layers: List[Tuple[List[int], List[int]]] = [
+            ([], []) for _ in range(max(self.depth, default=0) + 1)
+        ]
+        for wire, gate in enumerate(gates):
+            open_gates, local_gates = self.layers[self.depth[wire]]
+            (open_gates if gate.op in OPEN_OPS else local_gates).append(wire)
+        self.mul_gates = [
+            wire for open_gates, _ in self.layers for wire in open_gates if gates[wire].op == MUL
+        ]
+        self.random_gates = [
+            wire for open_gates, _ in self.layers for wire in open_gates if gates[wire].op in RANDOM_KINDS
+        ]
+
+        self.levels: List[List[List[int]]] = [[] for _ in self.layers]
+        level = [0] * len(gates)
+        for wire, gate in enumerate(gates):
+            if gate.op in OPEN_OPS:
+                continue
+            depth = self.depth[wire]
+            # The openings of the same depth are evaluated before its local gates.
+            level[wire] = max(
+                [
+                    level[w] + 1 for w in gate.operands()
+                    if self.depth[w] == depth and gates[w].op not in OPEN_OPS
+                ],
+                default=0
+            )
+            if level[wire] == len(self.levels[depth]):
+                self.levels[depth].append([])
+            self.levels[depth][level[wire]].append(wire)
+
+    def dependents(self, input_keys: Set[str]) -> List[bool]:
+        """
+        Flag the wires that depend on at least one of the given secrets.
+        """
+        flags: List[bool] = []
+        for gate in self.gates:
+            if gate.op == INPUT:
+                flags.append(gate.key in input_keys)
+            else:
+                flags.append(any(flags[w] for w in gate.operands()))
+        return flags
+
+    def rebind(self, keys: Dict[str, str]) -> "Circuit":
+        """
+        Copy the circuit, replacing the keys of its gates (IDs of the secrets, of the
+        Beaver triplets and of the random masks). The suffix of the keys of the gates
+        of a power (see `_compile_power`) is kept. The layering is shared with the original
+        circuit.
+        """
+        def rebind_key(key: Optional[str]) -> Optional[str]:
+            if key is None:
+                return None
+            base, separator, suffix = key.partition(":")
+            return keys[base] + separator + suffix
+
+        circuit = copy.copy(self)
+        circuit.gates = [
+            Gate(gate.op, gate.a, gate.b, gate.value, rebind_key(gate.key), gate.args)
+            for gate in self.gates
+        ]
+        circuit.inputs = [keys[key] for key in self.inputs]
+        return circuit
+
+    def __repr__(self):
+        return f"Circuit({len(self.gates)} gates, {len(self.layers) - 1} rounds)"
+
+
+def compile_circuit(outputs: Dict[str, Expression]) -> Circuit:
+    """
+    Compile named output expressions into a single circuit.
+
+    Subexpressions are compiled only once, whether they are shared by several nodes or
+    outputs, or just structurally identical. Sums of products are then fused into inner
+    products (see `fuse_inner_products`).
+    """
+    gates: List[Gate] = []
+    # Wire of each gate already emitted, keyed by its operation and operands.
+    emitted: Dict[Tuple, int] = {}
+    # Compiled value of each node: either a public constant or a wire index.
+    compiled: Dict[int, Tuple[bool, int]] = {}
+
+    def emit(gate: Gate) -> Tuple[bool, int]:
+        a, b = gate.a, gate.b
+        if gate.op in (ADD, MUL) and a > b:
+            a, b = b, a
+        # Multiplications are identified by their operands, not by their triplet.
+        signature = (gate.op, a, b, gate.value, gate.key if gate.op == INPUT else None, gate.args)
+        if signature not in emitted:
+            gates.append(gate)
+            emitted[signature] = len(gates) - 1
+        return (False, emitted[signature])
+
+    def wire(value: Tuple[bool, int]) -> int:
+        is_const, x = value
+        if not is_const:
+            return x
+        return emit(Gate(CONST, value=x))[1]
+
+    for expr in outputs.values():
+        # Iterative post-order traversal, long chains would exceed the recursion limit.
+        stack = [(expr, False)]
+        while stack:
+            node, visited = stack.pop()
+            if id(node) in compiled:
+                continue
+
+            if isinstance(node, Secret):
+                compiled[id(node)] = emit(Gate(INPUT, key=node.id.decode()))
+            elif isinstance(node, Scalar):
+                compiled[id(node)] = (True, node.value)
+            elif not visited:
+                stack.append((node, True))
+                stack.append((node.b, False))
+                stack.append((node.a, False))
+            else:
+                compiled[id(node)] = _compile_operation(
+                    node, compiled[id(node.a)], compiled[id(node.b)], emit, wire
+                )
+
+    return fuse_inner_products(
+        Circuit(gates, {name: wire(compiled[id(expr)]) for name, expr in outputs.items()})
+    )
+
+
+def fuse_inner_products(circuit: Circuit) -> Circuit:
+    """
+    Replace the multiplications summed together by inner product gates.
+
+    A sum is a tree of additions whose inner nodes are only used by the sum. The
+    multiplications among its terms that are only used by the sum are fused into a single
+    DOT gate, which needs a single triple for the whole sum, and the other terms are added
+    to its result.
+    """
+    gates = circuit.gates
+    uses = [0] * len(gates)
+    for gate in gates:
+        for w in gate.operands():
+            uses[w] += 1
+    for w in circuit.outputs.values():
+        uses[w] += 1
+
+    def is_inner(w: int) -> bool:
+        return gates[w].op == ADD and uses[w] == 1
+
+    # Multiplications and other terms of each sum to fuse, keyed by the root of the sum.
+    fused: Dict[int, Tuple[List[int], List[int]]] = {}
+    removed: Set[int] = set()
+    consumed_by_sum = {w for gate in gates if gate.op == ADD for w in gate.operands() if is_inner(w)}
+    for root, gate in enumerate(gates):
+        if gate.op != ADD or root in consumed_by_sum:
+            continue
+        inner, products, terms = [], [], []
+        stack = list(gate.operands())
+        while stack:
+            w = stack.pop()
+            if is_inner(w):
+                inner.append(w)
+                stack.extend(gates[w].operands())
+            elif gates[w].op == MUL and uses[w] == 1:
+                products.append(w)
+            else:
+                terms.append(w)
+        if len(products) >= 2:
+            fused[root] = (products, terms)
+            removed.update(inner, products)
+
+    if not fused:
+        return circuit
+
+    new_gates: List[Gate] = []
+    index: Dict[int, int] = {}
+    for wire, gate in enumerate(gates):
+        if wire in removed:
+            continue
+        if wire in fused:
+            products, terms = fused[wire]
+            args = tuple(index[w] for product in products for w in (gates[product].a, gates[product].b))
+            new_gates.append(Gate(DOT, key=gates[products[0]].key, args=args))
+            for term in terms:
+                new_gates.append(Gate(ADD, len(new_gates) - 1, index[term]))
+        else:
+            new_gates.append(Gate(
+                gate.op,
+                index[gate.a] if gate.a is not None else None,
+                index[gate.b] if gate.b is not None else None,
+                gate.value,
+                gate.key,
+                tuple(index[w] for w in gate.args) if gate.args is not None else None
+            ))
+        index[wire] = len(new_gates) - 1
+
+    return Circuit(new_gates, {name: index[w] for name, w in circuit.outputs.items()})
+
+
+def random_mask_size(gate: Gate) -> int:
+    """
+    Size of the random masks of a gate: number of bits of a truncation or of a bit
+    decomposition, or length of an inner product.
+    """
+    if gate.op in (TRUNC, BITDEC):
+        return gate.value
+    if gate.op == DOT:
+        return len(gate.args) // 2
+    return 0
+
+
+def _compile_operation(node: Expression, a_value, b_value, emit, wire) -> Tuple[bool, int]:
+    """
+    Compile an operation node, given the compiled values of its operands.
+    """
+    a_const, a = a_value
+    b_const, b = b_value
+    if isinstance(node, AddOp):
+        if a_const and b_const:
+            return (True, a + b)
+        return emit(Gate(ADD, wire(a_value), wire(b_value)))
+    if isinstance(node, SubOp):
+        if a_const and b_const:
+            return (True, a - b)
+        return emit(Gate(SUB, wire(a_value), wire(b_value)))
+    if isinstance(node, MultOp):
+        if a_const and b_const:
+            return (True, a * b)
+        if a_const:
+            return emit(Gate(SCALE, b, value=a))
+        if b_const:
+            return emit(Gate(SCALE, a, value=b))
+        if a == b:
+            return emit(Gate(SQUARE, a, key=node.id.decode()))
+        return emit(Gate(MUL, a, b, key=node.id.decode()))
+    if isinstance(node, TruncOp):
+        if a_const:
+            return (True, a >> b)
+        return emit(Gate(TRUNC, a, value=b, key=node.id.decode()))
+    if isinstance(node, PowOp):
+        if a_const:
+            return (True, a ** b)
+        return _compile_power(node.id.decode(), a, b, emit)
+    if isinstance(node, LessThanOp):
+        if a_const and b_const:
+            return (True, int(a < b))
+        return _compile_comparison(node.id.decode(), wire(a_value), wire(b_value), emit, wire)
+    raise TypeError(f"Unsupported expression {node!r}")
+
+
+def _compile_power(key: str, a: int, exponent: int, emit) -> Tuple[bool, int]:
+    """
+    Compile a ** exponent by square-and-multiply: the squares a^(2^i) are chained, and
+    the ones of the bits of the exponent are multiplied as soon as they are available.
+    The gates get the keys "key:0", "key:1", ... for their triplets and random pairs.
+    """
+    if exponent == 0:
+        return (True, 1)
+    keys = (f"{key}:{idx}" for idx in itertools.count())
+    result = None
+    square = a
+    while True:
+        if exponent & 1:
+            result = square if result is None else emit(Gate(MUL, result, square, key=next(keys)))[1]
+        exponent >>= 1
+        if not exponent:
+            return (False, result)
+        square = emit(Gate(SQUARE, square, key=next(keys)))[1]
+
+
+def _compile_comparison(key: str, a: int, b: int, emit, wire) -> Tuple[bool, int]:
+    """
+    Compile a < b into the bit COMPARISON_BITS = k of z = b - a - 1 + 2^k, which is in
+    [0, 2^(k + 1)) as long as a and b differ by less than 2^k.
+
+    z is masked as c = z + r, with r = r_hi * 2^k + r_lo and the bits of r_lo shared by
+    the TTP. Opening c reveals nothing about z, up to a statistical distance of
+    2^-STATISTICAL_SECURITY, and z >> k = (c >> k) - r_hi - [c mod 2^k < r_lo], where the
+    last term, the carry of z mod 2^k + r_lo, is compared bit by bit: for each bit i, the
+    bit of c is either lower than the one of r_lo (LTBIT) or equal to it (EQBIT), and the
+    pairs (lower, equal) of adjacent groups of bits are combined from the most significant
+    one as (lower_hi + equal_hi * lower_lo, equal_hi * equal_lo).
+
+    The products are inner products of length 1, whose masks are drawn from a full range,
+    and are combined as a tree, so this takes 1 + log2(k) rounds and only opens values
+    masked with statistically hiding masks.
+    """
+    k = COMPARISON_BITS
+    z = emit(Gate(ADD, emit(Gate(SUB, b, a))[1], wire((True, (1 << k) - 1))))[1]
+    opened = emit(Gate(BITDEC, z, value=k, key=key))[1]
+    # Pairs (lower, equal) of the groups of bits, from the least significant one.
+    groups: List[Tuple[int, Optional[int]]] = [
+        (emit(Gate(LTBIT, opened, value=i, key=key))[1], emit(Gate(EQBIT, opened, value=i, key=key))[1])
+        for i in range(k)
+    ]
+    products = itertools.count()
+
+    def product(x: int, y: int) -> int:
+        return emit(Gate(DOT, key=f"{key}:{next(products)}", args=(x, y)))[1]
+
+    while len(groups) > 1:
+        last = len(groups) == 2
+        combined = []
+        for idx in range(0, len(groups) - 1, 2):
+            (lower_lo, equal_lo), (lower_hi, equal_hi) = groups[idx], groups[idx + 1]
+            lower = emit(Gate(ADD, lower_hi, product(equal_hi, lower_lo)))[1]
+            # The equality of all the bits is not needed.
+            combined.append((lower, None if last else product(equal_hi, equal_lo)))
+        if len(groups) % 2:
+            combined.append(groups[-1])
+        groups = combined
+
+    carry = groups[0][0]
+    return emit(Gate(SUB, opened, carry))
+
+
+def fingerprint(
+        outputs: Dict[str, Expression],
+        participant_ids: List[str]
+    ) -> Tuple[str, List[str], List[str]]:
+    """
+    Compute a structural fingerprint of named output expressions for a list of participants.
+
+    The secrets are identified by their order of appearance rather than by their ID, so
+    the same formula built over other secrets has the same fingerprint. Returns the
+    fingerprint, the IDs of the secrets and the IDs of the operations using preprocessed
+    randomness (multiplications, powers, truncations and comparisons), in their order of
+    appearance.
+    """
+    digest = hashlib.sha256(repr(participant_ids).encode())
+    index: Dict[int, int] = {}
+    secret_ids: List[str] = []
+    op_ids: List[str] = []
+
+    for name, expr in outputs.items():
+        # Iterative post-order traversal, long chains would exceed the recursion limit.
+        stack = [(expr, False)]
+        while stack:
+            node, visited = stack.pop()
+            if id(node) in index:
+                continue
+
+            if isinstance(node, Secret):
+                token = f"S{len(secret_ids)}"
+                secret_ids.append(node.id.decode())
+            elif isinstance(node, Scalar):
+                token = f"K{node.value}"
+            elif not visited:
+                stack.append((node, True))
+                stack.append((node.b, False))
+                stack.append((node.a, False))
+                continue
+            else:
+                if isinstance(node, (MultOp, TruncOp, LessThanOp, PowOp)):
+                    op_ids.append(node.id.decode())
+                token = f"{type(node).__name__}({index[id(node.a)]},{index[id(node.b)]})"
+            index[id(node)] = len(index)
+            digest.update(token.encode() + b";")
+        digest.update(f"={name}:{index[id(expr)]};".encode())
+
+    return digest.hexdigest(), secret_ids, op_ids
+
+
+# Binary circuit format:
+#   header:    magic, version, number of gates, keys, constants and outputs
+#   keys:      IDs of the secrets, Beaver triplets and random masks (u16 length + UTF-8)
+#   constants: public constants (u16 length + signed big-endian integer)
+#   outputs:   name (u16 length + UTF-8) and wire (u32) of each output
+#   gates:     op (u8), a (i32), b (i32), index of the key (i32) and of the constant (i32),
+#              -1 if none, then the input wires (i32) of gates with `args`, whose number
+#              is given by b
+#   trailer:   SHA-256 of everything above
+CIRCUIT_MAGIC = b"SMCC"
+CIRCUIT_FORMAT_VERSION = 4
+_OPCODES = (INPUT, CONST, ADD, SUB, SCALE, MUL, TRUNC, BITDEC, EQBIT, SQUARE, DOT, LTBIT)
+# Number of operands of each operation, the inner products have any even number of them.
+_ARITY = {
+    INPUT: 0, CONST: 0, SCALE: 1, TRUNC: 1, BITDEC: 1, EQBIT: 1, LTBIT: 1, SQUARE: 1,
+    ADD: 2, SUB: 2, MUL: 2,
+}
+_HEADER = struct.Struct(">4sBIIII")
+_GATE = struct.Struct(">Biiii")
+_LENGTH = struct.Struct(">H")
+_WIRE = struct.Struct(">I")
+
+
+class _HashingWriter:
+    """
+    Write to a stream while hashing what is written.
+    """
+
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self.digest = hashlib.sha256()
+
+    def write(self, data: bytes) -> None:
+        self.digest.update(data)
+        self.stream.write(data)
+
+
+class _HashingReader:
+    """
+    Read exactly from a stream while hashing what is read.
+    """
+
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self.digest = hashlib.sha256()
+
+    def read(self, size: int) -> bytes:
+        data = self.stream.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated circuit")
+        self.digest.update(data)
+        return data
+
+    def read_string(self) -> bytes:
+        (length,) = _LENGTH.unpack(self.read(_LENGTH.size))
+        return self.read(length)
+
+
+def write_circuit(circuit: Circuit, stream: BinaryIO) -> str:
+    """
+    Write a circuit to a binary stream, one gate at a time. Returns the hash of the
+    circuit, which identifies it for integrity checks and caches.
+    """
+    keys: Dict[str, int] = {}
+    constants: Dict[int, int] = {}
+    for gate in circuit.gates:
+        if gate.key is not None:
+            keys.setdefault(gate.key, len(keys))
+        if gate.value is not None:
+            constants.setdefault(gate.value, len(constants))
+
+    writer = _HashingWriter(stream)
+    writer.write(_HEADER.pack(
+        CIRCUIT_MAGIC, CIRCUIT_FORMAT_VERSION,
+        len(circuit.gates), len(keys), len(constants), len(circuit.outputs)
+    ))
+    for key in keys:
+        encoded = key.encode()
+        writer.write(_LENGTH.pack(len(encoded)) + encoded)
+    for value in constants:
+        encoded = value.to_bytes(value.bit_length() // 8 + 1, "big", signed=True)
+        writer.write(_LENGTH.pack(len(encoded)) + encoded)
+    for name, wire in circuit.outputs.items():
+        encoded = name.encode()
+        writer.write(_LENGTH.pack(len(encoded)) + encoded + _WIRE.pack(wire))
+    for gate in circuit.gates:
+        writer.write(_GATE.pack(
+            _OPCODES.index(gate.op),
+            gate.a if gate.a is not None else -1,
+            len(gate.args) if gate.args is not None else gate.b if gate.b is not None else -1,
+            keys[gate.key] if gate.key is not None else -1,
+            constants[gate.value] if gate.value is not None else -1
+        ))
+        if gate.args is not None:
+            writer.write(struct.pack(f">{len(gate.args)}i", *gate.args))
+
+    digest = writer.digest.digest()
+    stream.write(digest)
+    return digest.hex()
+
+
+def read_circuit(stream: BinaryIO, expected_hash: Optional[str] = None) -> Circuit:
+    """
+    Read a circuit written by `write_circuit` from a binary stream, one gate at a time,
+    checking its integrity (and its hash, if expected). Raises ValueError if the circuit
+    is corrupted or malformed: unknown operations, or operands and outputs which are not
+    wires computed before.
+    """
+    reader = _HashingReader(stream)
+    magic, version, num_gates, num_keys, num_constants, num_outputs = _HEADER.unpack(
+        reader.read(_HEADER.size)
+    )
+    if magic != CIRCUIT_MAGIC:
+        raise ValueError("Not a circuit")
+    if version != CIRCUIT_FORMAT_VERSION:
+        raise ValueError(f"Unsupported circuit format version {version}")
+
+    try:
+        keys = [reader.read_string().decode() for _ in range(num_keys)]
+        constants = [int.from_bytes(reader.read_string(), "big", signed=True) for _ in range(num_constants)]
+        outputs = {}
+        for _ in range(num_outputs):
+            name = reader.read_string().decode()
+            (outputs[name],) = _WIRE.unpack(reader.read(_WIRE.size))
+
+        gates = []
+        for idx in range(num_gates):
+            opcode, a, b, key, value = _GATE.unpack(reader.read(_GATE.size))
+            if opcode >= len(_OPCODES):
+                raise ValueError(f"Unknown op code {opcode} in circuit")
+            op = _OPCODES[opcode]
+            args = None
+            if op == DOT:
+                args = struct.unpack(f">{b}i", reader.read(4 * b))
+                b = -1
+            gate = Gate(
+                op,
+                a if a >= 0 else None,
+                b if b >= 0 else None,
+                constants[value] if value >= 0 else None,
+                keys[key] if key >= 0 else None,
+                args
+            )
+            operands = gate.operands()
+            if len(operands) != _ARITY.get(op, len(operands)) or (op == DOT and (not operands or len(operands) % 2)):
+                raise ValueError(f"Wrong number of operands for gate {idx} of circuit")
+            if any(not 0 <= w < idx for w in operands):
+                raise ValueError(f"Operand out of range for gate {idx} of circuit")
+            gates.append(gate)
+    except (IndexError, UnicodeDecodeError, struct.error) as e:
+        # Out of range keys or constants, or invalid names.
+        raise ValueError("Corrupted circuit") from e
+    if any(wire >= num_gates for wire in outputs.values()):
+        raise ValueError("Output out of range in circuit")
+
+    digest = reader.digest.digest()
+    if stream.read(len(digest)) != digest:
+        raise ValueError("Corrupted circuit")
+    if expected_hash is not None and digest.hex() != expected_hash:
+        raise ValueError("Unexpected circuit")
+    return Circuit(gates, outputs)
+
+
+def circuit_to_bytes(circuit: Circuit) -> Tuple[bytes, str]:
+    """
+    Serialize a circuit, returning its binary form and its hash.
+    """
+    stream = io.BytesIO()
+    circuit_hash = write_circuit(circuit, stream)
+    return stream.getvalue(), circuit_hash
+
+
+def circuit_from_bytes(data: bytes, expected_hash: Optional[str] = None) -> Circuit:
+    """
+    Deserialize a circuit, checking its integrity (and its hash, if expected).
+    """
+    return read_circuit(io.BytesIO(data), expected_hash)
+
+
+class CircuitCache:
+    """
+    Cache of compiled circuits, keyed by the structural fingerprint of the expressions and
+    the list of participants, with LRU eviction.
+
+    Circuits are stored with placeholder keys, and rebound to the IDs of the secrets and
+    operations of the expressions on each hit, so the same formula over new secrets
+    skips compilation entirely. The cache can be shared by the parties running as threads
+    of a process, and by processes through its path.
+
+    Attributes:
+        capacity: maximum number of circuits kept in memory (default: 128)
+        path: directory where the circuits are also persisted, if any
+        hits: number of lookups answered from the cache
+        misses: number of lookups that required a compilation
+    """
+
+    def __init__(self, capacity: int = 128, path: Optional[str] = None):
+        self.capacity = capacity
+        self.path = path
+        self.circuits: collections.OrderedDict = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Guards the circuits and the counters. Compilations run outside of it.
+        self.lock = threading.Lock()
+
+
+    def get(self, outputs: Dict[str, Expression], participant_ids: List[str]) -> Circuit:
+        """
+        Get the circuit of named output expressions, compiling it if it is not cached.
+        """
+        key, secret_ids, op_ids = fingerprint(outputs, participant_ids)
+        with self.lock:
+            template = self.circuits.get(key)
+        if template is None:
+            template = self._load(key)
+
+        hit = template is not None
+        if not hit:
+            circuit = compile_circuit(outputs)
+            placeholders = {secret_id: f"S{idx}" for idx, secret_id in enumerate(secret_ids)}
+            placeholders.update({op_id: f"M{idx}" for idx, op_id in enumerate(op_ids)})
+            template = circuit.rebind(placeholders)
+            self._store(key, template)
+
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.circuits[key] = template
+            self.circuits.move_to_end(key)
+            while len(self.circuits) > self.capacity:
+                self.circuits.popitem(last=False)
+
+        keys = {f"S{idx}": secret_id for idx, secret_id in enumerate(secret_ids)}
+        keys.update({f"M{idx}": op_id for idx, op_id in enumerate(op_ids)})
+        return template.rebind(keys)
+
+
+    def _load(self, key: str) -> Optional[Circuit]:
+        """
+        Load a circuit persisted on disk, if any.
+        """
+        if self.path is None:
+            return None
+        try:
+            with open(os.path.join(self.path, f"{key}.circuit"), "rb") as f:
+                return read_circuit(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+    def _store(self, key: str, circuit: Circuit) -> None:
+        """
+        Persist a circuit on disk, if a path is given.
+        """
+        if self.path is None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        # Write to a temporary file of its own then rename it, so that concurrent parties,
+        # threads or processes, never read nor write a partial file.
+        fd, tmp_path = tempfile.mkstemp(prefix=f"{key}.", suffix=".tmp", dir=self.path)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write_circuit(circuit, f)
+            os.replace(tmp_path, os.path.join(self.path, f"{key}.circuit"))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+# Cache used by the parties unless they are given another one.
+default_circuit_cache = CircuitCache()
+
@@ -3,12 +3,48 @@ Utilities for client communication with the trusted server.
 You should not need to change this file.
 """
 
+import bisect
+import collections
+import datetime
+import email.utils
+import hashlib
+import hmac
 import json
+import logging
+import math
+import os
+import pickle
+import random
+import threading
 import time
-from typing import Union, Tuple
+import zlib
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener, answer_challenge, deliver_challenge
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Union, Tuple
 
 import requests
 
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+from circuit import circuit_from_bytes
+from logs import get_logger
+
+
+logger: logging.Logger = get_logger("communication")
+
+
+# Upper bounds, in seconds, of the buckets of the latency histograms.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, math.inf)
+
+# HTTP content encoding of each compression algorithm. lz4 is only available if installed.
+CONTENT_ENCODINGS = {"zlib": "deflate", "lz4": "lz4"}
+
+# Statuses of the answers to polls meaning that the message is not ready yet.
+RETRY_STATUSES = (404, 503)
+
 
 def sanitize_url_param(url_param: Union[bytes, str]) -> str:
     """
@@ -24,16 +60,324 @@ def sanitize_url_param(url_param: Union[bytes, str]) -> str:
     return url_param.replace("/", "_").replace("+", "-") # type: ignore
 
 
-class Communication:
+class TransportStats:
+    """
+    Counters of the traffic of a transport, the same for every backend so that they can be
+    compared directly.
+
+    Attributes:
+        requests: number of requests made, including the retries of polls
+        bytes_sent: bytes of the messages sent (request bodies, or pickled messages)
+        bytes_received: bytes of the messages received (response bodies, or pickled messages)
+        payload_sent: bytes of the messages sent before compression
+        payload_received: bytes of the messages received after decompression
+        poll_misses: number of retrievals answered before their message was ready
+        polled: number of messages retrieved after at least one poll miss
+        max_poll_misses: largest number of poll misses before retrieving a message
+        poll_wait: time spent sleeping between polls in seconds
+        latencies: number of requests whose latency falls in each bucket of `LATENCY_BUCKETS`
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.payload_sent = 0
+        self.payload_received = 0
+        self.poll_misses = 0
+        self.polled = 0
+        self.max_poll_misses = 0
+        self.poll_wait = 0.0
+        self.latencies = [0] * len(LATENCY_BUCKETS)
+        # The retrievals of the dataflow executor run in a pool of threads.
+        self.lock = threading.Lock()
+
+
+    def record_request(
+            self,
+            latency: float,
+            sent: int = 0,
+            received: int = 0,
+            payload_sent: Optional[int] = None,
+            payload_received: Optional[int] = None
+        ) -> None:
+        """
+        Count a request, its latency in seconds and the bytes it carried, with the sizes of
+        its payloads if it was compressed.
+        """
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, latency)
+        with self.lock:
+            self.requests += 1
+            self.latencies[bucket] += 1
+        self.record_bytes(sent, received, payload_sent, payload_received)
+
+
+    def record_bytes(
+            self,
+            sent: int = 0,
+            received: int = 0,
+            payload_sent: Optional[int] = None,
+            payload_received: Optional[int] = None
+        ) -> None:
+        """
+        Count bytes carried outside of a request, e.g. pushed by a peer.
+        """
+        with self.lock:
+            self.bytes_sent += sent
+            self.bytes_received += received
+            self.payload_sent += sent if payload_sent is None else payload_sent
+            self.payload_received += received if payload_received is None else payload_received
+
+
+    def compression_ratio(self) -> float:
+        """
+        Bytes of the payloads per byte carried (1 without compression).
+        """
+        with self.lock:
+            carried = self.bytes_sent + self.bytes_received
+            payload = self.payload_sent + self.payload_received
+        return payload / carried if carried else 1.0
+
+
+    def record_miss(self) -> None:
+        """
+        Count a retrieval answered before its message was ready.
+        """
+        with self.lock:
+            self.poll_misses += 1
+
+
+    def record_poll(self, misses: int, wait: float) -> None:
+        """
+        Count a message retrieved after some poll misses, and the time slept meanwhile.
+        """
+        with self.lock:
+            self.polled += 1
+            self.max_poll_misses = max(self.max_poll_misses, misses)
+            self.poll_wait += wait
+
+
+    def as_dict(self) -> Dict[str, Any]:
+        """
+        Counters as a dictionary, the latency histogram keyed by the upper bound of each
+        bucket.
+        """
+        ratio = self.compression_ratio()
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "payload_sent": self.payload_sent,
+                "payload_received": self.payload_received,
+                "compression_ratio": ratio,
+                "poll_misses": self.poll_misses,
+                "polled": self.polled,
+                "max_poll_misses": self.max_poll_misses,
+                "poll_wait": self.poll_wait,
+                "latencies": dict(zip(LATENCY_BUCKETS, self.latencies)),
+            }
+
+
+class Transport:
+    """
+    Interface of the transports carrying the messages of a client.
+
+    Retrievals block until their message is ready. Every transport counts its traffic in
+    `stats`.
+
+    Attributes:
+        client_id: Identifier of this client
+        stats: counters of the traffic of this transport
+    """
+
+    def __init__(self, client_id: str):
+        self.client_id = client_id
+        self.stats = TransportStats()
+
+
+    def send_private_message(
+            self,
+            receiver_id: str,
+            label: str,
+            message: Union[bytes, str]
+        ) -> None:
+        """
+        Send a private message to another client.
+        """
+        raise NotImplementedError
+
+
+    def retrieve_private_message(
+            self,
+            label: str
+        ) -> bytes:
+        """
+        Retrieve a private message sent to this client.
+        """
+        raise NotImplementedError
+
+
+    def publish_message(
+            self,
+            label: str,
+            message: Union[bytes, str]
+        ) -> None:
+        """
+        Publish a message for every client.
+        """
+        raise NotImplementedError
+
+
+    def retrieve_public_message(
+            self,
+            sender_id: str,
+            label: str
+        ) -> bytes:
+        """
+        Retrieve a message published by a client.
+        """
+        raise NotImplementedError
+
+
+    def retrieve_aggregated_message(
+            self,
+            label: str,
+            mode: str = "sum"
+        ) -> bytes:
+        """
+        Retrieve the public messages of all the participants for a label, aggregated
+        (see `aggregate_messages`).
+        """
+        raise NotImplementedError
+
+
+    def wait_for_many(
+            self,
+            keys: Iterable[Tuple[str, str]],
+            wait_all: bool = True
+        ) -> Dict[Tuple[str, str], bytes]:
+        """
+        Retrieve several messages, given as (sender_id, label), in one request. An empty
+        sender stands for a private message sent to this client (private messages are
+        addressed by label only).
+
+        If `wait_all`, block until all of them are ready. Otherwise, return as soon as
+        some are, with the ones ready (see `iter_many`). Transports override it to make a
+        single request.
+        """
+        keys = list(keys)
+        if not wait_all:
+            keys = keys[:1]
+        return {
+            (sender_id, label): (
+                self.retrieve_public_message(sender_id, label) if sender_id
+                else self.retrieve_private_message(label)
+            )
+            for sender_id, label in keys
+        }
+
+
+    def iter_many(
+            self,
+            keys: Iterable[Tuple[str, str]]
+        ) -> Iterator[Tuple[Tuple[str, str], bytes]]:
+        """
+        Yield several messages, given as in `wait_for_many`, as they arrive, so that a slow
+        sender does not hold back the messages of the others.
+        """
+        remaining = list(keys)
+        while remaining:
+            ready = self.wait_for_many(remaining, wait_all=False)
+            yield from ready.items()
+            remaining = [key for key in remaining if key not in ready]
+
+
+    def retrieve_beaver_triplet_shares(
+            self,
+            op_id: str
+        ) -> Tuple[int, int, int]:
+        """
+        Retrieve a triplet of shares generated by the trusted third party.
+        """
+        raise NotImplementedError
+
+
+    def retrieve_beaver_triplet_shares_batch(
+            self,
+            op_ids: List[str]
+        ) -> List[Tuple[int, int, int]]:
+        """
+        Retrieve the triplets of shares of several operations. Transports override it to
+        make a single request.
+        """
+        return [self.retrieve_beaver_triplet_shares(op_id) for op_id in op_ids]
+
+
+    def retrieve_randomness_batch(
+            self,
+            ops: List[Tuple[str, str, int]]
+        ) -> List[Tuple[int, ...]]:
+        """
+        Retrieve the shares of the random masks of several operations, given as
+        (op_id, kind, size).
+        """
+        raise NotImplementedError
+
+
+    def publish_circuit(
+            self,
+            circuit_hash: str,
+            data: bytes
+        ) -> None:
+        """
+        Publish a compiled circuit for the clients to load it.
+        """
+        raise NotImplementedError
+
+
+    def retrieve_circuit(
+            self,
+            circuit_hash: str
+        ) -> bytes:
+        """
+        Retrieve a compiled circuit.
+        """
+        raise NotImplementedError
+
+
+class Reply(NamedTuple):
+    """
+    Answer of the server to a request, with its decompressed content.
+    """
+    status_code: int
+    headers: Mapping[str, str]
+    content: bytes
+
+
+class Communication(Transport):
     """
-    Network communications with the server.
+    Network communications with the server, polling it until the messages are ready.
+
+    The delay between polls starts short, for fast rounds, and grows exponentially with
+    random jitter up to a cap, for slow peers. It starts over whenever the server reports
+    fewer missing messages than before, since the message is then likely to come soon.
 
     Attributes:
         server_host: hostname of the server
         server_port: port of the server
         client_id: Identifier of this client
-        poll_delay: delay between requests in seconds (default: 0.2 s)
+        poll_delay: initial delay between requests in seconds (default: 0.01 s)
         protocol: network protocol to use (default: "http")
+        max_poll_delay: cap of the delay between requests in seconds (default: 0.5 s)
+        backoff: factor applied to the delay after each miss (default: 2)
+        jitter: fraction of the delay drawn at random, so that the parties do not poll in
+            lockstep (default: 0.5)
+        compression: "zlib" or "lz4" (if installed) to compress the messages of at least
+            `compression_threshold` bytes (default: 1024) with the given level (default:
+            6), None not to compress (default). The server compresses its answers too.
+        max_message_size: largest answer accepted from the server, once decompressed,
+            in bytes (default: 64 MiB); larger ones raise `MessageTooLarge`
     """
 
     def __init__(
@@ -41,12 +385,94 @@ class Communication:
             server_host: str,
             server_port: int,
             client_id: str,
-            poll_delay: float = 0.2,
-            protocol: str = "http"
+            poll_delay: float = 0.01,
+            protocol: str = "http",
+            max_poll_delay: float = 0.5,
+            backoff: float = 2.0,
+            jitter: float = 0.5,
+            compression: Optional[str] = None,
+            compression_threshold: int = 1024,
+            compression_level: int = 6,
+            max_message_size: int = 64 << 20
     ):
+        super().__init__(client_id)
+        if compression is not None and compression not in available_compressions():
+            raise ValueError(f"Unavailable compression {compression}")
         self.base_url = f"{protocol}://{server_host}:{server_port}"
-        self.client_id = client_id
         self.poll_delay = poll_delay
+        self.max_poll_delay = max_poll_delay
+        self.backoff = backoff
+        self.jitter = jitter
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.compression_level = compression_level
+        self.max_message_size = max_message_size
+        # The answers are only compressed with the chosen algorithm, if any.
+        self.accept_encoding = CONTENT_ENCODINGS[compression] if compression is not None else "identity"
+
+
+    def _request(self, method: str, url: str, data: Optional[Union[bytes, str]] = None) -> Reply:
+        """
+        Send a request to the server, compressing it if large enough, and count it.
+        """
+        logger.debug("%s %s", method, url)
+        headers = {"Accept-Encoding": self.accept_encoding}
+        payload = _to_bytes(data) if data is not None else b""
+        body = payload
+        if self.compression is not None and len(payload) >= self.compression_threshold:
+            body = compress(payload, self.compression, self.compression_level)
+            headers["Content-Encoding"] = CONTENT_ENCODINGS[self.compression]
+
+        start = time.perf_counter()
+        res = requests.request(
+            method, url, data=body if data is not None else None, headers=headers, stream=True
+        )
+        # The body is read as it is on the wire, to count its bytes before decompression.
+        raw = res.raw.read(decode_content=False)
+        content = decompress(raw, res.headers.get("Content-Encoding"), self.max_message_size)
+        self.stats.record_request(
+            time.perf_counter() - start, len(body), len(raw), len(payload), len(content)
+        )
+        if res.status_code == 404:
+            self.stats.record_miss()
+        return Reply(res.status_code, res.headers, content)
+
+
+    def _poll(self, url: str, data: Optional[Union[bytes, str]] = None) -> bytes:
+        """
+        Request a message until the server has it, with a POST if there is data to send.
+        Only the answers meaning that the message is not ready yet (404 and 503) are
+        retried, the other errors raise `requests.HTTPError`.
+        """
+        # We can either use a websocket, or do some polling, but websockets would require asyncio.
+        # So we are doing polling to avoid introducing a new programming paradigm.
+        delay = self.poll_delay
+        missing = None
+        misses = 0
+        wait = 0.0
+        method = "GET" if data is None else "POST"
+        while True:
+            res = self._request(method, url, data)
+            if res.status_code == 200:
+                if misses > 0:
+                    self.stats.record_poll(misses, wait)
+                return res.content
+            _check_retry_status(res, method, url)
+            misses += 1
+
+            hint = res.headers.get("X-Missing-Messages")
+            if hint is not None:
+                if missing is not None and int(hint) < missing:
+                    delay = self.poll_delay
+                missing = int(hint)
+            retry_after = parse_retry_after(res.headers.get("Retry-After"))
+            if retry_after is not None:
+                pause = min(retry_after, self.max_poll_delay)
+            else:
+                pause = random.uniform((1 - self.jitter) * delay, delay)
+            time.sleep(pause)
+            wait += pause
+            delay = min(delay * self.backoff, self.max_poll_delay)
 
 
     def send_private_message(
@@ -64,8 +490,7 @@ class Communication:
         label_san = sanitize_url_param(label)
 
         url = f"{self.base_url}/private/{client_id_san}/{receiver_id_san}/{label_san}"
-        print(f"POST {url}")
-        requests.post(url, message)
+        _check_success(self._request("POST", url, message), "POST", url)
 
 
     def retrieve_private_message(
@@ -80,14 +505,7 @@ class Communication:
         label_san = sanitize_url_param(label)
 
         url = f"{self.base_url}/private/{client_id_san}/{label_san}"
-        # We can either use a websocket, or do some polling, but websockets would require asyncio.
-        # So we are doing polling to avoid introducing a new programming paradigm.
-        while True:
-            print(f"GET  {url}")
-            res = requests.get(url)
-            if res.status_code == 200:
-                return res.content
-            time.sleep(self.poll_delay)
+        return self._poll(url)
 
 
     def publish_message(
@@ -103,8 +521,7 @@ class Communication:
         label_san = sanitize_url_param(label)
 
         url = f"{self.base_url}/public/{client_id_san}/{label_san}"
-        print(f"POST {url}")
-        requests.post(url, message)
+        _check_success(self._request("POST", url, message), "POST", url)
 
 
     def retrieve_public_message(
@@ -121,15 +538,48 @@ class Communication:
         label_san = sanitize_url_param(label)
 
         url = f"{self.base_url}/public/{client_id_san}/{sender_id_san}/{label_san}"
+        return self._poll(url)
 
-        # We can either use a websocket, or do some polling, but websockets would require asyncio.
-        # So we are doing polling to avoid introducing a new programming paradigm.
-        while True:
-            print(f"GET  {url}")
-            res = requests.get(url)
-            if res.status_code == 200:
-                return res.content
-            time.sleep(self.poll_delay)
+
+    def retrieve_aggregated_message(
+            self,
+            label: str,
+            mode: str = "sum"
+        ) -> bytes:
+        """
+        Retrieve the public messages of all the participants for a label in one response,
+        once they are all published, aggregated by the server (see `aggregate_messages`).
+        """
+
+        client_id_san = sanitize_url_param(self.client_id)
+        label_san = sanitize_url_param(label)
+
+        url = f"{self.base_url}/aggregate/{client_id_san}/{label_san}?mode={mode}"
+        return self._poll(url)
+
+
+    def wait_for_many(
+            self,
+            keys: Iterable[Tuple[str, str]],
+            wait_all: bool = True
+        ) -> Dict[Tuple[str, str], bytes]:
+        """
+        Retrieve several messages, given as (sender_id, label), in one request (see
+        `Transport.wait_for_many`).
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+
+        client_id_san = sanitize_url_param(self.client_id)
+        keys_san = [
+            [sanitize_url_param(sender_id) if sender_id else "", sanitize_url_param(label)]
+            for sender_id, label in keys
+        ]
+
+        url = f"{self.base_url}/many/{client_id_san}?all={int(wait_all)}"
+        messages = unpack_messages(self._poll(url, json.dumps(keys_san)))
+        return {keys[idx]: message for idx, message in messages.items()}
 
 
     def retrieve_beaver_triplet_shares(
@@ -144,7 +594,1097 @@ class Communication:
         op_id_san = sanitize_url_param(op_id)
 
         url = f"{self.base_url}/shares/{client_id_san}/{op_id_san}"
-        print(f"GET  {url}")
 
-        res = requests.get(url)
-        return tuple(json.loads(res.text)) # type: ignore
+        res = self._request("GET", url)
+        _check_success(res, "GET", url)
+        return tuple(json.loads(res.content)) # type: ignore
+
+
+    def retrieve_beaver_triplet_shares_batch(
+            self,
+            op_ids: List[str]
+        ) -> List[Tuple[int, int, int]]:
+        """
+        Retrieve the triplets of shares of several operations in a single request.
+        """
+
+        client_id_san = sanitize_url_param(self.client_id)
+        op_ids_san = [sanitize_url_param(op_id) for op_id in op_ids]
+
+        url = f"{self.base_url}/shares/{client_id_san}"
+
+        res = self._request("POST", url, json.dumps(op_ids_san))
+        _check_success(res, "POST", url)
+        return [tuple(triplet) for triplet in json.loads(res.content)] # type: ignore
+
+
+    def retrieve_randomness_batch(
+            self,
+            ops: List[Tuple[str, str, int]]
+        ) -> List[Tuple[int, ...]]:
+        """
+        Retrieve the shares of the random masks of several operations, given as
+        (op_id, kind, size), in a single request.
+        """
+
+        client_id_san = sanitize_url_param(self.client_id)
+        ops_san = [(sanitize_url_param(op_id), kind, size) for op_id, kind, size in ops]
+
+        url = f"{self.base_url}/randomness/{client_id_san}"
+
+        res = self._request("POST", url, json.dumps(ops_san))
+        _check_success(res, "POST", url)
+        return [tuple(masks) for masks in json.loads(res.content)] # type: ignore
+
+
+    def publish_circuit(
+            self,
+            circuit_hash: str,
+            data: bytes
+        ) -> None:
+        """
+        Publish a compiled circuit on the server.
+        """
+
+        url = f"{self.base_url}/circuits/{sanitize_url_param(circuit_hash)}"
+        res = self._request("POST", url, data)
+        if res.status_code != 200:
+            raise ValueError(f"The server rejected circuit {circuit_hash}")
+
+
+    def retrieve_circuit(
+            self,
+            circuit_hash: str
+        ) -> bytes:
+        """
+        Retrieve a compiled circuit from the server.
+        """
+
+        url = f"{self.base_url}/circuits/{sanitize_url_param(circuit_hash)}"
+        return self._poll(url)
+
+class LongPollCommunication(Communication):
+    """
+    Network communications with the server, which holds each retrieval until the message
+    is ready or a timeout expires, so that the client neither floods it with polls nor
+    sleeps after the message arrived.
+
+    Attributes:
+        server_host: hostname of the server
+        server_port: port of the server
+        client_id: Identifier of this client
+        wait: longest time the server holds a retrieval in seconds (default: 10 s)
+        protocol: network protocol to use (default: "http")
+        compression: compression of the messages, as in `Communication`
+        max_message_size: largest answer accepted from the server, as in `Communication`
+    """
+
+    def __init__(
+            self,
+            server_host: str,
+            server_port: int,
+            client_id: str,
+            wait: float = 10.0,
+            protocol: str = "http",
+            compression: Optional[str] = None,
+            compression_threshold: int = 1024,
+            compression_level: int = 6,
+            max_message_size: int = 64 << 20
+    ):
+        super().__init__(
+            server_host, server_port, client_id, 0.0, protocol,
+            compression=compression,
+            compression_threshold=compression_threshold,
+            compression_level=compression_level,
+            max_message_size=max_message_size
+        )
+        self.wait = wait
+
+
+    def _poll(self, url: str, data: Optional[Union[bytes, str]] = None) -> bytes:
+        """
+        Request a message, held by the server until it has it, until it is ready.
+        """
+        separator = "&" if "?" in url else "?"
+        url = f"{url}{separator}wait={self.wait}"
+        method = "GET" if data is None else "POST"
+        misses = 0
+        while True:
+            res = self._request(method, url, data)
+            if res.status_code == 200:
+                if misses > 0:
+                    self.stats.record_poll(misses, 0.0)
+                return res.content
+            _check_retry_status(res, method, url)
+            misses += 1
+
+
+class UnixSocketCommunication(Transport):
+    """
+    Communications with a server running on the same host, through a Unix domain socket.
+
+    It keeps a connection open (one per thread) and the server blocks on retrievals until
+    the message is ready, so no polling is needed.
+
+    Attributes:
+        socket_path: path of the Unix domain socket of the server
+        client_id: Identifier of this client
+        authkey: key authenticating the connections to the server (default: the key the
+            server wrote next to the socket, see `unix_socket_key_path`)
+    """
+
+    def __init__(
+            self,
+            socket_path: str,
+            client_id: str,
+            authkey: Optional[bytes] = None
+    ):
+        super().__init__(client_id)
+        self.socket_path = socket_path
+        self.authkey = authkey
+        self.local = threading.local()
+
+
+    def _connect(self) -> Connection:
+        """
+        Open an authenticated connection to the server.
+        """
+        if self.authkey is None:
+            # Read on the first connection, the server may not have started before.
+            with open(unix_socket_key_path(self.socket_path), "rb") as f:
+                self.authkey = f.read()
+        return Client(self.socket_path, family="AF_UNIX", authkey=self.authkey)
+
+
+    def _request(self, method: str, *args: Any) -> Any:
+        """
+        Send a request to the server and wait for its answer.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self._connect()
+        logger.debug("%s %s", method, self.socket_path)
+        # The requests are pickled here rather than by the connection, to count their bytes.
+        start = time.perf_counter()
+        data = pickle.dumps((method, args))
+        conn.send_bytes(data)
+        res = conn.recv_bytes()
+        self.stats.record_request(time.perf_counter() - start, len(data), len(res))
+        return pickle.loads(res)
+
+
+    def send_private_message(
+            self,
+            receiver_id: str,
+            label: str,
+            message: Union[bytes, str]
+        ) -> None:
+        """
+        Send a private message to the server.
+        """
+        self._request(
+            "send_private",
+            sanitize_url_param(self.client_id),
+            sanitize_url_param(receiver_id),
+            sanitize_url_param(label),
+            _to_bytes(message)
+        )
+
+
+    def retrieve_private_message(
+            self,
+            label: str
+        ) -> bytes:
+        """
+        Retrieve a private message from the server.
+        """
+        return self._request(
+            "retrieve_private",
+            sanitize_url_param(self.client_id),
+            sanitize_url_param(label)
+        )
+
+
+    def publish_message(
+            self,
+            label: str,
+            message: Union[bytes, str]
+        ) -> None:
+        """
+        Publish a message on the server.
+        """
+        self._request(
+            "publish",
+            sanitize_url_param(self.client_id),
+            sanitize_url_param(label),
+            _to_bytes(message)
+        )
+
+
+    def retrieve_public_message(
+            self,
+            sender_id: str,
+            label: str
+        ) -> bytes:
+        """
+        Retrieve a public message from the server.
+        """
+        return self._request(
+            "retrieve_public",
+            sanitize_url_param(self.client_id),
+            sanitize_url_param(sender_id),
+            sanitize_url_param(label)
+        )
+
+
+    def retrieve_aggregated_message(
+            self,
+            label: str,
+            mode: str = "sum"
+        ) -> bytes:
+        """
+        Retrieve the public messages of all the participants for a label in one response,
+        once they are all published, aggregated by the server (see `aggregate_messages`).
+        """
+        return self._request(
+            "retrieve_aggregate",
+            sanitize_url_param(self.client_id),
+            sanitize_url_param(label),
+            mode
+        )
+
+
+    def wait_for_many(
+            self,
+            keys: Iterable[Tuple[str, str]],
+            wait_all: bool = True
+        ) -> Dict[Tuple[str, str], bytes]:
+        """
+        Retrieve several messages, given as (sender_id, label), in one request (see
+        `Transport.wait_for_many`).
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        messages = self._request(
+            "wait_many",
+            sanitize_url_param(self.client_id),
+            [
+                (sanitize_url_param(sender_id) if sender_id else "", sanitize_url_param(label))
+                for sender_id, label in keys
+            ],
+            wait_all
+        )
+        return {keys[idx]: message for idx, message in messages.items()}
+
+
+    def retrieve_beaver_triplet_shares(
+            self,
+            op_id: str
+        ) -> Tuple[int, int, int]:
+        """
+        Retrieve a triplet of shares generated by the trusted server.
+        """
+        return tuple(self._request(
+            "shares",
+            sanitize_url_param(self.client_id),
+            sanitize_url_param(op_id)
+        )) # type: ignore
+
+
+    def retrieve_beaver_triplet_shares_batch(
+            self,
+            op_ids: List[str]
+        ) -> List[Tuple[int, int, int]]:
+        """
+        Retrieve the triplets of shares of several operations in a single request.
+        """
+        return [tuple(triplet) for triplet in self._request( # type: ignore
+            "shares_batch",
+            sanitize_url_param(self.client_id),
+            [sanitize_url_param(op_id) for op_id in op_ids]
+        )]
+
+
+    def retrieve_randomness_batch(
+            self,
+            ops: List[Tuple[str, str, int]]
+        ) -> List[Tuple[int, ...]]:
+        """
+        Retrieve the shares of the random masks of several operations, given as
+        (op_id, kind, size), in a single request.
+        """
+        return [tuple(masks) for masks in self._request( # type: ignore
+            "randomness_batch",
+            sanitize_url_param(self.client_id),
+            [(sanitize_url_param(op_id), kind, size) for op_id, kind, size in ops]
+        )]
+
+
+    def publish_circuit(
+            self,
+            circuit_hash: str,
+            data: bytes
+        ) -> None:
+        """
+        Publish a compiled circuit on the server.
+        """
+        if not self._request("publish_circuit", sanitize_url_param(circuit_hash), data):
+            raise ValueError(f"The server rejected circuit {circuit_hash}")
+
+
+    def retrieve_circuit(
+            self,
+            circuit_hash: str
+        ) -> bytes:
+        """
+        Retrieve a compiled circuit from the server.
+        """
+        return self._request("retrieve_circuit", sanitize_url_param(circuit_hash))
+
+
+class PeerToPeerCommunication(Communication):
+    """
+    Network communications where the parties exchange messages directly with each other.
+
+    Each party listens on a TCP port and opens a persistent connection to every other
+    participant. The server is only used to discover the addresses of the peers and to
+    retrieve Beaver triplets, so it does not relay the shares anymore.
+
+    The connections are authenticated with a key shared by the parties out of band: each
+    pair of parties proves to each other that it knows the key derived for that pair (see
+    `peer_authkey`), so a connection is bound to the peer it claims to come from and no key
+    goes through the server. The messages are sent as frames of bytes (see
+    `pack_peer_message`), which are never unpickled.
+
+    Attributes:
+        server_host: hostname of the server
+        server_port: port of the server
+        client_id: Identifier of this client
+        participant_ids: IDs of all the participants, including this client
+        host: hostname on which this client listens for its peers (default: "localhost")
+        poll_delay: initial delay between requests to the server in seconds (default: 0.01 s)
+        protocol: network protocol to use with the server (default: "http")
+        session: identifier of the run (see `ProtocolSpec`), which scopes the addresses
+            published on the server, so that a later run does not connect to stale ones
+        authkey: key of the session, shared by its parties beforehand (required)
+    """
+
+    def __init__(
+            self,
+            server_host: str,
+            server_port: int,
+            client_id: str,
+            participant_ids: List[str],
+            host: str = "localhost",
+            poll_delay: float = 0.01,
+            protocol: str = "http",
+            session: str = "",
+            authkey: Optional[bytes] = None
+    ):
+        if not authkey:
+            raise ValueError("The peer-to-peer transport needs the authkey of the session")
+        super().__init__(server_host, server_port, client_id, poll_delay, protocol)
+        self.participant_ids = participant_ids
+        self.peers: Dict[str, Connection] = {}
+        self.connected = False
+        self.connect_lock = threading.Lock()
+        # Messages received from peers, keyed by (pool, sender, label).
+        self.inbox: Dict[Tuple[str, str, str], bytes] = {}
+        self.inbox_updated = threading.Condition()
+
+        self.address_label = f"{session}_p2p_address" if session else "p2p_address"
+        self.authkey = authkey
+        # The handshake depends on the peer, so it is done by the thread of each connection.
+        self.listener = Listener((host, 0))
+        threading.Thread(target=self._accept_peers, daemon=True).start()
+
+
+    def _accept_peers(self) -> None:
+        """
+        Accept the connections of the peers, each one authenticated and read in its own
+        thread, so that a stalled peer does not hold up the others.
+        """
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError as e:
+                logger.warning("%s failed to accept a peer connection: %s", self.client_id, e)
+                continue
+            threading.Thread(target=self._read_peer, args=(conn,), daemon=True).start()
+
+
+    def _read_peer(self, conn: Connection) -> None:
+        """
+        Authenticate a peer, then store the messages it sends in the inbox.
+        """
+        try:
+            sender_id = conn.recv_bytes(256).decode()
+            if sender_id not in self.participant_ids or sender_id == self.client_id:
+                raise ValueError(f"Unknown peer {sender_id!r}")
+            # Only the claimed peer and this client know the key of the pair.
+            authkey = peer_authkey(self.authkey, self.client_id, sender_id)
+            deliver_challenge(conn, authkey)
+            answer_challenge(conn, authkey)
+            while True:
+                data = conn.recv_bytes()
+                self.stats.record_bytes(received=len(data))
+                pool, label, message = unpack_peer_message(data)
+                self._deliver(pool, sender_id, label, message)
+        except EOFError:
+            return
+        except (AuthenticationError, OSError, UnicodeDecodeError, ValueError) as e:
+            logger.warning("%s dropped a peer connection: %s", self.client_id, e)
+        finally:
+            conn.close()
+
+
+    def _send_peer(self, conn: Connection, pool: str, label: str, message: bytes) -> None:
+        """
+        Send a message to a peer, and count it.
+        """
+        start = time.perf_counter()
+        data = pack_peer_message(pool, label, message)
+        conn.send_bytes(data)
+        self.stats.record_request(time.perf_counter() - start, len(data))
+
+
+    def _deliver(self, pool: str, sender_id: str, label: str, message: bytes) -> None:
+        """
+        Put a message in the inbox and wake up the waiting retrievals.
+        """
+        # Private messages are addressed by label only, like on the server.
+        if pool == "private":
+            sender_id = ""
+        with self.inbox_updated:
+            self.inbox[(pool, sender_id, label)] = message
+            self.inbox_updated.notify_all()
+
+
+    def _wait(self, pool: str, sender_id: str, label: str) -> bytes:
+        """
+        Block until a message is in the inbox, then get it.
+        """
+        key = (pool, sender_id, label)
+        with self.inbox_updated:
+            if key not in self.inbox:
+                self.stats.record_miss()
+                self.inbox_updated.wait_for(lambda: key in self.inbox)
+            return self.inbox[key]
+
+
+    def connect(self) -> None:
+        """
+        Announce the address of this client on the server and connect to every peer.
+        Called automatically before the first exchange.
+        """
+        with self.connect_lock:
+            if self.connected:
+                return
+            host, port = self.listener.address
+            super().publish_message(self.address_label, json.dumps([host, port]))
+            for participant_id in self.participant_ids:
+                if participant_id == self.client_id:
+                    continue
+                address = super().retrieve_public_message(participant_id, self.address_label)
+                peer_host, peer_port = json.loads(address)
+                conn = Client((peer_host, peer_port))
+                conn.send_bytes(self.client_id.encode())
+                # The peer proves its identity too, so a forged address is of no use.
+                authkey = peer_authkey(self.authkey, self.client_id, participant_id)
+                answer_challenge(conn, authkey)
+                deliver_challenge(conn, authkey)
+                self.peers[participant_id] = conn
+            self.connected = True
+
+
+    def send_private_message(
+            self,
+            receiver_id: str,
+            label: str,
+            message: Union[bytes, str]
+        ) -> None:
+        """
+        Send a private message directly to a peer.
+        """
+        self.connect()
+        message = _to_bytes(message)
+        if receiver_id == self.client_id:
+            self._deliver("private", self.client_id, label, message)
+        else:
+            self._send_peer(self.peers[receiver_id], "private", label, message)
+
+
+    def retrieve_private_message(
+            self,
+            label: str
+        ) -> bytes:
+        """
+        Retrieve a private message sent by a peer.
+        """
+        self.connect()
+        return self._wait("private", "", label)
+
+
+    def publish_message(
+            self,
+            label: str,
+            message: Union[bytes, str]
+        ) -> None:
+        """
+        Publish a message to every peer.
+        """
+        self.connect()
+        message = _to_bytes(message)
+        self._deliver("public", self.client_id, label, message)
+        for conn in self.peers.values():
+            self._send_peer(conn, "public", label, message)
+
+
+    def retrieve_public_message(
+            self,
+            sender_id: str,
+            label: str
+        ) -> bytes:
+        """
+        Retrieve a public message published by a peer.
+        """
+        self.connect()
+        return self._wait("public", sender_id, label)
+
+
+    def retrieve_aggregated_message(
+            self,
+            label: str,
+            mode: str = "sum"
+        ) -> bytes:
+        """
+        Retrieve the public messages of all the peers for a label, aggregated locally since
+        they do not go through the server.
+        """
+        self.connect()
+        messages = [self._wait("public", sender_id, label) for sender_id in self.participant_ids]
+        return aggregate_messages(messages, mode)
+
+
+    def wait_for_many(
+            self,
+            keys: Iterable[Tuple[str, str]],
+            wait_all: bool = True
+        ) -> Dict[Tuple[str, str], bytes]:
+        """
+        Retrieve several messages sent by peers, given as (sender_id, label) (see
+        `Transport.wait_for_many`).
+        """
+        self.connect()
+        keys = list(keys)
+        inbox_keys = {
+            key: ("public", key[0], key[1]) if key[0] else ("private", "", key[1]) for key in keys
+        }
+
+        def ready() -> Dict[Tuple[str, str], bytes]:
+            return {key: self.inbox[inbox_key] for key, inbox_key in inbox_keys.items() if inbox_key in self.inbox}
+
+        with self.inbox_updated:
+            res = ready()
+            if len(res) < len(keys):
+                self.stats.record_miss()
+            while len(res) < (len(keys) if wait_all else min(1, len(keys))):
+                self.inbox_updated.wait()
+                res = ready()
+            return res
+
+
+class InMemoryHub:
+    """
+    Messages and trusted parameters shared by parties running in the same process, e.g. as
+    threads, to run the protocol without any network.
+
+    Attributes:
+        participant_ids: participants, in the order their messages are aggregated
+    """
+
+    def __init__(self):
+        # Imported here since the trusted third party depends on this module.
+        from ttp import TrustedParamGenerator
+
+        self.participant_ids: List[str] = []
+        self.store: Dict[str, Dict[Tuple[str, str], bytes]] = collections.defaultdict(dict)
+        self.store_updated = threading.Condition()
+        self.ttp = TrustedParamGenerator()
+
+
+    def add_participants(self, participant_ids: List[str]) -> None:
+        """
+        Register the participants of a run, if they are not yet.
+        """
+        with self.store_updated:
+            for participant_id in participant_ids:
+                if participant_id not in self.participant_ids:
+                    self.participant_ids.append(participant_id)
+                    self.ttp.add_participant(participant_id)
+
+
+    def set_value(self, pool: str, channel: Tuple[str, str], data: bytes) -> None:
+        """
+        Push data to a channel in a given pool and wake up the waiting retrievals.
+        """
+        with self.store_updated:
+            self.store[pool][channel] = data
+            self.store_updated.notify_all()
+
+
+    def wait_value(self, pool: str, channel: Tuple[str, str]) -> Tuple[bytes, bool]:
+        """
+        Block until a channel in a given pool is ready, then get it, and whether it had to
+        wait for it.
+        """
+        with self.store_updated:
+            missed = channel not in self.store[pool]
+            self.store_updated.wait_for(lambda: channel in self.store[pool])
+            return self.store[pool][channel], missed
+
+
+    def wait_many(
+            self,
+            channels: List[Tuple[str, Tuple[str, str]]],
+            wait_all: bool
+        ) -> Tuple[Dict[int, bytes], bool]:
+        """
+        Block until all (or, if not `wait_all`, some) of the (pool, channel) are ready,
+        then get the ones ready by index, and whether it had to wait for them.
+        """
+        def ready() -> Dict[int, bytes]:
+            return {
+                idx: self.store[pool][channel]
+                for idx, (pool, channel) in enumerate(channels) if channel in self.store[pool]
+            }
+
+        with self.store_updated:
+            res = ready()
+            missed = len(res) < len(channels)
+            while len(res) < (len(channels) if wait_all else min(1, len(channels))):
+                self.store_updated.wait()
+                res = ready()
+            return res, missed
+
+
+    def call_ttp(self, method: Callable, *args: Any) -> Any:
+        """
+        Call a method of the trusted third party, which is not thread-safe.
+        """
+        with self.store_updated:
+            return method(*args)
+
+
+# Hubs of the in-memory transports created by name, by session and participants (see
+# `make_transport`), so that the runs of a process do not see each other's messages.
+default_hubs: Dict[Tuple[str, Tuple[str, ...]], InMemoryHub] = {}
+default_hubs_lock = threading.Lock()
+
+
+class InMemoryTransport(Transport):
+    """
+    Communications through a hub shared by the parties running in the same process.
+
+    Nothing goes on a wire: the bytes counted are those of the messages, and the triplets
+    and masks are counted by the size of their decimal values.
+
+    Attributes:
+        hub: hub shared by the parties
+        client_id: Identifier of this client
+        participant_ids: IDs of all the participants, including this client
+    """
+
+    def __init__(
+            self,
+            hub: InMemoryHub,
+            client_id: str,
+            participant_ids: List[str]
+    ):
+        super().__init__(client_id)
+        self.hub = hub
+        hub.add_participants(participant_ids)
+
+
+    def _send(self, pool: str, channel: Tuple[str, str], message: Union[bytes, str]) -> None:
+        """
+        Put a message in the hub, and count it.
+        """
+        start = time.perf_counter()
+        message = _to_bytes(message)
+        self.hub.set_value(pool, channel, message)
+        self.stats.record_request(time.perf_counter() - start, sent=len(message))
+
+
+    def _retrieve(self, pool: str, channel: Tuple[str, str]) -> bytes:
+        """
+        Wait for a message of the hub, and count it.
+        """
+        start = time.perf_counter()
+        message, missed = self.hub.wait_value(pool, channel)
+        if missed:
+            self.stats.record_miss()
+        self.stats.record_request(time.perf_counter() - start, received=len(message))
+        return message
+
+
+    def _call_ttp(self, method: Callable, *args: Any) -> List[List[str]]:
+        """
+        Get share values from the trusted third party, and count them.
+        """
+        start = time.perf_counter()
+        res = [[share.value for share in shares] for shares in self.hub.call_ttp(method, *args)]
+        received = sum(len(value) for values in res for value in values)
+        self.stats.record_request(time.perf_counter() - start, received=received)
+        return res
+
+
+    def send_private_message(
+            self,
+            receiver_id: str,
+            label: str,
+            message: Union[bytes, str]
+        ) -> None:
+        """
+        Send a private message through the hub.
+        """
+        self._send("private", (receiver_id, label), message)
+
+
+    def retrieve_private_message(
+            self,
+            label: str
+        ) -> bytes:
+        """
+        Retrieve a private message from the hub.
+        """
+        return self._retrieve("private", (self.client_id, label))
+
+
+    def publish_message(
+            self,
+            label: str,
+            message: Union[bytes, str]
+        ) -> None:
+        """
+        Publish a message on the hub.
+        """
+        self._send("public", (self.client_id, label), message)
+
+
+    def retrieve_public_message(
+            self,
+            sender_id: str,
+            label: str
+        ) -> bytes:
+        """
+        Retrieve a public message from the hub.
+        """
+        return self._retrieve("public", (sender_id, label))
+
+
+    def retrieve_aggregated_message(
+            self,
+            label: str,
+            mode: str = "sum"
+        ) -> bytes:
+        """
+        Retrieve the public messages of all the participants for a label, aggregated
+        locally (see `aggregate_messages`).
+        """
+        messages = [
+            self._retrieve("public", (sender_id, label)) for sender_id in self.hub.participant_ids
+        ]
+        return aggregate_messages(messages, mode)
+
+
+    def wait_for_many(
+            self,
+            keys: Iterable[Tuple[str, str]],
+            wait_all: bool = True
+        ) -> Dict[Tuple[str, str], bytes]:
+        """
+        Retrieve several messages of the hub, given as (sender_id, label) (see
+        `Transport.wait_for_many`).
+        """
+        keys = list(keys)
+        channels = [
+            ("public", (sender_id, label)) if sender_id else ("private", (self.client_id, label))
+            for sender_id, label in keys
+        ]
+        start = time.perf_counter()
+        messages, missed = self.hub.wait_many(channels, wait_all)
+        if missed:
+            self.stats.record_miss()
+        received = sum(len(message) for message in messages.values())
+        self.stats.record_request(time.perf_counter() - start, received=received)
+        return {keys[idx]: message for idx, message in messages.items()}
+
+
+    def retrieve_beaver_triplet_shares(
+            self,
+            op_id: str
+        ) -> Tuple[int, int, int]:
+        """
+        Retrieve a triplet of shares generated by the trusted third party.
+        """
+        return tuple(self.retrieve_beaver_triplet_shares_batch([op_id])[0]) # type: ignore
+
+
+    def retrieve_beaver_triplet_shares_batch(
+            self,
+            op_ids: List[str]
+        ) -> List[Tuple[int, int, int]]:
+        """
+        Retrieve the triplets of shares of several operations at once.
+        """
+        return [tuple(triplet) for triplet in self._call_ttp( # type: ignore
+            self.hub.ttp.retrieve_share_batch, self.client_id, op_ids
+        )]
+
+
+    def retrieve_randomness_batch(
+            self,
+            ops: List[Tuple[str, str, int]]
+        ) -> List[Tuple[int, ...]]:
+        """
+        Retrieve the shares of the random masks of several operations, given as
+        (op_id, kind, size), at once.
+        """
+        return [tuple(masks) for masks in self._call_ttp( # type: ignore
+            self.hub.ttp.retrieve_randomness_batch, self.client_id, ops
+        )]
+
+
+    def publish_circuit(
+            self,
+            circuit_hash: str,
+            data: bytes
+        ) -> None:
+        """
+        Publish a compiled circuit on the hub.
+        """
+        circuit_from_bytes(data, circuit_hash)
+        self._send("circuit", (circuit_hash, ""), data)
+
+
+    def retrieve_circuit(
+            self,
+            circuit_hash: str
+        ) -> bytes:
+        """
+        Retrieve a compiled circuit from the hub.
+        """
+        return self._retrieve("circuit", (circuit_hash, ""))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Delay in seconds given by a Retry-After header, either in seconds or as an HTTP date.
+    None if there is no header or if it is invalid.
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def _check_retry_status(res: Reply, method: str, url: str) -> None:
+    """
+    Raise `requests.HTTPError` unless an answer means that a polled message is not ready
+    yet: 404 (not there yet) or 503 (server busy).
+    """
+    if res.status_code not in RETRY_STATUSES:
+        raise requests.HTTPError(f"{res.status_code} error for {method} {url}")
+
+
+def _check_success(res: Reply, method: str, url: str) -> None:
+    """
+    Raise `requests.HTTPError` unless the server accepted a request (2xx), so that a
+    message it refused, e.g. too large (413) or badly encoded (415), is not lost silently.
+    """
+    if not 200 <= res.status_code < 300:
+        raise requests.HTTPError(f"{res.status_code} error for {method} {url}")
+
+
+def unix_socket_key_path(socket_path: str) -> str:
+    """
+    Path of the file in which the server writes the key authenticating the connections to
+    its Unix domain socket, readable by its user only.
+    """
+    return f"{socket_path}.key"
+
+
+def make_transport(
+        kind: str,
+        server_host: str,
+        server_port: int,
+        client_id: str,
+        participant_ids: List[str],
+        session: str = "",
+        **options: Any
+    ) -> Transport:
+    """
+    Create a transport by name: "http" (polling, the default of the parties), "long-poll"
+    or "memory" (through the hub of the session in `default_hubs`, for parties running in
+    the same process). The options are given to the HTTP transports, e.g. `compression`.
+    """
+    if kind == "http":
+        return Communication(server_host, server_port, client_id, **options)
+    if kind == "long-poll":
+        return LongPollCommunication(server_host, server_port, client_id, **options)
+    if kind == "memory":
+        with default_hubs_lock:
+            hub = default_hubs.setdefault((session, tuple(participant_ids)), InMemoryHub())
+        return InMemoryTransport(hub, client_id, participant_ids)
+    raise ValueError(f"Unknown transport {kind}")
+
+
+def aggregate_messages(messages: List[bytes], mode: str = "sum") -> bytes:
+    """
+    Aggregate the messages of all the parties for a label, each one a comma-separated list
+    of share values: "sum" sums them element-wise, "concat" joins them with newlines.
+    """
+    if mode == "sum":
+        columns = zip(*(message.decode().split(",") for message in messages))
+        return ",".join(str(sum(int(value) for value in column)) for column in columns).encode()
+    if mode == "concat":
+        return b"\n".join(messages)
+    raise ValueError(f"Unknown aggregation {mode}")
+
+
+def pack_messages(messages: Dict[int, bytes]) -> bytes:
+    """
+    Pack messages, keyed by their index in a request, in one response: a JSON line of
+    [index, length] pairs, followed by the messages.
+    """
+    header = json.dumps([[idx, len(message)] for idx, message in messages.items()]).encode()
+    return b"\n".join([header, b"".join(messages.values())])
+
+
+def unpack_messages(data: bytes) -> Dict[int, bytes]:
+    """
+    Unpack the messages packed by `pack_messages`.
+    """
+    header, body = data.split(b"\n", 1)
+    messages = {}
+    offset = 0
+    for idx, length in json.loads(header):
+        messages[idx] = body[offset:offset + length]
+        offset += length
+    return messages
+
+
+def peer_authkey(authkey: bytes, client_id: str, peer_id: str) -> bytes:
+    """
+    Derive the key authenticating the connections between two parties from the key of the
+    session. It is the same both ways, and a party cannot compute the key of another pair.
+    """
+    pair = json.dumps(sorted([client_id, peer_id])).encode()
+    return hmac.new(authkey, pair, hashlib.sha256).digest()
+
+
+def pack_peer_message(pool: str, label: str, message: bytes) -> bytes:
+    """
+    Frame a message sent to a peer: a JSON line of its pool and label, followed by the
+    message.
+    """
+    return b"\n".join([json.dumps([pool, label]).encode(), message])
+
+
+def unpack_peer_message(data: bytes) -> Tuple[str, str, bytes]:
+    """
+    Unpack a message framed by `pack_peer_message`, raising ValueError if it is malformed.
+    """
+    header, message = data.split(b"\n", 1) if b"\n" in data else (data, b"")
+    try:
+        pool, label = json.loads(header)
+    except (TypeError, ValueError):
+        raise ValueError("Malformed peer message") from None
+    if pool not in ("private", "public") or not isinstance(label, str):
+        raise ValueError("Malformed peer message")
+    return pool, label, message
+
+
+def available_compressions() -> List[str]:
+    """
+    Compression algorithms available in this environment.
+    """
+    return ["zlib", "lz4"] if lz4_frame is not None else ["zlib"]
+
+
+def compress(data: bytes, compression: str, level: int = 6) -> bytes:
+    """
+    Compress data with "zlib" or "lz4".
+    """
+    if compression == "zlib":
+        return zlib.compress(data, level)
+    if compression == "lz4" and lz4_frame is not None:
+        return lz4_frame.compress(data, compression_level=level)
+    raise ValueError(f"Unavailable compression {compression}")
+
+
+class MessageTooLarge(ValueError):
+    """
+    Raised when decompressed data would exceed its size limit.
+    """
+
+
+def decompress(data: bytes, content_encoding: Optional[str], max_length: Optional[int] = None) -> bytes:
+    """
+    Decompress data given its HTTP content encoding (None or "identity" for raw data).
+    If `max_length` is given, raise `MessageTooLarge` instead of decompressing more than
+    that many bytes, so that a small compressed bomb cannot exhaust the memory.
+    """
+    if content_encoding in (None, "", "identity"):
+        if max_length is not None and len(data) > max_length:
+            raise MessageTooLarge(f"Data larger than {max_length} bytes")
+        return data
+    if content_encoding == CONTENT_ENCODINGS["zlib"]:
+        if max_length is None:
+            return zlib.decompress(data)
+        decompressor = zlib.decompressobj()
+    elif content_encoding == CONTENT_ENCODINGS["lz4"] and lz4_frame is not None:
+        if max_length is None:
+            return lz4_frame.decompress(data)
+        decompressor = lz4_frame.LZ4FrameDecompressor()
+    else:
+        raise ValueError(f"Unsupported content encoding {content_encoding}")
+
+    # One more byte than allowed tells the data which are too large apart.
+    res = decompressor.decompress(data, max_length + 1)
+    if len(res) > max_length:
+        raise MessageTooLarge(f"Decompressed data larger than {max_length} bytes")
+    if not decompressor.eof:
+        raise ValueError("Truncated compressed data")
+    return res
+
+
+def negotiate_compression(accept_encoding: str) -> Optional[str]:
+    """
+    Compression algorithm to use for an answer, given the Accept-Encoding of the request.
+    """
+    accepted = {token.split(";")[0].strip() for token in accept_encoding.split(",")}
+    for compression in reversed(available_compressions()):
+        if CONTENT_ENCODINGS[compression] in accepted:
+            return compression
+    return None
+
+
+def _to_bytes(message: Union[bytes, str]) -> bytes:
+    """
+    Encode a text message to bytes.
+    """
+    if isinstance(message, str):
+        return message.encode("utf-8")
+    return message
@@ -0,0 +1,343 @@
+"""
+Executors speeding up the evaluation of circuits by an SMC party.
+
+`DataflowExecutor`: instead of evaluating the circuit one multiplicative layer at a time,
+every gate fires as soon as its operands are available. The shares of the secrets and the
+Beaver openings are retrieved by a pool of threads while the party keeps evaluating the
+gates that are ready, so that the local computation overlaps with the network.
+
+`ParallelEvaluator`: the independent local gates of wide circuits are evaluated in chunks
+by a pool of workers, so that the local computation scales with the available cores.
+"""
+
+import math
+import queue
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from circuit import Circuit, INPUT, ADD, SUB, SCALE, OPEN_OPS
+from secret_sharing import Share
+
+
+class DataflowExecutor:
+    """
+    Evaluate circuits for an SMC party, firing each gate as soon as its operands are ready.
+
+    Attributes:
+        party: the SMC party evaluating the circuit
+        max_workers: number of threads retrieving messages (default: 8)
+    """
+
+    def __init__(self, party, max_workers: int = 8):
+        self.party = party
+        self.max_workers = max_workers
+
+
+    def evaluate(
+            self,
+            circuit: Circuit,
+            dirty: Optional[List[bool]] = None
+        ) -> Dict[str, Share]:
+        """
+        Compute own's share of the outputs of a circuit, retrieving the shares of its
+        inputs along the way.
+
+        If `dirty` is given, only the dirty wires are recomputed, the others keep their
+        share from the previous evaluation.
+        """
+        party = self.party
+        gates = circuit.gates
+        participants = party.protocol_spec.participant_ids
+        # With the king strategy, the king gets the shares of the other parties and the
+        # others get the opened values from the king. With the aggregate strategy, every
+        # party gets the opened values from the server.
+        king = participants[0] if party.opening == "king" else None
+        if party.opening == "aggregate":
+            expected = 1
+        elif king is None:
+            expected = len(participants)
+        elif king == party.client_id:
+            expected = len(participants) - 1
+        else:
+            expected = 1
+
+        if dirty is None:
+            party.wires = [None] * len(gates)
+        wires = party.wires
+        todo = [dirty is None or dirty[wire] for wire in range(len(gates))]
+
+        # Gates waiting on each wire, and number of operands each gate still waits for.
+        consumers: List[List[int]] = [[] for _ in gates]
+        missing = [0] * len(gates)
+        for wire, gate in enumerate(gates):
+            if not todo[wire]:
+                continue
+            for operand in gate.operands():
+                if todo[operand]:
+                    consumers[operand].append(wire)
+                    missing[wire] += 1
+
+        # The messages are retrieved in topological order, and the workers take them in
+        # that order. So when a worker waits for the opening of a gate, the messages of the
+        # gates it depends on are all retrieved, this party has sent its own masked value
+        # of the gate, and every other party can do the same: even a single worker cannot
+        # deadlock (see `test_dataflow_single_worker`).
+        events: queue.Queue = queue.Queue()
+        pool = RetrievalPool(events, self.max_workers)
+        for wire, gate in enumerate(gates):
+            if not todo[wire]:
+                continue
+            if gate.op == INPUT:
+                label = party.label(gate.key)
+                pool.submit(wire, lambda label=label: party.comm.retrieve_private_message(label))
+            elif gate.op in OPEN_OPS:
+                label = party.label(f"beaver_g{wire}")
+                if party.opening == "aggregate":
+                    pool.submit(
+                        wire,
+                        lambda label=label: party.comm.retrieve_aggregated_message(label)
+                    )
+                elif king is None:
+                    for sid in participants:
+                        pool.submit(
+                            wire,
+                            lambda sid=sid, label=label: party.comm.retrieve_public_message(sid, label)
+                        )
+                elif king == party.client_id:
+                    for sid in participants[1:]:
+                        share_label = party.share_label(label, sid)
+                        pool.submit(
+                            wire,
+                            lambda label=share_label: party.comm.retrieve_private_message(label)
+                        )
+                else:
+                    pool.submit(
+                        wire,
+                        lambda label=label: party.comm.retrieve_public_message(king, label)
+                    )
+
+        remaining = sum(todo)
+        # Masked values opened so far by each gate, and number of messages they came from.
+        opened: Dict[int, List[int]] = {}
+        received: Dict[int, int] = {}
+        fired = [False] * len(gates)
+        ready = [
+            wire for wire, gate in enumerate(gates)
+            if todo[wire] and missing[wire] == 0 and gate.op != INPUT
+        ]
+
+        def complete(wire: int, share: Share) -> None:
+            nonlocal remaining
+            wires[wire] = share
+            remaining -= 1
+            for consumer in consumers[wire]:
+                missing[consumer] -= 1
+                if missing[consumer] == 0:
+                    ready.append(consumer)
+
+        def add_opened(wire: int, values: List[int]) -> None:
+            sums = opened.setdefault(wire, [0] * len(values))
+            for idx, value in enumerate(values):
+                sums[idx] += value
+
+        def try_finish_opening(wire: int) -> None:
+            if fired[wire] and received.get(wire, 0) == expected:
+                if king == party.client_id:
+                    party.publish_message(
+                        party.label(f"beaver_g{wire}"), ",".join(str(value) for value in opened[wire])
+                    )
+                complete(wire, party.finish_open_gate(wire, gates[wire], wires, opened[wire]))
+
+        try:
+            while remaining > 0:
+                while ready:
+                    wire = ready.pop()
+                    gate = gates[wire]
+                    if gate.op in OPEN_OPS:
+                        masked = party.mask_open_gate(wire, gate, wires)
+                        label = party.label(f"beaver_g{wire}")
+                        if king is None:
+                            party.publish_message(label, ",".join(share.value for share in masked))
+                        elif king == party.client_id:
+                            add_opened(wire, [int(share.value) for share in masked])
+                        else:
+                            party.send_private_message(
+                                king, party.share_label(label, party.client_id),
+                                ",".join(share.value for share in masked)
+                            )
+                        fired[wire] = True
+                        try_finish_opening(wire)
+                    else:
+                        complete(wire, party.evaluate_local_gate(gate, wires))
+
+                if remaining == 0:
+                    break
+
+                wire, message = events.get()
+                if isinstance(message, BaseException):
+                    raise message
+                message = message.decode()
+                if gates[wire].op == INPUT:
+                    party.shares_dict[gates[wire].key] = Share(message)
+                    complete(wire, party.shares_dict[gates[wire].key])
+                else:
+                    add_opened(wire, [int(value) for value in message.split(",")])
+                    received[wire] = received.get(wire, 0) + 1
+                    try_finish_opening(wire)
+        finally:
+            pool.stop()
+
+        return {name: wires[wire] for name, wire in circuit.outputs.items()}
+
+
+class RetrievalPool:
+    """
+    Threads retrieving messages in the order they are submitted, each one reported as a
+    (wire, message) event, or (wire, exception) if the retrieval failed.
+
+    The threads are daemons: if the evaluation fails, the retrievals still waiting for a
+    message, which may never come, neither keep the process alive nor are ever reported.
+
+    Attributes:
+        events: queue of the events
+        workers: number of threads
+    """
+
+    def __init__(self, events: queue.Queue, workers: int):
+        self.events = events
+        self.tasks: queue.Queue = queue.Queue()
+        self.stopped = threading.Event()
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+
+    def submit(self, wire: int, retrieve: Callable[[], bytes]) -> None:
+        """
+        Retrieve a message for a wire.
+        """
+        self.tasks.put((wire, retrieve))
+
+
+    def stop(self) -> None:
+        """
+        Stop the threads once their current retrieval is over, dropping the others.
+        """
+        self.stopped.set()
+        self.tasks.put(None)
+
+
+    def _work(self) -> None:
+        """
+        Run the retrievals until the pool is stopped.
+        """
+        while True:
+            task = self.tasks.get()
+            if task is None or self.stopped.is_set():
+                # Wake up the next thread.
+                self.tasks.put(None)
+                return
+            wire, retrieve = task
+            try:
+                message = retrieve()
+            except BaseException as e:
+                message = e
+            if not self.stopped.is_set():
+                self.events.put((wire, message))
+
+
+class ParallelEvaluator:
+    """
+    Evaluate batches of independent operations on shares in a pool of workers.
+
+    Batches smaller than the threshold are evaluated serially, since dispatching them to
+    the workers would cost more than it saves. Python threads do not run arithmetic in
+    parallel, so the "thread" backend only helps if the workers mostly wait; use the
+    default "process" backend to use several cores.
+
+    Attributes:
+        workers: number of workers of the pool
+        backend: "process" or "thread" (default: "process")
+        threshold: minimum size of a batch to use the pool (default: 1024)
+    """
+
+    def __init__(self, workers: int, backend: str = "process", threshold: int = 1024):
+        if backend not in ("process", "thread"):
+            raise ValueError(f"Unknown backend {backend}")
+        self.workers = workers
+        self.backend = backend
+        self.threshold = threshold
+        self.pool: Optional[Executor] = None
+
+
+    def map(self, function: Callable, items: Sequence, *args) -> List:
+        """
+        Apply `function(chunk, *args)` to chunks of the items, and concatenate the results.
+        """
+        if len(items) < self.threshold:
+            return function(items, *args)
+        if self.pool is None:
+            pool_class = ProcessPoolExecutor if self.backend == "process" else ThreadPoolExecutor
+            self.pool = pool_class(max_workers=self.workers)
+
+        size = math.ceil(len(items) / self.workers)
+        futures = [
+            self.pool.submit(function, items[start:start + size], *args)
+            for start in range(0, len(items), size)
+        ]
+        return [res for future in futures for res in future.result()]
+
+
+    def evaluate_gates(self, circuit: Circuit, gates: List[int], wires: List) -> List[int]:
+        """
+        Compute the values of own's shares of independent ADD, SUB and SCALE gates.
+        """
+        operations = []
+        for wire in gates:
+            gate = circuit.gates[wire]
+            b = int(wires[gate.b].value) if gate.b is not None else None
+            operations.append((gate.op, int(wires[gate.a].value), b, gate.value))
+        return self.map(evaluate_operations, operations)
+
+
+    def close(self) -> None:
+        """
+        Stop the workers.
+        """
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def evaluate_operations(operations: Sequence[Tuple[str, int, Optional[int], Optional[int]]]) -> List[int]:
+    """
+    Evaluate (op, a, b, value) operations on share values.
+    """
+    res = []
+    for op, a, b, value in operations:
+        if op == ADD:
+            res.append(a + b)
+        elif op == SUB:
+            res.append(a - b)
+        elif op == SCALE:
+            res.append(a * value)
+        else:
+            raise ValueError(f"Unknown local operation {op}")
+    return res
+
+
+def finish_multiplications(
+        operands: Sequence[Tuple[int, int, int, int, int]],
+        first_party: bool
+    ) -> List[int]:
+    """
+    Compute the shares c_i + a * y + b * x (- x * y for the first party) of Beaver
+    multiplications, given (a, b, c_i, x, y) share values.
+    """
+    res = []
+    for a, b, c_i, x, y in operands:
+        share = c_i + a * y + b * x
+        if first_party:
+            share -= x * y
+        res.append(share)
+    return res
@@ -10,11 +10,15 @@ MODIFY THIS FILE.
 """
 
 import base64
+import hashlib
 import random
-from typing import Optional
+from array import array
+from typing import List, Optional, Tuple
 
 
 ID_BYTES = 4
+# Content-addressed IDs are longer, since they are derived from whole subexpressions.
+CONTENT_ID_BYTES = 12
 
 
 def gen_id() -> bytes:
@@ -24,10 +28,25 @@ def gen_id() -> bytes:
     return base64.b64encode(id_bytes)
 
 
+def content_id(kind: str, *parts: bytes) -> bytes:
+    """
+    Derive a deterministic ID from the kind of a node and the IDs (or value) of its parts,
+    so that the same expression gets the same IDs in every process.
+    """
+    digest = hashlib.sha256(kind.encode())
+    for part in parts:
+        # Length-prefixed, so that different splits of the parts never collide.
+        digest.update(len(part).to_bytes(4, "big") + part)
+    return base64.b64encode(digest.digest()[:CONTENT_ID_BYTES])
+
+
 class Expression:
     """
     Base class for an arithmetic expression.
     """
+    # Nodes have no __dict__, large expressions have millions of them.
+    __slots__ = ("id",)
+
     def __init__(
             self,
             id: Optional[bytes] = None
@@ -46,16 +65,24 @@ class Expression:
     def __mul__(self, other):
         return MultOp(self, other)        
 
+    def __pow__(self, exponent: int):
+        return PowOp(self, Scalar(exponent))
+
 
     def __hash__(self):
         return hash(self.id)
 
 
+    def __eq__(self, other):
+        return isinstance(other, Expression) and self.id == other.id
+
+
     # Feel free to add as many methods as you like.
 
 
 class Scalar(Expression):
     """Term representing a scalar finite field value."""
+    __slots__ = ("value",)
 
     def __init__(
             self,
@@ -63,22 +90,19 @@ class Scalar(Expression):
             id: Optional[bytes] = None
         ):
         self.value = value
-        super().__init__(id)
+        super().__init__(id if id is not None else content_id("Scalar", str(value).encode()))
 
 
     def __repr__(self):
         return f"{self.__class__.__name__}({repr(self.value)})"
 
 
-    def __hash__(self):
-        return
-
-
     # Feel free to add as many methods as you like.
 
 
 class Secret(Expression):
     """Term representing a secret finite field value (variable)."""
+    __slots__ = ("value",)
     def __init__(
             self,
             value: Optional[int] = None,
@@ -97,8 +121,10 @@ class Secret(Expression):
     # Feel free to add as many methods as you like.
 
 class AddOp(Expression):
+    __slots__ = ("a", "b")
+
     def __init__(self, a: Expression, b: Expression):
-        super().__init__()
+        super().__init__(content_id("AddOp", a.id, b.id))
         self.a = a
         self.b = b
 
@@ -108,8 +134,10 @@ class AddOp(Expression):
         )
 
 class SubOp(Expression):
+    __slots__ = ("a", "b")
+
     def __init__(self, a: Expression, b: Expression):
-        super().__init__()
+        super().__init__(content_id("SubOp", a.id, b.id))
         self.a = a
         self.b = b
 
@@ -120,12 +148,230 @@ class SubOp(Expression):
 
 
 class MultOp(Expression):
+    __slots__ = ("a", "b")
+
     def __init__(self, a: Expression, b: Expression):
-        super().__init__()
+        super().__init__(content_id("MultOp", a.id, b.id))
         self.a = a
         self.b = b
 
     def __repr__(self): 
         return (
             f"{repr(self.a)} * {repr(self.b)}"
-        )    
\ No newline at end of file
+        )    
+
+
+class TruncOp(Expression):
+    """
+    Truncation of `a` by `b` bits, i.e. a / 2^b rounded down or up. `b` must be a Scalar.
+
+    It is computed in one round, with a mask of preprocessed random bits.
+    """
+    __slots__ = ("a", "b")
+
+    def __init__(self, a: Expression, b: Expression):
+        if not isinstance(b, Scalar):
+            raise TypeError("Truncations need a public number of bits")
+        super().__init__(content_id("TruncOp", a.id, b.id))
+        self.a = a
+        self.b = b
+
+    def __repr__(self):
+        return (
+            f"({repr(self.a)} >> {repr(self.b)})"
+        )
+
+
+class LessThanOp(Expression):
+    """
+    Comparison of `a` and `b`: 1 if a < b, 0 otherwise.
+
+    It is computed in two rounds, with preprocessed random masks.
+    """
+    __slots__ = ("a", "b")
+
+    def __init__(self, a: Expression, b: Expression):
+        super().__init__(content_id("LessThanOp", a.id, b.id))
+        self.a = a
+        self.b = b
+
+    def __repr__(self):
+        return (
+            f"({repr(self.a)} < {repr(self.b)})"
+        )
+
+
+class PowOp(Expression):
+    """
+    Power of `a` to the exponent `b`, which must be a non-negative Scalar.
+
+    It is computed by square-and-multiply, in a number of rounds logarithmic in `b`.
+    """
+    __slots__ = ("a", "b")
+
+    def __init__(self, a: Expression, b: Expression):
+        if not isinstance(b, Scalar) or b.value < 0:
+            raise TypeError("Powers need a public non-negative exponent")
+        super().__init__(content_id("PowOp", a.id, b.id))
+        self.a = a
+        self.b = b
+
+    def __repr__(self):
+        return (
+            f"{repr(self.a)} ** {repr(self.b)}"
+        )
+
+
+# Operations with two operands `a` and `b`.
+OPERATIONS = (AddOp, SubOp, MultOp, TruncOp, LessThanOp, PowOp)
+
+
+def balance(expr: Expression) -> Expression:
+    """
+    Reshape the associative chains of additions and multiplications of an expression into
+    balanced trees, so that their depth is logarithmic in their length instead of linear.
+
+    Scalars of a chain are folded together and applied at the top of the balanced tree.
+    Subexpressions used several times are kept shared and are not flattened into their
+    parents. The expression given as argument is left untouched.
+    """
+    # Iterative post-order traversal, long chains would exceed the recursion limit.
+    order = []
+    parents = {}
+    stack = [(expr, False)]
+    while stack:
+        node, visited = stack.pop()
+        if visited:
+            order.append(node)
+            continue
+        parents[id(node)] = parents.get(id(node), 0) + 1
+        if parents[id(node)] > 1:
+            continue
+        stack.append((node, True))
+        if isinstance(node, OPERATIONS):
+            stack.append((node.b, False))
+            stack.append((node.a, False))
+
+    # Terms of the chains still being flattened, and balanced results of the other nodes.
+    terms = {}
+    results = {}
+
+    def resolve(node):
+        if id(node) not in results:
+            results[id(node)] = _balanced_chain(type(node), terms.pop(id(node)))
+        return results[id(node)]
+
+    for node in order:
+        if isinstance(node, (AddOp, MultOp)):
+            chains = []
+            for child in (node.a, node.b):
+                if type(child) is type(node) and parents[id(child)] == 1:
+                    chains.append(terms.pop(id(child)))
+                else:
+                    chains.append([resolve(child)])
+            # Both operations are commutative, so extend the longest list to keep it linear.
+            chains.sort(key=len, reverse=True)
+            chains[0].extend(chains[1])
+            terms[id(node)] = chains[0]
+        elif isinstance(node, OPERATIONS):
+            a = resolve(node.a)
+            b = resolve(node.b)
+            results[id(node)] = node if a is node.a and b is node.b else type(node)(a, b)
+        else:
+            results[id(node)] = node
+
+    return resolve(expr)
+
+
+def _balanced_chain(op: type, terms: list) -> Expression:
+    """
+    Build a balanced tree of `op` (AddOp or MultOp) over the given terms.
+    """
+    scalars = [term for term in terms if isinstance(term, Scalar)]
+    level = [term for term in terms if not isinstance(term, Scalar)]
+
+    scalar = None
+    if len(scalars) == 1:
+        scalar = scalars[0]
+    elif scalars:
+        value = scalars[0].value
+        for term in scalars[1:]:
+            value = value + term.value if op is AddOp else value * term.value
+        scalar = Scalar(value)
+
+    if not level:
+        return scalar
+
+    while len(level) > 1:
+        paired = [op(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2 == 1:
+            paired.append(level[-1])
+        level = paired
+
+    return level[0] if scalar is None else op(level[0], scalar)
+
+
+# Kinds of nodes in packed expressions.
+_PACKED_KINDS = ("Secret", "Scalar") + tuple(op.__name__ for op in OPERATIONS)
+
+
+def pack(exprs: List[Expression]) -> Tuple:
+    """
+    Pack expressions into flat arrays, to ship them compactly and without recursion.
+
+    Shared subexpressions are packed once. Only the IDs of the leaves are kept, the IDs of
+    the operations are derived again from their content by `unpack`.
+    Returns the node kinds, the operands of each node, the leaves and the root nodes.
+    """
+    kinds = array("B")
+    operands = array("i")
+    leaves: List[Tuple[bytes, Optional[int]]] = []
+    leaf_index = {}
+    index = {}
+    for expr in exprs:
+        # Iterative post-order traversal, long chains would exceed the recursion limit.
+        stack = [(expr, False)]
+        while stack:
+            node, visited = stack.pop()
+            if id(node) in index:
+                continue
+            if isinstance(node, (Secret, Scalar)):
+                # Leaves with the same ID (e.g. equal scalars) are stored once.
+                if node.id not in leaf_index:
+                    leaf_index[node.id] = len(leaves)
+                    leaves.append((node.id, node.value))
+                operands.extend((leaf_index[node.id], -1))
+            elif not visited:
+                stack.append((node, True))
+                stack.append((node.b, False))
+                stack.append((node.a, False))
+                continue
+            else:
+                operands.extend((index[id(node.a)], index[id(node.b)]))
+            kinds.append(_PACKED_KINDS.index(type(node).__name__))
+            index[id(node)] = len(index)
+
+    return (kinds.tobytes(), operands.tobytes(), leaves, [index[id(expr)] for expr in exprs])
+
+
+def unpack(packed: Tuple) -> List[Expression]:
+    """
+    Rebuild the expressions packed by `pack`.
+    """
+    kinds_bytes, operands_bytes, leaves, roots = packed
+    operands = array("i")
+    operands.frombytes(operands_bytes)
+
+    nodes: List[Expression] = []
+    for idx, kind in enumerate(kinds_bytes):
+        a, b = operands[2 * idx], operands[2 * idx + 1]
+        if kind == 0:
+            leaf_id, value = leaves[a]
+            nodes.append(Secret(value, leaf_id))
+        elif kind == 1:
+            leaf_id, value = leaves[a]
+            nodes.append(Scalar(value, leaf_id))
+        else:
+            op = OPERATIONS[kind - 2]
+            nodes.append(op(nodes[a], nodes[b]))
+    return [nodes[root] for root in roots]
@@ -0,0 +1,87 @@
+"""
+Fixed-point arithmetic and comparisons over secret expressions.
+
+A real number x is encoded as the integer round(x * 2^f), where f is the number of
+fractional bits. Sums of encoded numbers are encoded sums, but products carry 2f
+fractional bits, so they are truncated back to f bits (in one round, see `TruncOp`).
+
+Example:
+>>> price = Secret()
+>>> quantity = Secret()
+>>> cost = mul(price, quantity)  # price and quantity are given as encode(...)
+>>> expensive = less_than(fixed(100.0), cost)
+"""
+
+from expression import Expression, LessThanOp, Scalar, TruncOp
+
+
+# Default number of fractional bits.
+FRACTIONAL_BITS = 16
+
+
+def encode(value: float, precision: int = FRACTIONAL_BITS) -> int:
+    """
+    Encode a real number as a fixed-point integer.
+    """
+    return round(value * (1 << precision))
+
+
+def decode(value: int, precision: int = FRACTIONAL_BITS) -> float:
+    """
+    Decode a fixed-point integer into a real number.
+    """
+    return value / (1 << precision)
+
+
+def fixed(value: float, precision: int = FRACTIONAL_BITS) -> Scalar:
+    """
+    Public fixed-point constant.
+    """
+    return Scalar(encode(value, precision))
+
+
+def truncate(expr: Expression, bits: int) -> Expression:
+    """
+    Divide an expression by 2^bits. The result may be one more than the exact floor.
+    """
+    return TruncOp(expr, Scalar(bits))
+
+
+def mul(a: Expression, b: Expression, precision: int = FRACTIONAL_BITS) -> Expression:
+    """
+    Product of two fixed-point expressions.
+    """
+    return truncate(a * b, precision)
+
+
+def less_than(a: Expression, b: Expression) -> Expression:
+    """
+    1 if a < b, 0 otherwise. Works on integers and on fixed-point numbers alike, as long as
+    a and b differ by less than 2^COMPARISON_BITS (see `circuit.COMPARISON_BITS`).
+
+    b - a is masked with a random mask whose bits are shared, and the masked value is
+    compared with the mask bit by bit. Every opened value is masked with statistically
+    hiding masks, so neither the result nor the magnitude of a - b leaks.
+    """
+    return LessThanOp(a, b)
+
+
+def greater_than(a: Expression, b: Expression) -> Expression:
+    """
+    1 if a > b, 0 otherwise.
+    """
+    return LessThanOp(b, a)
+
+
+def maximum(a: Expression, b: Expression) -> Expression:
+    """
+    Maximum of two expressions.
+    """
+    return b + LessThanOp(b, a) * (a - b)
+
+
+def minimum(a: Expression, b: Expression) -> Expression:
+    """
+    Minimum of two expressions.
+    """
+    return a + LessThanOp(b, a) * (b - a)
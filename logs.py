@@ -0,0 +1,102 @@
+"""
+Logging of the SMC parties and the server.
+
+Every module logs under the "smc" logger (e.g. "smc.server"). Logging is off by default:
+only warnings go through, and the records of the hot paths (one per request or message)
+are debug records with lazy arguments, so nothing is formatted unless they are enabled.
+
+The verbose mode is enabled with `enable_verbose_logging`, or through the environment of
+the processes:
+- SMC_LOG: level of the "smc" loggers, e.g. "debug" or "info";
+- SMC_LOG_SAMPLE: log only one record out of this many for each message (default: 1).
+"""
+
+import itertools
+import logging
+import os
+import threading
+from typing import Dict, Iterator, Optional, TextIO
+
+
+ROOT_LOGGER = "smc"
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Logger of a module, under the "smc" logger.
+    """
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Let one record out of every `every` through, counting each message (format string)
+    separately, so that rare messages are not drowned by frequent ones.
+
+    Attributes:
+        every: sampling period (1 lets every record through)
+    """
+
+    def __init__(self, every: int = 1):
+        super().__init__()
+        if every < 1:
+            raise ValueError("The sampling period must be positive")
+        self.every = every
+        self.counters: Dict[str, Iterator[int]] = {}
+        self.lock = threading.Lock()
+
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.every == 1 or record.levelno >= logging.WARNING:
+            return True
+        with self.lock:
+            counter = self.counters.setdefault(str(record.msg), itertools.count())
+            return next(counter) % self.every == 0
+
+
+def enable_verbose_logging(
+        level: int = logging.DEBUG,
+        sample_every: int = 1,
+        stream: Optional[TextIO] = None
+    ) -> logging.Handler:
+    """
+    Log the records of the "smc" loggers from the given level on, sampled, to a stream
+    (default: stderr). Returns the handler, to remove it with `disable_verbose_logging`.
+    """
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s"))
+    handler.addFilter(SamplingFilter(sample_every))
+    logger = logging.getLogger(ROOT_LOGGER)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    # The records go to the handler above only.
+    logger.propagate = False
+    return handler
+
+
+def disable_verbose_logging(handler: logging.Handler) -> None:
+    """
+    Go back to logging warnings only.
+    """
+    logger = logging.getLogger(ROOT_LOGGER)
+    logger.removeHandler(handler)
+    logger.setLevel(logging.WARNING)
+    logger.propagate = True
+
+
+def configure_from_environment() -> Optional[logging.Handler]:
+    """
+    Enable the verbose mode if SMC_LOG is set (see the module documentation).
+    """
+    level = os.environ.get("SMC_LOG")
+    if not level:
+        return None
+    return enable_verbose_logging(
+        getattr(logging, level.upper()),
+        int(os.environ.get("SMC_LOG_SAMPLE", "1"))
+    )
+
+
+# Off by default, even if the application logs debug records of other libraries.
+logging.getLogger(ROOT_LOGGER).setLevel(logging.WARNING)
+configure_from_environment()
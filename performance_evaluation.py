@@ -5,12 +5,14 @@ ALL EXISTING TESTS IN THIS SUITE SHOULD PASS WITHOUT ANY MODIFICATION TO THEM.
 """
 
 import statistics
+import threading
 import time
 from statistics import mean
 from multiprocessing import Process, Queue
 import pandas as pd
 import pytest
 
+import communication
 from expression import Expression, Scalar, Secret
 from protocol import ProtocolSpec
 from server import run
@@ -68,12 +70,17 @@ class PerformanceEvaluator:
     self.bytes_in = []
     self.bytes_out = []
     self.title = title
+    # Counters of the transports (see `TransportStats`), kept apart from the plotted columns.
+    self.transport_df = pd.DataFrame(columns=["Requests", "Poll Misses", "Poll Wait (in seconds)", "Median Latency (in seconds)", "Compression Ratio"])
+    self.transport_stats = []
 
   # Adds the given evaluation results to the list of parties' results 
-  def performance_eval_callback(self, client_id, computation_time, bytes_in, bytes_out):
+  def performance_eval_callback(self, client_id, computation_time, bytes_in, bytes_out, transport_stats=None):
     self.computation_times.append(computation_time)
     self.bytes_in.append(bytes_in)
     self.bytes_out.append(bytes_out)
+    if transport_stats is not None:
+      self.transport_stats.append(transport_stats)
 
   # Reset the evaluation for one parameter
   def complete_results(self, id):
@@ -84,26 +91,52 @@ class PerformanceEvaluator:
     }, name=str(id)))
 
     self.df.to_csv(f"perf_eval/{self.title}.csv")
-    
+
+    if self.transport_stats:
+      self.transport_df = self.transport_df.append(pd.Series({
+        "Requests": mean(stats["requests"] for stats in self.transport_stats),
+        "Poll Misses": mean(stats["poll_misses"] for stats in self.transport_stats),
+        "Poll Wait (in seconds)": mean(stats["poll_wait"] for stats in self.transport_stats),
+        "Median Latency (in seconds)": median_latency(self.transport_stats),
+        "Compression Ratio": mean(stats["compression_ratio"] for stats in self.transport_stats)
+      }, name=str(id)))
+      self.transport_df.to_csv(f"perf_eval/{self.title} (transport).csv")
+
     self.computation_times = []
     self.bytes_in = []
     self.bytes_out = []
+    self.transport_stats = []
 
   def plot_results(self):
     make_plot(self.title, f"perf_eval/{self.title}.csv")
 
 
-def smc_client(client_id, prot, value_dict, queue):
+# Upper bound of the latency bucket holding the median request of all the parties.
+def median_latency(transport_stats):
+    histogram = {}
+    for stats in transport_stats:
+      for bound, count in stats["latencies"].items():
+        histogram[bound] = histogram.get(bound, 0) + count
+    seen = 0
+    for bound in sorted(histogram):
+      seen += histogram[bound]
+      if 2 * seen >= sum(histogram.values()):
+        return bound
+    return 0
+
+
+def smc_client(client_id, prot, value_dict, party_kwargs, queue):
     cli = SMCParty(
         client_id,
         "localhost",
         5000,
         protocol_spec=prot,
         value_dict=value_dict,
-        performance_evaluation=True
+        performance_evaluation=True,
+        **party_kwargs
     )
     res = cli.run()
-    queue.put(res)
+    queue.put((*res, cli.comm.stats.as_dict()))
     print(f"{client_id} has finished!")
 
 
@@ -111,15 +144,25 @@ def smc_server(args):
     run("localhost", 5000, args)
 
 
-def run_processes(server_args, performance_evaluator, *client_args):
+def run_processes(server_args, performance_evaluator, party_kwargs, *client_args):
     queue = Queue()
 
+    # The in-memory transport needs no server, and its parties run as threads of this process.
+    in_memory = party_kwargs.get("transport") == "memory"
+    if in_memory:
+        # The runs of the evaluation share their session, each one needs a fresh hub.
+        communication.default_hubs.clear()
+        server = None
+        clients = [
+            threading.Thread(target=smc_client, args=(*args, party_kwargs, queue))
+            for args in client_args
+        ]
+    else:
+        server = Process(target=smc_server, args=(server_args,))
+        clients = [Process(target=smc_client, args=(*args, party_kwargs, queue)) for args in client_args]
+        server.start()
+        time.sleep(3)
 
-    server = Process(target=smc_server, args=(server_args,))
-    clients = [Process(target=smc_client, args=(*args, queue)) for args in client_args]
-
-    server.start()
-    time.sleep(3)
     for client in clients:
         client.start()
 
@@ -129,27 +172,37 @@ def run_processes(server_args, performance_evaluator, *client_args):
         
     for client in clients:
         res = queue.get()
-        performance_evaluator.performance_eval_callback("", res[1], res[2], res[3])
+        performance_evaluator.performance_eval_callback("", res[1], res[2], res[3], res[4])
         results.append(res[0])
 
-    server.terminate()
-    server.join()
+    if server is not None:
+        server.terminate()
+        server.join()
 
-    # To "ensure" the workers are dead.
-    time.sleep(2)
+        # To "ensure" the workers are dead.
+        time.sleep(2)
 
-    print("Server stopped.")
+        print("Server stopped.")
 
     return results
 
 
-def suite(parties, expr, expected, performance_evaluator):
+# Options of the parties, e.g. {"opening": "king"} to compare the opening strategies, or
+# {"transport": "long-poll"} to compare the transports ("http", "long-poll" or "memory"), or
+# {"transport_options": {"compression": "zlib"}} to trade CPU for bytes.
+PARTY_KWARGS = {}
+
+
+def suite(parties, expr, expected, performance_evaluator, party_kwargs=None):
     participants = list(parties.keys())
 
     prot = ProtocolSpec(expr=expr, participant_ids=participants)
     clients = [(name, prot, value_dict) for name, value_dict in parties.items()]
 
-    results = run_processes(participants, performance_evaluator, *clients)
+    results = run_processes(
+        participants, performance_evaluator,
+        PARTY_KWARGS if party_kwargs is None else party_kwargs, *clients
+    )
 
     print(results)
 
@@ -251,9 +304,9 @@ def test_number_scalar_multiplications(perf):
     perf.plot_results()
 
 
-def test_number_parties(perf):
+def test_number_parties(perf, opening="broadcast"):
   """
-  f(x1, x2, ..., xn) = x1 + x2 + ... + xn
+  f(x1, x2, ..., xn) = x1 + x2 + ... + xn, opened with the given strategy
   """
 
   num_ops = 1000
@@ -279,12 +332,39 @@ def test_number_parties(perf):
       parties[idx][secrets[secret_count]] = 5
       secret_count += 1
 
-    suite(parties, expr, 0, perf)
+    suite(parties, expr, 0, perf, {**PARTY_KWARGS, "opening": opening})
     perf.complete_results(num_party)
 
   perf.plot_results()
 
-    
+
+def test_transports(perf, transports=("http", "long-poll", "memory")):
+  """
+  f(a, b, c) = (a * b + c) * ... * (a * b + c), over each transport
+  """
+
+  num_muls = 20
+
+  for transport in transports:
+    print("----- Performance evaluation for transport " + transport)
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+    parties = {
+      "Alice": {alice_secret: 3},
+      "Bob": {bob_secret: 14},
+      "Charlie": {charlie_secret: 2}
+    }
+
+    expr = alice_secret * bob_secret + charlie_secret
+    for _ in range(num_muls):
+      expr = expr * (alice_secret * bob_secret + charlie_secret)
+
+    suite(parties, expr, 0, perf, {**PARTY_KWARGS, "transport": transport})
+    perf.complete_results(transport)
+
+  perf.plot_results()
+
 
 
 
@@ -293,6 +373,8 @@ def test_number_parties(perf):
 # test_number_multiplications(PerformanceEvaluator("Number of multiplications"))
 # test_number_scalar_multiplications(PerformanceEvaluator("Number of scalar multiplications"))
 # test_number_parties(PerformanceEvaluator("Number of parties"))
+# test_number_parties(PerformanceEvaluator("Number of parties (king opening)"), opening="king")
+# test_transports(PerformanceEvaluator("Transports"))
 make_plot("Number of parties", "perf_eval/Number of parties.csv")
 make_plot("Number of additions", "perf_eval/Number of additions.csv")
 make_plot("Number of scalar additions", "perf_eval/Number of scalar additions.csv")
@@ -1,4 +1,10 @@
-from expression import Expression
+from typing import Dict, Optional
+
+from expression import Expression, balance as balance_expression, pack, unpack
+
+
+# Name of the output of a protocol computing a single expression.
+DEFAULT_OUTPUT = "result"
 
 
 class ProtocolSpec:
@@ -6,9 +12,75 @@ class ProtocolSpec:
 
     Attributes:
         participant_ids: List of IDs of the participating clients
-        expr: Expression to be computed
+        expr: Expression to be computed, if the protocol has a single output
+        balance: If True (default), the chains of additions and multiplications of the
+            expressions are rebalanced so that they are computed in a logarithmic number of
+            rounds. This must happen once, before the specification is given to the parties.
+        outputs: Named expressions to be computed together, instead of `expr`. They are
+            evaluated over a single circuit and opened in a single round.
+        session: Identifier of this run of the protocol, to keep apart the messages and
+            Beaver triplets of runs that share a server. The IDs of the operations only
+            depend on the expressions, so runs of the same expressions over the same
+            secrets on a long-lived server must use distinct sessions.
+        circuit_hash: Hash of a compiled circuit (see `circuit.write_circuit`) to be
+            evaluated, instead of `expr` or `outputs`. The parties load it from
+            `circuit_path` if given, otherwise from the server, and check its hash.
+        circuit_path: Path of the binary file of the circuit, if `circuit_hash` is given.
     """
 
-    def __init__(self, participant_ids: list, expr: Expression):
+    def __init__(
+            self,
+            participant_ids: list,
+            expr: Optional[Expression] = None,
+            balance: bool = True,
+            outputs: Optional[Dict[str, Expression]] = None,
+            session: str = "",
+            circuit_hash: Optional[str] = None,
+            circuit_path: Optional[str] = None
+        ):
+        if [expr, outputs, circuit_hash].count(None) != 2:
+            raise ValueError("Exactly one of expr, outputs and circuit_hash must be given")
+        if circuit_path is not None and circuit_hash is None:
+            raise ValueError("The hash of the circuit must be given with its path")
+
         self.participant_ids = participant_ids
-        self.expr = expr
+        self.session = session
+        self.circuit_hash = circuit_hash
+        self.circuit_path = circuit_path
+        if circuit_hash is not None:
+            self.expr = None
+            self.outputs = None
+        elif expr is not None:
+            self.expr = balance_expression(expr) if balance else expr
+            self.outputs = {DEFAULT_OUTPUT: self.expr}
+        else:
+            self.expr = None
+            self.outputs = {
+                name: balance_expression(output) if balance else output
+                for name, output in outputs.items()
+            }
+
+
+    def __getstate__(self):
+        # The expressions are packed into flat arrays, which are smaller to pickle, and
+        # do not hit the recursion limit on deep expressions.
+        return {
+            "participant_ids": self.participant_ids,
+            "session": self.session,
+            "circuit_hash": self.circuit_hash,
+            "circuit_path": self.circuit_path,
+            "single": self.expr is not None,
+            "names": list(self.outputs.keys()) if self.outputs is not None else None,
+            "outputs": pack(list(self.outputs.values())) if self.outputs is not None else None,
+        }
+
+    def __setstate__(self, state):
+        self.participant_ids = state["participant_ids"]
+        self.session = state["session"]
+        self.circuit_hash = state["circuit_hash"]
+        self.circuit_path = state["circuit_path"]
+        if state["outputs"] is None:
+            self.outputs = None
+        else:
+            self.outputs = dict(zip(state["names"], unpack(state["outputs"])))
+        self.expr = self.outputs[DEFAULT_OUTPUT] if state["single"] else None
@@ -4,19 +4,75 @@ You should not need to change this file.
 """
 
 import collections
+import json
+import logging
+import os
 import sys
+import threading
+import zlib
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
 from os import environ
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
-from flask import Flask, request, Response, jsonify
+from flask import Flask, abort, request, Response, jsonify
 
-from ttp import TrustedParamGenerator
+from circuit import circuit_from_bytes
+from communication import (
+    CONTENT_ENCODINGS,
+    MessageTooLarge,
+    aggregate_messages,
+    compress,
+    decompress,
+    negotiate_compression,
+    pack_messages,
+    unix_socket_key_path,
+)
+from logs import get_logger
+from ttp import TripleFactory, TrustedParamGenerator
 
 
 environ["WERKZEUG_RUN_MAIN"] = "true"
+logger: logging.Logger = get_logger("server")
 app: Flask = Flask("Trusted Third Party Server")
 store: Dict[str, Dict[Tuple[str, str], bytes]] = collections.defaultdict(dict)
 ttp: TrustedParamGenerator = TrustedParamGenerator()
+# Participants, in the order their messages are aggregated.
+participant_ids: List[str] = []
+# Notified on every store update, so that local transports can block instead of polling.
+store_updated: threading.Condition = threading.Condition()
+# The TTP is shared between the Flask threads and the Unix socket handlers.
+ttp_lock: threading.Lock = threading.Lock()
+# Longest time a long-polling retrieval is held, in seconds.
+MAX_WAIT = 30.0
+# Answers of at least "threshold" bytes are compressed with "level" for the clients
+# accepting it, and requests are refused beyond "max_length" bytes once decompressed
+# (see `run`).
+compression_options: Dict[str, int] = {"threshold": 1024, "level": 6, "max_length": 64 << 20}
+# Methods the clients of the Unix domain socket may call (see `_handle_unix_request`).
+UNIX_METHODS = frozenset([
+    "send_private", "retrieve_private", "publish", "retrieve_public", "retrieve_aggregate",
+    "wait_many", "publish_circuit", "retrieve_circuit", "shares", "shares_batch",
+    "randomness_batch",
+])
+
+
+@app.after_request
+def compress_response(response: Response) -> Response:
+    """
+    Compress large answers with the best algorithm accepted by the client, if any.
+    """
+    if response.status_code != 200 or response.direct_passthrough or "Content-Encoding" in response.headers:
+        return response
+    compression = negotiate_compression(request.headers.get("Accept-Encoding", ""))
+    if compression is None:
+        return response
+    data = response.get_data()
+    if len(data) < compression_options["threshold"]:
+        return response
+    response.set_data(compress(data, compression, compression_options["level"]))
+    response.headers["Content-Encoding"] = CONTENT_ENCODINGS[compression]
+    return response
 
 
 @app.route("/private/<sender_id>/<receiver_id>/<label>", methods=["POST"])
@@ -24,10 +80,8 @@ def send_private_message(sender_id: str, receiver_id: str, label: str):
     """
     The client send a private message to the server.
     """
-    print(
-        f"[ SEND     ] SENDER {sender_id} / LABEL {label} / RECEIVER {receiver_id}"
-    )
-    _set_value("private", (receiver_id, label), request.get_data())
+    logger.debug("[ SEND     ] SENDER %s / LABEL %s / RECEIVER %s", sender_id, label, receiver_id)
+    _set_value("private", (receiver_id, label), _request_data())
     return Response(status=200)
 
 
@@ -36,12 +90,12 @@ def retrieve_private_message(receiver_id: str, label: str):
     """
     The client retrieve a private message from the server.
     """
-    res = _get_value("private", (receiver_id, label))
+    res = _wait_value("private", (receiver_id, label), _request_wait())
     if res is not None:
-        print(f"[ RETRIEVE ] RECEIVER {receiver_id} / LABEL {label}")
+        logger.debug("[ RETRIEVE ] RECEIVER %s / LABEL %s", receiver_id, label)
         return res, 200
 
-    return Response(status=404)
+    return _not_ready(1)
 
 
 @app.route("/public/<sender_id>/<label>", methods=["POST"])
@@ -49,8 +103,8 @@ def publish_message(sender_id: str, label: str):
     """
     The client publish a public message on the server.
     """
-    print(f"[ PUBLISH  ] SENDER {sender_id} / LABEL {label}")
-    _set_value("public", (sender_id, label), request.get_data())
+    logger.debug("[ PUBLISH  ] SENDER %s / LABEL %s", sender_id, label)
+    _set_value("public", (sender_id, label), _request_data())
     return Response(status=200)
 
 
@@ -59,13 +113,52 @@ def retrieve_public_message(receiver_id: str, sender_id: str, label: str):
     """
     The client retrieve a public message from the server.
     """
-    res = _get_value("public", (sender_id, label))
+    res = _wait_value("public", (sender_id, label), _request_wait())
     if res is not None:
-        print(
-            f"[ RETRIEVE ] RECEIVER {receiver_id}. LABEL {label} / SENDER {sender_id}"
-        )
+        logger.debug("[ RETRIEVE ] RECEIVER %s. LABEL %s / SENDER %s", receiver_id, label, sender_id)
+        return res, 200
+    return _not_ready(1)
+
+
+@app.route("/aggregate/<receiver_id>/<label>", methods=["GET"])
+def retrieve_aggregated_message(receiver_id: str, label: str):
+    """
+    The client retrieve the public messages of all the participants for a label in one
+    response, summed ("mode=sum", default) or concatenated ("mode=concat"), once they are
+    all published.
+    """
+    mode = request.args.get("mode", "sum")
+    if mode not in ("sum", "concat"):
+        return Response(status=400)
+    res = _wait_aggregate(label, mode, _request_wait())
+    if res is not None:
+        logger.debug("[ RETRIEVE ] RECEIVER %s. LABEL %s / AGGREGATE %s", receiver_id, label, mode)
         return res, 200
-    return Response(status=404)
+    missing = sum(
+        _get_value("public", (sender_id, label)) is None for sender_id in participant_ids
+    )
+    return _not_ready(missing)
+
+
+@app.route("/many/<receiver_id>", methods=["POST"])
+def retrieve_many_messages(receiver_id: str):
+    """
+    The client retrieve several messages, given as a JSON list of [sender ID, label] (an
+    empty sender for its private messages), in one response (see `pack_messages`): all of
+    them ("all=1", default), or the ones ready as soon as there are some ("all=0").
+    """
+    keys = _request_json_list()
+    if not all(
+        isinstance(key, list) and len(key) == 2 and all(isinstance(value, str) for value in key)
+        for key in keys
+    ):
+        return Response(status=400)
+    wait_all = request.args.get("all", "1") != "0"
+    messages = _wait_many(receiver_id, keys, wait_all, _request_wait())
+    if len(messages) == len(keys) or (messages and not wait_all):
+        logger.debug("[ RETRIEVE ] RECEIVER %s / %d MESSAGES", receiver_id, len(messages))
+        return pack_messages(messages), 200
+    return _not_ready(len(keys) - len(messages))
 
 
 @app.route("/shares/<client_id>/<op_id>", methods=["GET"])
@@ -73,15 +166,140 @@ def retrieve_share(client_id: str, op_id: str):
     """
     The client retrieve Beaver triplets generated by the server.
     """
-    shares = ttp.retrieve_share(client_id, op_id)
-    return jsonify([share.value for share in shares]), 200
+    return jsonify(_retrieve_share_values(client_id, op_id)), 200
+
+
+@app.route("/shares/<client_id>", methods=["POST"])
+def retrieve_shares(client_id: str):
+    """
+    The client retrieve the Beaver triplets of several operations, given as a JSON list of
+    operation IDs, in a single request.
+    """
+    op_ids = _request_json_list()
+    try:
+        return jsonify(_retrieve_share_values_batch(client_id, op_ids)), 200
+    except (ValueError, TypeError, KeyError):
+        return Response(status=400)
+
+
+@app.route("/circuits/<circuit_hash>", methods=["POST"])
+def publish_circuit(circuit_hash: str):
+    """
+    The client publish a compiled circuit on the server, for the parties to load it.
+    """
+    data = _request_data()
+    try:
+        circuit_from_bytes(data, circuit_hash)
+    except ValueError:
+        return Response(status=400)
+    _set_value("circuit", (circuit_hash, ""), data)
+    return Response(status=200)
+
+
+@app.route("/circuits/<circuit_hash>", methods=["GET"])
+def retrieve_circuit(circuit_hash: str):
+    """
+    The client retrieve a compiled circuit from the server.
+    """
+    res = _wait_value("circuit", (circuit_hash, ""), _request_wait())
+    if res is not None:
+        return res, 200
+    return _not_ready(1)
+
+
+@app.route("/randomness/<client_id>", methods=["POST"])
+def retrieve_randomness(client_id: str):
+    """
+    The client retrieve the random masks of several operations, given as a JSON list of
+    [operation ID, kind, size], in a single request.
+    """
+    ops = _request_json_list()
+    try:
+        return jsonify(_retrieve_randomness_values(client_id, ops)), 200
+    except (ValueError, TypeError, KeyError):
+        return Response(status=400)
+
+
+def _retrieve_randomness_values(client_id: str, ops: List) -> List[List[str]]:
+    """
+    Retrieve the values of the random mask shares of a client.
+    """
+    with ttp_lock:
+        masks = ttp.retrieve_randomness_batch(client_id, [tuple(op) for op in ops])
+    return [[share.value for share in shares] for shares in masks]
+
+
+def _retrieve_share_values(client_id: str, op_id: str) -> List[str]:
+    """
+    Retrieve the values of the Beaver triplet shares of a client.
+    """
+    return _retrieve_share_values_batch(client_id, [op_id])[0]
+
+
+def _retrieve_share_values_batch(client_id: str, op_ids: List[str]) -> List[List[str]]:
+    """
+    Retrieve the values of the Beaver triplet shares of a client for several operations.
+    """
+    with ttp_lock:
+        triplets = ttp.retrieve_share_batch(client_id, op_ids)
+    return [[share.value for share in shares] for shares in triplets]
+
+
+def _request_data() -> bytes:
+    """
+    Body of the current request, decompressed according to its Content-Encoding, up to
+    the size limit of the messages.
+    """
+    try:
+        return decompress(
+            request.get_data(), request.headers.get("Content-Encoding"), compression_options["max_length"]
+        )
+    except MessageTooLarge:
+        abort(413)
+    except (ValueError, zlib.error):
+        abort(415)
+
+
+def _request_json_list() -> List:
+    """
+    Body of the current request as a JSON list, or abort with 400 if it is not one.
+    """
+    try:
+        res = json.loads(_request_data())
+    except ValueError:
+        abort(400)
+    if not isinstance(res, list):
+        abort(400)
+    return res
+
+
+def _not_ready(missing: int) -> Response:
+    """
+    Answer a retrieval whose messages are not all ready yet, with the number of messages
+    still missing as a hint for the polling of the client.
+    """
+    return Response(status=404, headers={"X-Missing-Messages": str(missing)})
+
+
+def _request_wait() -> float:
+    """
+    Time the current request may be held until its message is ready, given by the client
+    as a "wait" parameter in seconds (long polling), 0 by default.
+    """
+    try:
+        wait = float(request.args.get("wait", 0))
+    except ValueError:
+        return 0.0
+    return min(max(wait, 0.0), MAX_WAIT)
 
 
 def _set_value(pool: str, channel: Tuple[str, str], data: bytes) -> None:
     """
     Push data to a channel in a given pool and send an event.
     """
-    store[pool][channel] = data
+    with store_updated:
+        store[pool][channel] = data
+        store_updated.notify_all()
 
 
 def _get_value(pool: str, channel: Tuple[str, str]) -> Optional[bytes]:
@@ -93,13 +311,217 @@ def _get_value(pool: str, channel: Tuple[str, str]) -> Optional[bytes]:
     return store[pool][channel]
 
 
-def run(host: str, port: int, participants: List[str]) -> None:
+def _wait_value(pool: str, channel: Tuple[str, str], timeout: Optional[float] = None) -> Optional[bytes]:
+    """
+    Block until a channel in a given pool is ready, then get it, or None if the timeout
+    (in seconds, none by default) expires first.
+    """
+    with store_updated:
+        store_updated.wait_for(lambda: channel in store[pool], timeout)
+        return store[pool].get(channel)
+
+
+def _wait_aggregate(label: str, mode: str, timeout: Optional[float] = None) -> Optional[bytes]:
+    """
+    Block until the public messages of all the participants for a label are published, then
+    aggregate them (see `_get_aggregate`), or None if the timeout expires first.
+    """
+    with store_updated:
+        store_updated.wait_for(
+            lambda: all((sender_id, label) in store["public"] for sender_id in participant_ids),
+            timeout
+        )
+    return _get_aggregate(label, mode)
+
+
+def _wait_many(
+        receiver_id: str,
+        keys: List,
+        wait_all: bool,
+        timeout: Optional[float] = None
+    ) -> Dict[int, bytes]:
+    """
+    Block until all (or, if not `wait_all`, some) of the messages given as (sender ID,
+    label) are ready, or the timeout expires, then get the ones ready by index. An empty
+    sender stands for a private message of the receiver.
+    """
+    channels = [
+        ("public", (sender_id, label)) if sender_id else ("private", (receiver_id, label))
+        for sender_id, label in keys
+    ]
+
+    def ready() -> Dict[int, bytes]:
+        return {
+            idx: store[pool][channel]
+            for idx, (pool, channel) in enumerate(channels) if channel in store[pool]
+        }
+
+    expected = len(channels) if wait_all else min(1, len(channels))
+    with store_updated:
+        store_updated.wait_for(lambda: len(ready()) >= expected, timeout)
+        return ready()
+
+
+def _get_aggregate(label: str, mode: str) -> Optional[bytes]:
+    """
+    Aggregate the public messages of all the participants for a label, once they are all
+    published. The aggregate is computed once, then kept in the store.
+    """
+    res = _get_value("aggregate", (label, mode))
+    if res is not None:
+        return res
+    messages = [_get_value("public", (sender_id, label)) for sender_id in participant_ids]
+    if any(message is None for message in messages):
+        return None
+    res = aggregate_messages(messages, mode)
+    _set_value("aggregate", (label, mode), res)
+    return res
+
+
+def _handle_unix_request(method: str, args: Tuple) -> Any:
+    """
+    Execute a request received on the Unix domain socket.
+    """
+    if method == "send_private":
+        sender_id, receiver_id, label, data = args
+        _set_value("private", (receiver_id, label), data)
+        return None
+    if method == "retrieve_private":
+        receiver_id, label = args
+        return _wait_value("private", (receiver_id, label))
+    if method == "publish":
+        sender_id, label, data = args
+        _set_value("public", (sender_id, label), data)
+        return None
+    if method == "retrieve_public":
+        receiver_id, sender_id, label = args
+        return _wait_value("public", (sender_id, label))
+    if method == "retrieve_aggregate":
+        receiver_id, label, mode = args
+        return _wait_aggregate(label, mode)
+    if method == "wait_many":
+        receiver_id, keys, wait_all = args
+        return _wait_many(receiver_id, keys, wait_all)
+    if method == "publish_circuit":
+        circuit_hash, data = args
+        try:
+            circuit_from_bytes(data, circuit_hash)
+        except ValueError:
+            return False
+        _set_value("circuit", (circuit_hash, ""), data)
+        return True
+    if method == "retrieve_circuit":
+        (circuit_hash,) = args
+        return _wait_value("circuit", (circuit_hash, ""))
+    if method == "shares":
+        client_id, op_id = args
+        return _retrieve_share_values(client_id, op_id)
+    if method == "shares_batch":
+        client_id, op_ids = args
+        return _retrieve_share_values_batch(client_id, op_ids)
+    if method == "randomness_batch":
+        client_id, ops = args
+        return _retrieve_randomness_values(client_id, ops)
+    raise ValueError(f"Unknown method {method}")
+
+
+def _serve_unix_connection(conn) -> None:
+    """
+    Answer the requests of one client connected to the Unix domain socket.
+    """
+    with conn:
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                return
+            if not (isinstance(request, tuple) and len(request) == 2
+                    and request[0] in UNIX_METHODS and isinstance(request[1], tuple)):
+                logger.warning("Rejected a request on the Unix socket: %.100r", request)
+                return
+            method, args = request
+            conn.send(_handle_unix_request(method, args))
+
+
+def _accept_unix_connections(listener: Listener) -> None:
+    """
+    Accept clients on a Unix domain socket, each one in its own thread.
+    """
+    while True:
+        try:
+            conn = listener.accept()
+        except (AuthenticationError, EOFError, OSError) as e:
+            logger.warning("Rejected a connection on the Unix socket: %s", e)
+            continue
+        threading.Thread(target=_serve_unix_connection, args=(conn,), daemon=True).start()
+
+
+def serve_unix_socket(path: str, authkey: Optional[bytes] = None) -> None:
+    """
+    Listen on a Unix domain socket in the background.
+    Co-located parties can use it to skip the TCP and HTTP layers.
+
+    The socket is only accessible to the user of the server, and the connections are
+    authenticated with `authkey`, by default a random key written to
+    `unix_socket_key_path(path)`, readable by the user only.
+    """
+    if authkey is None:
+        authkey = os.urandom(32)
+        key_path = unix_socket_key_path(path)
+        if os.path.exists(key_path):
+            os.unlink(key_path)
+        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(authkey)
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = Listener(path, family="AF_UNIX", authkey=authkey)
+    os.chmod(path, 0o600)
+    threading.Thread(target=_accept_unix_connections, args=(listener,), daemon=True).start()
+
+
+def run(
+        host: str,
+        port: int,
+        participants: List[str],
+        unix_socket: Optional[str] = None,
+        unix_authkey: Optional[bytes] = None,
+        compression_threshold: int = 1024,
+        compression_level: int = 6,
+        max_message_size: int = 64 << 20,
+        triple_workers: int = 0,
+        triple_chunk_size: int = 1024,
+        triples_path: Optional[str] = None
+    ) -> None:
     """
     Register the participants, then run the server.
+    If `unix_socket` is given, the server also listens on that Unix domain socket, with
+    connections authenticated by `unix_authkey` (see `serve_unix_socket`).
+    The answers of at least `compression_threshold` bytes are compressed with
+    `compression_level` for the clients accepting it. The requests larger than
+    `max_message_size` bytes, compressed or not, are refused with 413.
+    The Beaver triplets are generated in chunks of `triple_chunk_size` by
+    `triple_workers` processes (none by default, in the request threads), and kept in
+    memory, or in the memory-mapped store at `triples_path` (see `pregenerate_triples`).
     """
+    compression_options.update(
+        threshold=compression_threshold, level=compression_level, max_length=max_message_size
+    )
+    app.config["MAX_CONTENT_LENGTH"] = max_message_size
+    ttp.factory = TripleFactory(triple_chunk_size, triple_workers)
+    ttp.triples_path = triples_path
     for participant in participants:
         ttp.add_participant(participant)
-    app.run(host, port, threaded=False, processes=1)
+    participant_ids.extend(participants)
+    if unix_socket is not None:
+        serve_unix_socket(unix_socket, unix_authkey)
+    # Werkzeug logs every request; only its warnings are kept unless the "smc" loggers are
+    # verbose (see `logs`).
+    if not logger.isEnabledFor(logging.DEBUG):
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    # Long-polling retrievals are held while the other requests go on, so each request is
+    # handled in its own thread.
+    app.run(host, port, threaded=True, processes=1)
 
 
 def main(args: List[str]) -> None:
@@ -5,25 +5,37 @@ MODIFY THIS FILE.
 """
 # You might want to import more classes if needed.
 
-import sys
-import collections
-import json
+import logging
 import time
-from server import publish_message, retrieve_private_message, send_private_message
 from typing import (
     Dict,
-    Set,
+    List,
+    Optional,
     Tuple,
     Union
 )
 
-from communication import Communication
-from expression import (
-    Expression,
-    Secret,
-    AddOp, SubOp, MultOp, Scalar
+from circuit import (
+    Circuit,
+    CircuitCache,
+    Gate,
+    circuit_from_bytes,
+    default_circuit_cache,
+    read_circuit,
+    INPUT, CONST, ADD, SUB, SCALE, MUL, DOT, SQUARE, TRUNC, BITDEC, LTBIT, BIT_OPS,
+    RANDOM_KINDS,
+    random_mask_size,
 )
-from protocol import ProtocolSpec
+from communication import (
+    PeerToPeerCommunication,
+    Transport,
+    UnixSocketCommunication,
+    make_transport,
+)
+from executor import DataflowExecutor, ParallelEvaluator, finish_multiplications
+from expression import Secret
+from logs import get_logger
+from protocol import DEFAULT_OUTPUT, ProtocolSpec
 from secret_sharing import (
     reconstruct_secret,
     share_secret,
@@ -34,6 +46,9 @@ from secret_sharing import (
 # Feel free to add as many imports as you want.
 
 
+logger: logging.Logger = get_logger("smc_party")
+
+
 class SMCParty:
     """
     A client that executes an SMC protocol to collectively compute a value of an expression together
@@ -45,6 +60,32 @@ class SMCParty:
         server_port: port of the server
         protocol_spec (ProtocolSpec): Protocol specification
         value_dict (dict): Dictionary assigning values to secrets belonging to this client.
+        unix_socket: path of the Unix domain socket of the server, for co-located parties.
+            If given, it is used instead of HTTP.
+        peer_to_peer: if True, the parties exchange their messages directly with each other
+            and only use the server for discovery and Beaver triplets.
+        incremental: if True, the windows after the first one only reshare the secrets whose
+            value changed, and only recompute the gates that depend on them.
+        dataflow: if True, the circuit is evaluated by a `DataflowExecutor`, which fires each
+            gate as soon as its operands are available instead of one layer at a time.
+            `dataflow_workers` threads retrieve its messages (default: 8).
+        parallel_workers: if positive, the independent local gates are evaluated by a
+            `ParallelEvaluator` with that many workers, in batches of at least
+            `parallel_threshold` gates (default: 1024). `parallel_backend` is "process"
+            (default) or "thread". The workers are started on demand and stopped at the
+            end of each window.
+        circuit_cache: cache of compiled circuits to use (default: a cache shared by the
+            parties of the process). Give a `CircuitCache` with a path to reuse the circuits
+            across processes.
+        opening: how shared values are opened (see `open_shares`), "broadcast" (default),
+            "king" or "aggregate". All the parties of a run must use the same strategy.
+        transport: transport to use if neither `unix_socket` nor `peer_to_peer` is given,
+            either a `Transport` or the name of one (see `make_transport`): "http"
+            (default), "long-poll" or "memory". Its counters are in `comm.stats`.
+        transport_options: options of the transport created by name, e.g.
+            {"compression": "zlib"} (see `Communication`), or of the peer-to-peer
+            or Unix socket transports, e.g. {"authkey": key} (see `PeerToPeerCommunication`
+            and `UnixSocketCommunication`).
     """
 
     def __init__(
@@ -54,93 +95,265 @@ class SMCParty:
             server_port: int,
             protocol_spec: ProtocolSpec,
             value_dict: Dict[Secret, int],
-            performance_evaluation: bool = False
+            performance_evaluation: bool = False,
+            unix_socket: Optional[str] = None,
+            peer_to_peer: bool = False,
+            incremental: bool = False,
+            dataflow: bool = False,
+            dataflow_workers: int = 8,
+            parallel_workers: int = 0,
+            parallel_backend: str = "process",
+            parallel_threshold: int = 1024,
+            circuit_cache: Optional[CircuitCache] = None,
+            opening: str = "broadcast",
+            transport: Union[str, Transport] = "http",
+            transport_options: Optional[Dict] = None
     ):
-        self.comm = Communication(server_host, server_port, client_id)
+        if opening not in ("broadcast", "king", "aggregate"):
+            raise ValueError(f"Unknown opening strategy {opening}")
+
+        self.comm: Transport
+        if unix_socket is not None:
+            self.comm = UnixSocketCommunication(unix_socket, client_id, **(transport_options or {}))
+        elif peer_to_peer:
+            self.comm = PeerToPeerCommunication(
+                server_host, server_port, client_id, protocol_spec.participant_ids,
+                session=protocol_spec.session, **(transport_options or {})
+            )
+        elif isinstance(transport, Transport):
+            self.comm = transport
+        else:
+            self.comm = make_transport(
+                transport, server_host, server_port, client_id, protocol_spec.participant_ids,
+                session=protocol_spec.session, **(transport_options or {})
+            )
 
         self.client_id = client_id
         self.protocol_spec = protocol_spec
         self.value_dict = value_dict
-        self.secret_ids_dict = {}  # Associate secrets sharer with corresponding secrets IDs; ex: {"Alice":alice's secrets' IDs}
-        self.secret_ids = []
+        self.input_secrets: List[Secret] = []  # Own secrets used by the circuit
         self.shares_dict = {}
         self.performance_evaluation = performance_evaluation
-
-        self.bytes_in = 0
-        self.bytes_out = 0
-
-
-    ### OVERRRIDES
-    # Every communication function is overriden to help for performance evaluation
+        self.circuit: Optional[Circuit] = None
+        self.window = 0  # Number of windows already computed
+        self.beaver_triplets: Dict[int, Tuple[Share, Share, Share]] = {}
+        self.random_masks: Dict[str, Tuple[Share, ...]] = {}  # Random masks of each key
+        self.opened_values: Dict[int, int] = {}  # Values opened by the bit decompositions
+        self.incremental = incremental
+        self.shared_values: Dict[Secret, int] = {}  # Values of own secrets last shared
+        self.wires: Optional[List[Optional[Share]]] = None  # Shares of the last evaluation
+        self.result: Optional[Dict[str, int]] = None
+        self.executor = DataflowExecutor(self, dataflow_workers) if dataflow else None
+        self.circuit_cache = circuit_cache if circuit_cache is not None else default_circuit_cache
+        self.opening = opening
+        self.parallel = (
+            ParallelEvaluator(parallel_workers, parallel_backend, parallel_threshold)
+            if parallel_workers > 0 else None
+        )
+
+    # The transport counts the bytes of every exchange, for performance evaluation.
+    @property
+    def bytes_in(self) -> int:
+        return self.comm.stats.bytes_received
+
+    @property
+    def bytes_out(self) -> int:
+        return self.comm.stats.bytes_sent
+
+
+    ### SHORTCUTS
+    # Communication functions of the transport, on text messages
     def publish_message(self, label: str, msg: str):
-        self.bytes_out += len(msg.encode())
         self.comm.publish_message(label, msg)
 
     def send_private_message(self, receiver, label: str, msg: str):
-        self.bytes_out += len(msg.encode())
         self.comm.send_private_message(receiver, label, msg)
 
     def retrieve_public_message(self, sender_id: str, label: str) -> str:
-        res = self.comm.retrieve_public_message(sender_id, label)
-        self.bytes_in += len(res)
-        return res.decode()
+        return self.comm.retrieve_public_message(sender_id, label).decode()
 
     def retrieve_private_message(self, label: str) -> str:
-        res = self.comm.retrieve_private_message(label)
-        self.bytes_in += len(res)
-        return res.decode()
+        return self.comm.retrieve_private_message(label).decode()
+
+    def retrieve_aggregated_message(self, label: str) -> str:
+        return self.comm.retrieve_aggregated_message(label).decode()
+
+    def wait_for_many(self, keys: List[Tuple[str, str]]) -> Dict[Tuple[str, str], str]:
+        return {key: message.decode() for key, message in self.comm.wait_for_many(keys).items()}
 
     def retrieve_beaver_triplet_shares(self, id: str):
-        res = self.comm.retrieve_beaver_triplet_shares(id)
-        for x in res:
-            print("Adding this", sys.getsizeof(x))
-            self.bytes_in += sys.getsizeof(x)
-        return res
+        return self.comm.retrieve_beaver_triplet_shares(id)
+
+    def retrieve_beaver_triplet_shares_batch(self, ids: List[str]):
+        return self.comm.retrieve_beaver_triplet_shares_batch(ids)
 
-    ### \OVERRIDES
+    def retrieve_randomness_batch(self, ops: List[Tuple[str, str, int]]):
+        return self.comm.retrieve_randomness_batch(ops)
 
-    def run(self) -> int:
+    ### \SHORTCUTS
+
+    def run(self) -> Union[int, Dict[str, int]]:
         """
         The method the client use to do the SMC.
+
+        It returns the value of the expression, or the value of each named output if the
+        protocol specification has several outputs.
+
+        It can be called again, after updating `value_dict` (see `push`), to compute the
+        expression over new values. Each call is a new window of the computation: the
+        connections and the compiled circuit are reused, only the secrets are reshared.
         """
 
         start = time.time()
 
-        # broadcast and get secrets ids from clients
-        self.publish_message(f"client_secrets_id", ",".join([x.id.decode() for x in self.value_dict.keys()]))
-
-        for sid in self.protocol_spec.participant_ids:
-            self.secret_ids_dict[sid] = self.retrieve_public_message(sid, "client_secrets_id").split(",")
-            for id in self.secret_ids_dict[sid]:
-                self.secret_ids.append(id)
+        if self.circuit is None:
+            self.setup()
+
+        # In incremental mode, only the secrets that changed since the last window are
+        # reshared, and only the gates depending on them are recomputed.
+        if self.incremental and self.wires is not None:
+            secrets = [
+                secret for secret in self.input_secrets
+                if self.shared_values.get(secret) != self.value_dict[secret]
+            ]
+            self.publish_message(self.label("changed_secrets_id"), ",".join([x.id.decode() for x in secrets]))
+            changed_ids = set()
+            messages = self.wait_for_many(
+                [(sid, self.label("changed_secrets_id")) for sid in self.protocol_spec.participant_ids]
+            )
+            for message in messages.values():
+                changed_ids.update(message.split(","))
+            dirty = self.circuit.dependents(changed_ids)
+        else:
+            secrets = self.input_secrets
+            changed_ids = None
+            dirty = None
 
         # broadcast own secret's shares to clients
-        for secret in self.value_dict.keys():
+        for secret in secrets:
             shares = share_secret(self.value_dict[secret], len(self.protocol_spec.participant_ids))
             for idx, sid in enumerate(self.protocol_spec.participant_ids):
-                self.send_private_message(sid, secret.id.decode(), shares[idx].value)
-
-        # retrieve own share for each secret
-        for sid in self.protocol_spec.participant_ids:
-            for secret_id in self.secret_ids_dict[sid]:
-                self.shares_dict[secret_id] = Share(self.retrieve_private_message(secret_id))
+                self.send_private_message(sid, self.label(secret.id.decode()), shares[idx].value)
+            self.shared_values[secret] = self.value_dict[secret]
 
-        # compute and broadcast self's result share
-        expression = self.protocol_spec.expr
-        my_share = self.process_expression(expression)
-        self.publish_message("computed share", str(my_share.value))
-        shares = []
-        for sid in self.protocol_spec.participant_ids:
-            shares.append(Share(self.retrieve_public_message(sid, "computed share")))
-
-        reconstructed = reconstruct_secret(shares)
+        if dirty is not None and not any(dirty[wire] for wire in self.circuit.outputs.values()):
+            # The outputs do not depend on the changed secrets.
+            reconstructed = self.result
+        else:
+            # compute and broadcast self's result shares, all outputs in one message
+            self.prefetch_beaver_triplets(dirty)
+            self.prefetch_random_masks(dirty)
+            if self.executor is not None:
+                # The executor retrieves the shares of the secrets while evaluating.
+                my_shares = self.executor.evaluate(self.circuit, dirty)
+            else:
+                # retrieve own share for each secret used by the circuit, all in one request
+                labels = {
+                    self.label(secret_id): secret_id for secret_id in self.circuit.inputs
+                    if changed_ids is None or secret_id in changed_ids
+                }
+                messages = self.wait_for_many([("", label) for label in labels])
+                for (_, label), message in messages.items():
+                    self.shares_dict[labels[label]] = Share(message)
+                try:
+                    my_shares = self.evaluate_circuit(self.circuit, dirty)
+                finally:
+                    # Idle workers would keep this process alive.
+                    if self.parallel is not None:
+                        self.parallel.close()
+            opened = self.open_shares(self.label("computed share"), list(my_shares.values()))
+            reconstructed = dict(zip(my_shares, opened))
+
+        self.result = reconstructed
+        if self.protocol_spec.expr is not None:
+            reconstructed = reconstructed[DEFAULT_OUTPUT]
+        self.window += 1
 
         end = time.time()
+        logger.info("%s computed window %d in %.3f s", self.client_id, self.window - 1, end - start)
         if self.performance_evaluation:
             return (reconstructed, end - start, self.bytes_in, self.bytes_out)
         else:
             return reconstructed
 
+    def push(self, values: Dict[Secret, int]) -> Union[int, Dict[str, int]]:
+        """
+        Stream new values for some of the secrets of this client, and compute the
+        expression over them in a new window. Every party has to push for each window.
+        """
+        self.value_dict.update(values)
+        if self.circuit is not None:
+            self.select_input_secrets()
+        return self.run()
+
+    def setup(self):
+        """
+        Compile (or load) the circuit, once for all windows, and find which of own secrets
+        it uses.
+        """
+        spec = self.protocol_spec
+        if spec.circuit_hash is None:
+            self.circuit = self.circuit_cache.get(spec.outputs, spec.participant_ids)
+        elif spec.circuit_path is not None:
+            with open(spec.circuit_path, "rb") as f:
+                self.circuit = read_circuit(f, spec.circuit_hash)
+        else:
+            data = self.comm.retrieve_circuit(spec.circuit_hash)
+            self.circuit = circuit_from_bytes(data, spec.circuit_hash)
+        self.select_input_secrets()
+
+    def select_input_secrets(self):
+        """
+        Select the own secrets used by the circuit, in the order they are consumed.
+        Only these are shared.
+        """
+        order = {secret_id: idx for idx, secret_id in enumerate(self.circuit.inputs)}
+        self.input_secrets = sorted(
+            [secret for secret in self.value_dict.keys() if secret.id.decode() in order],
+            key=lambda secret: order[secret.id.decode()]
+        )
+
+    # Label of a message (or ID of a Beaver triplet) of the current window
+    def label(self, name: str) -> str:
+        if self.protocol_spec.session:
+            return f"{self.protocol_spec.session}_{name}_{self.window}"
+        return f"{name}_{self.window}"
+
+    def prefetch_beaver_triplets(self, dirty: Optional[List[bool]] = None):
+        """
+        Retrieve, in a single request, the Beaver triplets of all the multiplications of the
+        current window (only the dirty ones if given). Each window uses its own triplets.
+        """
+        mul_gates = [wire for wire in self.circuit.mul_gates if dirty is None or dirty[wire]]
+        if not mul_gates:
+            return
+        triplets = self.retrieve_beaver_triplet_shares_batch(
+            [self.label(self.circuit.gates[wire].key) for wire in mul_gates]
+        )
+        logger.debug("%s retrieved %d Beaver triplets", self.client_id, len(triplets))
+        self.beaver_triplets = {
+            wire: tuple(map(lambda x: Share(str(x)), triplet))
+            for wire, triplet in zip(mul_gates, triplets)
+        }
+
+    def prefetch_random_masks(self, dirty: Optional[List[bool]] = None):
+        """
+        Retrieve, in a single request, the random masks of all the inner products, squares,
+        truncations and bit decompositions of the current window (only the dirty ones if given). Each window uses its own masks.
+        """
+        random_gates = [wire for wire in self.circuit.random_gates if dirty is None or dirty[wire]]
+        if not random_gates:
+            return
+        gates = [self.circuit.gates[wire] for wire in random_gates]
+        masks = self.retrieve_randomness_batch([
+            (self.label(gate.key), RANDOM_KINDS[gate.op], random_mask_size(gate))
+            for gate in gates
+        ])
+        logger.debug("%s retrieved %d random masks", self.client_id, len(masks))
+        self.random_masks = {
+            gate.key: tuple(map(lambda x: Share(str(x)), values))
+            for gate, values in zip(gates, masks)
+        }
 
     # Retrieve own's share of a given secret
     def get_share(self, x: Secret):
@@ -150,78 +363,235 @@ class SMCParty:
     def get_self_id(self) -> int:
         return self.protocol_spec.participant_ids.index(self.client_id)
 
-    # Perform a + or - operation on shares 
-    def perform_operation(self, expr: Expression, a: Share, b: Share) -> Share:
-        if isinstance(expr, AddOp): 
-            return a + b
-        elif isinstance(expr, SubOp):
-            return a - b
-        elif isinstance(expr, MultOp):
-            return a * b
-
-    # Perform a multiplication between two secrets
-    def perform_secret_multiplication(self, expr: Expression, a: Share, b: Share):
-        # Compute beaver triplets
-        a_i, b_i, c_i = tuple(map(lambda x: Share(str(x)), self.retrieve_beaver_triplet_shares(expr.id.decode())))
-        x_share = a - a_i
-        y_share = b - b_i
-
-        self.publish_message("castor_x", str(x_share.value));
-        self.publish_message("castor_y", str(y_share.value));
-
-        # Reconstruct [x - a] and [y - b]
-        x_shares = [] 
-        y_shares = []
-        for sid in self.protocol_spec.participant_ids:
-            x_shares.append(Share(self.retrieve_public_message(sid, "castor_x")))
-            y_shares.append(Share(self.retrieve_public_message(sid, "castor_y")))
-
-        x = Share(str(reconstruct_secret(x_shares)))
-        y = Share(str(reconstruct_secret(y_shares)))
+    def evaluate_circuit(self, circuit: Circuit, dirty: Optional[List[bool]] = None) -> Dict[str, Share]:
+        """
+        Compute own's share of the outputs of a circuit, one layer of openings at a time.
+
+        If `dirty` is given, only the dirty wires are recomputed, the others keep their
+        share from the previous evaluation.
+        """
+        if dirty is None:
+            self.wires = [None] * len(circuit.gates)
+        wires = self.wires
+        for depth, (open_gates, _) in enumerate(circuit.layers):
+            if dirty is not None:
+                open_gates = [wire for wire in open_gates if dirty[wire]]
+            if open_gates:
+                self.perform_openings(circuit, depth, open_gates, wires)
+            # The gates of a level are independent of each other
+            for level in circuit.levels[depth]:
+                if dirty is not None:
+                    level = [wire for wire in level if dirty[wire]]
+                if self.parallel is not None and len(level) >= self.parallel.threshold:
+                    self.evaluate_level_in_parallel(circuit, level, wires)
+                else:
+                    for wire in level:
+                        wires[wire] = self.evaluate_local_gate(circuit.gates[wire], wires)
+        return {name: wires[wire] for name, wire in circuit.outputs.items()}
+
+    def evaluate_level_in_parallel(self, circuit: Circuit, level: List[int], wires: List[Optional[Share]]):
+        """
+        Evaluate independent local gates, the arithmetic ones in the pool of workers.
+        """
+        operations = []
+        for wire in level:
+            if circuit.gates[wire].op in (INPUT, CONST, *BIT_OPS):
+                wires[wire] = self.evaluate_local_gate(circuit.gates[wire], wires)
+            else:
+                operations.append(wire)
+        for wire, value in zip(operations, self.parallel.evaluate_gates(circuit, operations, wires)):
+            wires[wire] = Share(str(value))
+
+    # Evaluate a gate that needs no communication
+    def evaluate_local_gate(self, gate: Gate, wires: List[Optional[Share]]) -> Share:
+        if gate.op == INPUT:
+            return self.shares_dict[gate.key]
+        elif gate.op == CONST:
+            # Only one party uses the actual value of a scalar, others get 0
+            return Share(str(gate.value if self.get_self_id() == 0 else 0))
+        elif gate.op in BIT_OPS:
+            # Bit i of the opened value against the share of bit i of its mask
+            bit = (self.opened_values[gate.a] >> gate.value) & 1
+            r_i = self.random_masks[gate.key][1 + gate.value]
+            if gate.op == LTBIT:
+                return r_i if bit == 0 else Share("0")
+            return r_i if bit == 1 else Share(str(1 if self.get_self_id() == 0 else 0)) - r_i
+        elif gate.op == ADD:
+            return wires[gate.a] + wires[gate.b]
+        elif gate.op == SUB:
+            return wires[gate.a] - wires[gate.b]
+        elif gate.op == SCALE:
+            return wires[gate.a] * Share(str(gate.value))
+        raise ValueError(f"Unknown local gate {gate!r}")
+
+    def perform_openings(
+            self,
+            circuit: Circuit,
+            depth: int,
+            open_gates: List[int],
+            wires: List[Optional[Share]]):
+        """
+        Perform all the multiplications, inner products, squares, truncations and bit
+        decompositions of a layer, opening the masked values of the whole layer in a single round.
+        """
+        masked = []
+        counts = []
+        for wire in open_gates:
+            values = self.mask_open_gate(wire, circuit.gates[wire], wires)
+            masked.extend(values)
+            counts.append(len(values))
+
+        # Reconstruct the masked values of every gate of the layer
+        opened = self.open_shares(self.label(f"beaver_{depth}"), masked)
+
+        mul_gates = [wire for wire in open_gates if circuit.gates[wire].op == MUL]
+        if self.parallel is not None and len(mul_gates) == len(open_gates) >= self.parallel.threshold:
+            operands = []
+            for idx, wire in enumerate(mul_gates):
+                gate = circuit.gates[wire]
+                operands.append((
+                    int(wires[gate.a].value), int(wires[gate.b].value), int(self.beaver_triplets[wire][2].value),
+                    opened[2 * idx], opened[2 * idx + 1]
+                ))
+            values = self.parallel.map(finish_multiplications, operands, self.get_self_id() == 0)
+            for wire, value in zip(mul_gates, values):
+                wires[wire] = Share(str(value))
+            return
+
+        idx = 0
+        for wire, count in zip(open_gates, counts):
+            wires[wire] = self.finish_open_gate(wire, circuit.gates[wire], wires, opened[idx:idx + count])
+            idx += count
+
+    def open_shares(self, label: str, shares: List[Share]) -> List[int]:
+        """
+        Open shared values: give own's shares of them, and get the values.
+
+        With the "broadcast" strategy, every party publishes its shares and retrieves the
+        shares of every party, i.e. O(n^2) messages per opening. With the "king" strategy,
+        the parties send their shares to the king (the first participant), which
+        reconstructs the values and publishes them once, i.e. O(n) messages per opening.
+        With the "aggregate" strategy, every party publishes its shares and retrieves the
+        values summed by the server, i.e. one retrieval per party and opening.
+        """
+        participants = self.protocol_spec.participant_ids
+        message = ",".join(share.value for share in shares)
+        if self.opening == "broadcast":
+            self.publish_message(label, message)
+            # A slow party does not hold back the retrieval of the shares of the others.
+            received = self.wait_for_many([(sid, label) for sid in participants])
+            messages = [received[(sid, label)] for sid in participants]
+        elif self.opening == "aggregate":
+            self.publish_message(label, message)
+            return [int(value) for value in self.retrieve_aggregated_message(label).split(",")]
+        elif self.client_id != participants[0]:
+            king = participants[0]
+            self.send_private_message(king, self.share_label(label, self.client_id), message)
+            return [int(value) for value in self.retrieve_public_message(king, label).split(",")]
+        else:
+            received = self.wait_for_many([("", self.share_label(label, sid)) for sid in participants[1:]])
+            messages = [message] + list(received.values())
+
+        columns = zip(*(message.split(",") for message in messages))
+        opened = [reconstruct_secret([Share(value) for value in column]) for column in columns]
+        if self.opening == "king":
+            self.publish_message(label, ",".join(str(value) for value in opened))
+        return opened
+
+    # Label of the private message carrying the shares of a sender for the king
+    def share_label(self, label: str, sender_id: str) -> str:
+        return f"{label}_share_{sender_id}"
+
+    def mask_open_gate(self, wire: int, gate: Gate, wires: List[Optional[Share]]) -> List[Share]:
+        """
+        Compute own's shares of the masked values a gate opens.
+        """
+        if gate.op == MUL:
+            # [x - a] and [y - b]
+            a_i, b_i, _ = self.beaver_triplets[wire]
+            return [wires[gate.a] - a_i, wires[gate.b] - b_i]
+        if gate.op == DOT:
+            # [x_i - a_i] and [y_i - b_i] for every pair
+            masks = self.random_masks[gate.key]
+            return [wires[w] - mask for w, mask in zip(gate.args, masks)]
+        if gate.op == SQUARE:
+            # [x - r], a single value instead of two for a multiplication
+            r, _ = self.random_masks[gate.key]
+            return [wires[gate.a] - r]
+        if gate.op == TRUNC:
+            # [x + r]
+            _, r = self.random_masks[gate.key]
+            return [wires[gate.a] + r]
+        if gate.op == BITDEC:
+            # [x + r] with r = r_hi * 2^k + sum of the r_i * 2^i
+            r_hi, *bits = self.random_masks[gate.key]
+            r = r_hi * Share(str(1 << gate.value))
+            for idx, r_i in enumerate(bits):
+                r += r_i * Share(str(1 << idx))
+            return [wires[gate.a] + r]
+        raise ValueError(f"Unknown opening gate {gate!r}")
+
+    def finish_open_gate(
+            self,
+            wire: int,
+            gate: Gate,
+            wires: List[Optional[Share]],
+            opened: List[int]) -> Share:
+        """
+        Compute own's share of the output of a gate, given the values it opened.
+        """
+        if gate.op == MUL:
+            x, y = opened
+            return self.finish_secret_multiplication(
+                wires[gate.a], wires[gate.b], self.beaver_triplets[wire], x, y
+            )
+
+        first = self.get_self_id() == 0
+        if gate.op == DOT:
+            # c + sum of x_i * e_i + y_i * d_i, minus the sum of d_i * e_i for the first party
+            res = self.random_masks[gate.key][-1]
+            correction = 0
+            for idx in range(0, len(gate.args), 2):
+                d, e = opened[idx], opened[idx + 1]
+                res += wires[gate.args[idx]] * Share(str(e)) + wires[gate.args[idx + 1]] * Share(str(d))
+                correction += d * e
+            return res - Share(str(correction if first else 0))
+        if gate.op == SQUARE:
+            # x^2 = d^2 + 2 * d * r + r^2 with d = x - r, d^2 held by the first party
+            r, r_squared = self.random_masks[gate.key]
+            (d,) = opened
+            return Share(str(d * d if first else 0)) + r * Share(str(2 * d)) + r_squared
+        if gate.op == TRUNC:
+            # (x + r) >> f - r_hi, the public part held by the first party
+            r_hi, _ = self.random_masks[gate.key]
+            (c,) = opened
+            return Share(str(c >> gate.value if first else 0)) - r_hi
+        if gate.op == BITDEC:
+            # (x + r) >> k - r_hi, the public part held by the first party; the opened value
+            # is kept for the comparisons of its bits
+            r_hi = self.random_masks[gate.key][0]
+            (c,) = opened
+            self.opened_values[wire] = c
+            return Share(str(c >> gate.value if first else 0)) - r_hi
+        raise ValueError(f"Unknown opening gate {gate!r}")
+
+    def finish_secret_multiplication(
+            self,
+            a: Share,
+            b: Share,
+            triplet: Tuple[Share, Share, Share],
+            x: int,
+            y: int) -> Share:
+        """
+        Compute own's share of a * b, given the Beaver triplet and the opened values
+        x = a - a_i and y = b - b_i.
+        """
+        _, _, c_i = triplet
+        x = Share(str(x))
+        y = Share(str(y))
 
         # Compute share result
         res = c_i + a * y + b * x
         if self.get_self_id() == 0:
             res -= x * y
-
         return res
-
-    # Suggestion: To process expressions, make use of the *visitor pattern* like so:
-    # ADD_SCALAR is a flag used to remember if we are adding a scalar
-    def process_expression(
-            self,
-            expr: Expression,
-            ADD_SCALAR=False) -> Share:
-
-        if isinstance(expr, Secret):
-            return self.get_share(expr)
-
-        # Only one party uses the actual value of a scalar, others get 0 
-        elif isinstance(expr, Scalar):
-            return Share(str(0 if (ADD_SCALAR and self.get_self_id() != 0) else expr.value))
-
-        # Perform an operation on a scalar
-        elif isinstance(expr.a, Scalar) or isinstance(expr.b, Scalar):
-            scalar = expr.a if isinstance(expr.a, Scalar) else expr.b
-            secret = expr.b if isinstance(expr.a, Scalar) else expr.a
-
-            if isinstance(expr, MultOp): # directly perform scalar multiplication
-                return self.perform_operation(expr, Share(scalar.value), self.process_expression(secret))
-            else: # perform scalar addition, if expr is a substraction just negate the scalar
-                if self.get_self_id() == 0:
-                    return self.perform_operation(AddOp(scalar, secret), Share(scalar.value if isinstance(expr, AddOp) else -scalar.value), self.process_expression(secret, ADD_SCALAR=True))
-                else:
-                    return self.process_expression(secret)
-
-        # Perform an operation between 2 secrets
-        elif (isinstance(expr.a, Secret) and isinstance(expr.b, Secret)) or isinstance(expr, MultOp):
-            if isinstance(expr, MultOp):
-                expr_a = self.process_expression(expr.a)
-                expr_b = self.process_expression(expr.b)
-                return self.perform_secret_multiplication(expr, expr_a, expr_b)
-            else:
-                return self.perform_operation(expr, self.get_share(expr.a), self.get_share(expr.b))
-
-        # Directly perform the operation on the share results
-        else:
-            return self.perform_operation(expr, self.process_expression(expr.a), self.process_expression(expr.b))
\ No newline at end of file
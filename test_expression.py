@@ -5,4 +5,403 @@ Testing expressions is not obligatory.
 MODIFY THIS FILE.
 """
 
-from expression import Secret, Scalar
+import hashlib
+import io
+import pickle
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import server
+from circuit import (
+    CircuitCache, Gate, circuit_from_bytes, circuit_to_bytes, compile_circuit, random_mask_size,
+    read_circuit, write_circuit, ADD, BITDEC, DOT, EQBIT, INPUT, LTBIT, MUL, SQUARE, SUB,
+    COMPARISON_BITS, RANDOM_KINDS,
+)
+import fixed_point
+from expression import Secret, Scalar, MultOp, TruncOp, LessThanOp, balance
+from protocol import ProtocolSpec
+from ttp import TrustedParamGenerator
+
+
+def evaluate(expr, values):
+    """Evaluate an expression in the clear, without recursion."""
+    return evaluate_outputs({"result": expr}, values)["result"]
+
+
+def evaluate_outputs(outputs, values):
+    """Evaluate named expressions in the clear, over a single circuit."""
+    return evaluate_circuit(compile_circuit(outputs), values)
+
+
+def evaluate_gate(gate, wires, values):
+    """Evaluate a gate in the clear, given the values of the previous wires."""
+    if gate.op == "input":
+        return values[gate.key]
+    if gate.op == "const":
+        return gate.value
+    if gate.op == "add":
+        return wires[gate.a] + wires[gate.b]
+    if gate.op == "sub":
+        return wires[gate.a] - wires[gate.b]
+    if gate.op == "scale":
+        return wires[gate.a] * gate.value
+    if gate.op == "mul":
+        return wires[gate.a] * wires[gate.b]
+    if gate.op == "square":
+        return wires[gate.a] ** 2
+    if gate.op == "dot":
+        return sum(wires[gate.args[i]] * wires[gate.args[i + 1]] for i in range(0, len(gate.args), 2))
+    raise ValueError(f"Gate {gate!r} cannot be evaluated in the clear")
+
+
+def evaluate_circuit(circuit, values):
+    """Evaluate a circuit in the clear."""
+    wires = []
+    for gate in circuit.gates:
+        wires.append(evaluate_gate(gate, wires, values))
+    return {name: wires[wire] for name, wire in circuit.outputs.items()}
+
+
+def test_balance_product_chain():
+    a, b = Secret(), Secret()
+    values = {a.id.decode(): 2, b.id.decode(): 3}
+
+    expr = a
+    for i in range(4000):
+        expr = expr * (a if i % 2 == 0 else b)
+    expr = expr * Scalar(5)
+
+    balanced = balance(expr)
+    circuit = compile_circuit({"result": balanced})
+    assert len(circuit.layers) - 1 == 12
+    # The repeated (a * b) factors are only computed once.
+    assert sum(gate.op == MUL for gate in circuit.gates) < 4000
+    assert evaluate(balanced, values) == 2 ** 2001 * 3 ** 2000 * 5
+
+
+def test_balance_folds_scalars():
+    a, b = Secret(), Secret()
+    values = {a.id.decode(): 7, b.id.decode(): -4}
+
+    expr = Scalar(1) + a + Scalar(2) + b + Scalar(3) - a * b
+    balanced = balance(expr)
+    assert evaluate(balanced, values) == 1 + 7 + 2 - 4 + 3 - 7 * -4
+
+
+def test_balance_keeps_shared_subexpressions():
+    a, b, c = Secret(), Secret(), Secret()
+    values = {a.id.decode(): 2, b.id.decode(): 5, c.id.decode(): 3}
+
+    shared = a * b * c
+    expr = shared * shared + shared
+    circuit = compile_circuit({"result": balance(expr)})
+    # shared * shared is a square
+    assert sum(gate.op == MUL for gate in circuit.gates) == 2
+    assert sum(gate.op == SQUARE for gate in circuit.gates) == 1
+    assert evaluate(balance(expr), values) == 30 * 30 + 30
+
+
+def test_balance_scalar_only():
+    expr = Scalar(2) * Scalar(3) + Scalar(4)
+    assert evaluate(balance(expr), {}) == 10
+
+
+def test_compile_outputs_shares_subexpressions():
+    a, b, c = Secret(), Secret(), Secret()
+    values = {a.id.decode(): 2, b.id.decode(): 5, c.id.decode(): 3}
+
+    # Structurally identical, but distinct, subexpressions.
+    outputs = {"x": a * b + c, "y": (b * a) * Scalar(4), "z": Scalar(7)}
+    circuit = compile_circuit(outputs)
+    assert sum(gate.op == MUL for gate in circuit.gates) == 1
+    assert evaluate_outputs(outputs, values) == {"x": 13, "y": 40, "z": 7}
+
+
+def cost_formula(nb_patients, avg_time):
+    return (nb_patients[0] * avg_time[0] + nb_patients[1] * avg_time[1]) * Scalar(1500) - Scalar(200)
+
+
+def test_circuit_cache_rebinds_secrets(tmp_path):
+    cache = CircuitCache(capacity=1, path=str(tmp_path))
+    participants = ["H1", "H2"]
+
+    first = [Secret(), Secret()], [Secret(), Secret()]
+    second = [Secret(), Secret()], [Secret(), Secret()]
+    circuit1 = cache.get({"cost": cost_formula(*first)}, participants)
+    circuit2 = cache.get({"cost": cost_formula(*second)}, participants)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # The cached circuit uses the secrets and multiplications of the second formula.
+    values = {s.id.decode(): v for s, v in zip(second[0] + second[1], [1500, 2000, 3, 4])}
+    assert sorted(circuit2.inputs) == sorted(values)
+    assert not {g.key for g in circuit1.gates if g.key} & {g.key for g in circuit2.gates if g.key}
+    assert evaluate_circuit(circuit2, values) == {"cost": (1500 * 3 + 2000 * 4) * 1500 - 200}
+
+    # Another formula evicts it from memory, but it is reloaded from disk.
+    cache.get({"other": first[0][0] + first[0][1]}, participants)
+    cache.get({"cost": cost_formula(*first)}, participants)
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    # The participants are part of the key.
+    cache.get({"cost": cost_formula(*first)}, participants + ["H3"])
+    assert cache.misses == 3
+
+
+def test_circuit_cache_is_thread_safe(tmp_path):
+    cache = CircuitCache(capacity=4, path=str(tmp_path))
+    participants = ["H1", "H2"]
+
+    def lookups():
+        for idx in range(40):
+            secrets = [Secret(), Secret()], [Secret(), Secret()]
+            outputs = {"cost": cost_formula(*secrets)} if idx % 2 else {"sum": secrets[0][0] + secrets[1][0]}
+            cache.get(outputs, participants)
+
+    threads = [threading.Thread(target=lookups) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert cache.hits + cache.misses == 8 * 40
+    assert len(cache.circuits) == 2
+    # Every file is complete, and no temporary file is left.
+    assert sorted(path.suffix for path in tmp_path.iterdir()) == [".circuit", ".circuit"]
+    for path in tmp_path.iterdir():
+        with open(path, "rb") as f:
+            read_circuit(f)
+
+
+def test_operation_ids_are_content_addressed():
+    a, b = Secret(), Secret()
+
+    assert (a * b + Scalar(3)).id == (a * b + Scalar(3)).id
+    assert (a * b).id != (b * a).id
+    assert (a * b).id != (a + b).id
+    assert (a - b).id != (a + b).id
+    assert Scalar(3).id != Scalar(4).id
+
+    # Equal expressions can be used interchangeably as keys.
+    assert a * b == MultOp(a, b)
+    assert {a * b: 1}[MultOp(a, b)] == 1
+    assert hash(Scalar(3)) == hash(Scalar(3))
+    assert len({Scalar(3), Scalar(3), a, Secret()}) == 3
+
+
+def test_protocol_spec_pickles_deep_expressions():
+    a, b = Secret(), Secret()
+    values = {a.id.decode(): 3, b.id.decode(): -2}
+
+    expr = a
+    for i in range(20000):
+        expr = expr + b * Scalar(i % 5) - a
+    outputs = {"deep": expr, "shared": expr * a, "constant": Scalar(12)}
+    spec = ProtocolSpec(["Alice", "Bob"], outputs=outputs, balance=False)
+
+    copy = pickle.loads(pickle.dumps(spec))
+    assert copy.participant_ids == spec.participant_ids
+    assert copy.expr is None
+    assert {name: e.id for name, e in copy.outputs.items()} == {name: e.id for name, e in spec.outputs.items()}
+    assert evaluate_outputs(copy.outputs, values) == evaluate_outputs(spec.outputs, values)
+    assert not hasattr(copy.outputs["deep"], "__dict__")
+
+
+def test_circuit_binary_format_round_trip():
+    a, b, c = Secret(), Secret(), Secret()
+    outputs = {
+        "big": a * b + Scalar(-2 ** 80),
+        "mixed": (a - c) * Scalar(7) + b * c,
+    }
+    circuit = compile_circuit(outputs)
+    data, circuit_hash = circuit_to_bytes(circuit)
+    assert data.startswith(b"SMCC")
+
+    loaded = circuit_from_bytes(data, circuit_hash)
+    assert [repr(gate) for gate in loaded.gates] == [repr(gate) for gate in circuit.gates]
+    assert loaded.outputs == circuit.outputs
+    assert loaded.layers == circuit.layers
+    assert circuit_to_bytes(loaded)[1] == circuit_hash
+
+    values = {a.id.decode(): 3, b.id.decode(): -5, c.id.decode(): 11}
+    assert evaluate_circuit(loaded, values) == evaluate_outputs(outputs, values)
+
+
+def test_circuit_binary_format_rejects_corruption():
+    a, b = Secret(), Secret()
+    data, circuit_hash = circuit_to_bytes(compile_circuit({"result": a * b}))
+
+    corrupted = bytearray(data)
+    corrupted[len(data) // 2] ^= 1
+    for bad in (bytes(corrupted), data[:-1]):
+        with pytest.raises(ValueError):
+            circuit_from_bytes(bad)
+    with pytest.raises(ValueError):
+        circuit_from_bytes(data, "0" * 64)
+
+
+@pytest.mark.parametrize("gates, outputs", [
+    # Operand computed after the gate, or by the gate itself.
+    ([Gate(INPUT, key="x"), Gate(ADD, 0, 2), Gate(INPUT, key="y")], {"result": 1}),
+    ([Gate(INPUT, key="x"), Gate(MUL, 0, 1, key="m")], {"result": 1}),
+    ([Gate(INPUT, key="x"), Gate(DOT, key="m", args=(0, 5))], {"result": 1}),
+    # Missing operand.
+    ([Gate(INPUT, key="x"), Gate(SUB, 0)], {"result": 1}),
+    # Output out of range.
+    ([Gate(INPUT, key="x")], {"result": 1}),
+])
+def test_circuit_binary_format_rejects_malformed_circuits(gates, outputs):
+    # Well hashed, but malformed: the writer does not check the circuits.
+    stream = io.BytesIO()
+    circuit_hash = write_circuit(SimpleNamespace(gates=gates, outputs=outputs), stream)
+    with pytest.raises(ValueError):
+        circuit_from_bytes(stream.getvalue(), circuit_hash)
+
+    response = server.app.test_client().post(f"/circuits/{circuit_hash}", data=stream.getvalue())
+    assert response.status_code == 400
+
+
+def test_circuit_binary_format_rejects_unknown_operations():
+    data, _ = circuit_to_bytes(compile_circuit({"result": Secret() + Secret()}))
+    # The op code of the last gate, re-hashed.
+    body = bytearray(data[:-32])
+    body[-17] = 200
+    with pytest.raises(ValueError, match="Unknown op code"):
+        circuit_from_bytes(bytes(body) + hashlib.sha256(body).digest())
+
+
+def test_fixed_point_operations_are_balanced_and_packed():
+    a, b, c, d = Secret(), Secret(), Secret(), Secret()
+    expr = fixed_point.less_than(fixed_point.mul(a * b * c * d, a), Scalar(0))
+    balanced = balance(expr)
+    assert isinstance(balanced, LessThanOp) and isinstance(balanced.a, TruncOp)
+    # The product chain inside the truncation is balanced too.
+    assert len(compile_circuit({"result": balanced}).layers) < len(compile_circuit({"result": expr}).layers)
+
+    spec = ProtocolSpec(participant_ids=["Alice"], expr=expr)
+    copy = pickle.loads(pickle.dumps(spec))
+    assert copy.expr.id == spec.expr.id
+
+    # Constants are folded.
+    assert evaluate(fixed_point.truncate(Scalar(100), 3) + fixed_point.less_than(Scalar(1), Scalar(2)), {}) == 13
+
+
+def test_comparisons_get_their_own_masks():
+    a, b = Secret(), Secret()
+    circuit = compile_circuit({
+        "lt": fixed_point.less_than(a, b),
+        "gt": fixed_point.greater_than(a, b),
+        "again": fixed_point.less_than(a, b),
+    })
+    assert circuit.outputs["lt"] == circuit.outputs["again"]
+    assert circuit.outputs["lt"] != circuit.outputs["gt"]
+    assert len({gate.key for gate in circuit.gates if gate.op == BITDEC}) == 2
+    # One round to open the masked value, then log2(k) rounds to combine its bits.
+    assert len(circuit.layers) - 1 == 1 + COMPARISON_BITS.bit_length() - 1
+
+    data, circuit_hash = circuit_to_bytes(circuit)
+    assert [repr(gate) for gate in circuit_from_bytes(data, circuit_hash).gates] == [repr(gate) for gate in circuit.gates]
+
+
+def simulate_openings(circuit, values, ttp):
+    """Evaluate a circuit in the clear with the masks of the TTP, and list the opened values."""
+    masks = {
+        gate.key: ttp.generate_randomness(RANDOM_KINDS[gate.op], random_mask_size(gate))
+        for gate in circuit.gates if gate.op in RANDOM_KINDS
+    }
+    wires, opened, opened_values = [], [], {}
+    for wire, gate in enumerate(circuit.gates):
+        if gate.op == DOT:
+            pairs = [wires[arg] for arg in gate.args]
+            opened.extend(value - mask for value, mask in zip(pairs, masks[gate.key]))
+            wires.append(sum(pairs[i] * pairs[i + 1] for i in range(0, len(pairs), 2)))
+        elif gate.op == BITDEC:
+            r_hi, *bits = masks[gate.key]
+            r = (r_hi << gate.value) + sum(bit << idx for idx, bit in enumerate(bits))
+            opened_values[wire] = wires[gate.a] + r
+            opened.append(opened_values[wire])
+            wires.append((opened_values[wire] >> gate.value) - r_hi)
+        elif gate.op in (EQBIT, LTBIT):
+            bit, r_i = (opened_values[gate.a] >> gate.value) & 1, masks[gate.key][1 + gate.value]
+            wires.append(int(bit == r_i) if gate.op == EQBIT else int(bit < r_i))
+        else:
+            wires.append(evaluate_gate(gate, wires, values))
+    return {name: wires[wire] for name, wire in circuit.outputs.items()}, opened
+
+
+def test_comparisons_do_not_leak():
+    a, b = Secret(), Secret()
+    circuit = compile_circuit({"lt": fixed_point.less_than(a, b)})
+    # The products use full-size masks, not Beaver triplets.
+    assert not any(gate.op == MUL for gate in circuit.gates)
+
+    ttp = TrustedParamGenerator()
+    # Opened values for each sign and magnitude of the difference.
+    samples = {}
+    for sign in (-1, 1):
+        for bits in (0, 20, 40, 60):
+            samples[sign, bits] = []
+            for trial in range(40):
+                x = trial << 30
+                y = x + sign * (1 << bits)
+                outputs, opened = simulate_openings(circuit, {a.id.decode(): x, b.id.decode(): y}, ttp)
+                assert outputs["lt"] == int(x < y)
+                samples[sign, bits].append(opened)
+
+    # Neither the signs nor the sizes of any opened value depend on the inputs.
+    for position in range(len(samples[1, 0][0])):
+        positive = [sum(opened[position] > 0 for opened in runs) / len(runs) for runs in samples.values()]
+        sizes = [sum(abs(opened[position]).bit_length() for opened in runs) / len(runs) for runs in samples.values()]
+        assert max(positive) - min(positive) < 0.4, position
+        assert max(sizes) - min(sizes) < 2.5, position
+
+
+def test_squares_and_powers():
+    a, b = Secret(), Secret()
+    circuit = compile_circuit({"square": a * a, "power": a ** 13, "product": (a + b) ** 2 * b})
+    # a^13 = a^8 * a^4 * a: three squares, shared with a * a, and two multiplications.
+    assert sum(gate.op == "square" for gate in circuit.gates) == 4
+    assert len(circuit.layers) - 1 == 4
+
+    values = {a.id.decode(): -3, b.id.decode(): 5}
+    assert evaluate_circuit(circuit, values) == {"square": 9, "power": (-3) ** 13, "product": 4 * 5}
+    assert evaluate(Scalar(3) ** 4 + a ** 0, values) == 82
+
+    # The keys of the gates of a power follow the expression through the cache.
+    cache = CircuitCache()
+    c, d = Secret(), Secret()
+    cache.get({"power": a ** 13}, ["Alice"])
+    rebound = cache.get({"power": c ** 13}, ["Alice"])
+    power_id = (c ** 13).id.decode()
+    assert {gate.key.split(":")[0] for gate in rebound.gates if gate.op != "input"} == {power_id}
+    assert evaluate_circuit(rebound, {c.id.decode(): 2})["power"] == 2 ** 13
+
+
+def test_sums_of_products_are_fused_into_inner_products():
+    x = [Secret() for _ in range(3)]
+    y = [Secret() for _ in range(3)]
+    shared = x[0] * y[1]
+    outputs = {
+        "weighted": balance(x[0] * y[0] + x[1] * y[1] + x[2] * y[2] + Scalar(7)),
+        "partial": shared + x[2] * y[0] + x[1],
+        "reuse": shared * Scalar(3),
+    }
+    circuit = compile_circuit(outputs)
+
+    dots = [gate for gate in circuit.gates if gate.op == "dot"]
+    assert sorted(len(gate.args) // 2 for gate in dots) == [3]
+    # The product used twice is kept, so "partial" keeps its two multiplications.
+    assert sum(gate.op == MUL for gate in circuit.gates) == 2
+    assert len(circuit.layers) - 1 == 1
+
+    values = {secret.id.decode(): value for secret, value in zip(x + y, [2, -3, 5, 7, 11, -13])}
+    assert evaluate_circuit(circuit, values) == evaluate_outputs(outputs, values) == {
+        "weighted": 2 * 7 - 3 * 11 - 5 * 13 + 7,
+        "partial": 2 * 11 + 5 * 7 - 3,
+        "reuse": 2 * 11 * 3,
+    }
+
+    data, circuit_hash = circuit_to_bytes(circuit)
+    loaded = circuit_from_bytes(data, circuit_hash)
+    assert [repr(gate) for gate in loaded.gates] == [repr(gate) for gate in circuit.gates]
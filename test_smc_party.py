@@ -0,0 +1,510 @@
+"""
+Integration tests for the execution modes of the SMC party.
+"""
+
+import threading
+import time
+from multiprocessing import Process, Queue
+
+import pytest
+
+import requests
+
+import fixed_point
+from circuit import circuit_to_bytes, compile_circuit, write_circuit
+from communication import Communication, InMemoryHub, InMemoryTransport
+from expression import Scalar, Secret
+from fixed_point import FRACTIONAL_BITS, decode, encode, fixed
+from protocol import ProtocolSpec
+from server import run
+
+from smc_party import SMCParty
+
+
+def smc_client(client_id, prot, value_dict, windows, party_kwargs, queue):
+    cli = SMCParty(
+        client_id,
+        "localhost",
+        5000,
+        protocol_spec=prot,
+        value_dict=value_dict,
+        **party_kwargs
+    )
+    res = [cli.run()]
+    for values in windows:
+        res.append(cli.push(values))
+    queue.put(res)
+    print(f"{client_id} has finished!")
+
+
+def smc_server(args):
+    run("localhost", 5000, args)
+
+
+def run_processes(server_args, party_kwargs, *client_args, on_start=None):
+    queue = Queue()
+
+    server = Process(target=smc_server, args=(server_args,))
+    clients = [
+        Process(target=smc_client, args=(*args, party_kwargs, queue))
+        for args in client_args
+    ]
+
+    server.start()
+    time.sleep(3)
+    if on_start is not None:
+        on_start()
+    for client in clients:
+        client.start()
+
+    results = list()
+    for client in clients:
+        client.join()
+
+    for client in clients:
+        results.append(queue.get())
+
+    server.terminate()
+    server.join()
+
+    # To "ensure" the workers are dead.
+    time.sleep(2)
+
+    print("Server stopped.")
+
+    return results
+
+
+def suite(parties, windows, expr, expected, party_kwargs=None):
+    """
+    Run the protocol over the initial values of `parties`, then over each window of new
+    values in `windows`, and check the result of every window.
+    """
+    participants = list(parties.keys())
+
+    prot = ProtocolSpec(expr=expr, participant_ids=participants)
+    clients = [
+        (name, prot, value_dict, [window.get(name, {}) for window in windows])
+        for name, value_dict in parties.items()
+    ]
+
+    results = run_processes(participants, party_kwargs or {}, *clients)
+
+    for result in results:
+        assert result == expected
+
+
+def test_streaming():
+    """
+    f(a, b, c) = a ∗ b + c ∗ K, over three windows
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 14},
+        "Charlie": {charlie_secret: 2}
+    }
+    windows = [
+        {"Alice": {alice_secret: 5}},
+        {"Bob": {bob_secret: -1}, "Charlie": {charlie_secret: 10}},
+    ]
+
+    expr = alice_secret * bob_secret + charlie_secret * Scalar(4)
+    expected = [3 * 14 + 2 * 4, 5 * 14 + 2 * 4, 5 * -1 + 10 * 4]
+    suite(parties, windows, expr, expected)
+
+
+def test_incremental():
+    """
+    f(a, b, c) = a ∗ b + c ∗ K, recomputing only what depends on the changed secrets
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 14},
+        "Charlie": {charlie_secret: 2}
+    }
+    windows = [
+        {"Charlie": {charlie_secret: 7}},
+        {},
+        {"Alice": {alice_secret: 5}, "Charlie": {charlie_secret: 7}},
+    ]
+
+    expr = alice_secret * bob_secret + charlie_secret * Scalar(4)
+    expected = [3 * 14 + 2 * 4, 3 * 14 + 7 * 4, 3 * 14 + 7 * 4, 5 * 14 + 7 * 4]
+    suite(parties, windows, expr, expected, party_kwargs={"incremental": True})
+
+
+def test_multiple_outputs():
+    """
+    f(a, b, c) = (a + b + c, (a ∗ b + c) ∗ K - K)
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 14},
+        "Charlie": {charlie_secret: 2}
+    }
+
+    participants = list(parties.keys())
+    outputs = {
+        "sum": alice_secret + bob_secret + charlie_secret,
+        "cost": (alice_secret * bob_secret + charlie_secret) * Scalar(10) - Scalar(5),
+    }
+    prot = ProtocolSpec(outputs=outputs, participant_ids=participants)
+    clients = [(name, prot, value_dict, []) for name, value_dict in parties.items()]
+
+    results = run_processes(participants, {}, *clients)
+
+    for result in results:
+        assert result == [{"sum": 3 + 14 + 2, "cost": (3 * 14 + 2) * 10 - 5}]
+
+
+def test_unused_secrets_are_not_shared():
+    """
+    f(a, b) = a ∗ b, while the parties hold more secrets, and one holds none used
+    """
+    alice_secret = Secret()
+    alice_unused = Secret()
+    bob_secret = Secret()
+    charlie_unused = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3, alice_unused: 100},
+        "Bob": {bob_secret: 14},
+        "Charlie": {charlie_unused: 2}
+    }
+
+    expr = alice_secret * bob_secret
+    suite(parties, [], expr, [3 * 14])
+
+
+def test_dataflow():
+    """
+    f(a, b, c, d) = (a ∗ b + c) ∗ (c - d) + a ∗ K, with incremental windows
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+    david_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 14},
+        "Charlie": {charlie_secret: 2},
+        "David": {david_secret: 5}
+    }
+    windows = [
+        {"David": {david_secret: -4}},
+        {"Alice": {alice_secret: 1}, "Bob": {bob_secret: 2}},
+    ]
+
+    expr = (alice_secret * bob_secret + charlie_secret) * (charlie_secret - david_secret) + alice_secret * Scalar(7)
+    expected = [
+        (3 * 14 + 2) * (2 - 5) + 3 * 7,
+        (3 * 14 + 2) * (2 + 4) + 3 * 7,
+        (1 * 2 + 2) * (2 + 4) + 1 * 7,
+    ]
+    suite(parties, windows, expr, expected, party_kwargs={"dataflow": True, "incremental": True})
+
+
+def test_dataflow_single_worker():
+    """
+    f(a, b, c) = (a ∗ b + b ∗ c) ∗ (a ∗ c) ∗ b, with a single thread retrieving messages
+    while several openings are waiting
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 14},
+        "Charlie": {charlie_secret: 2}
+    }
+
+    expr = (alice_secret * bob_secret + bob_secret * charlie_secret) * (alice_secret * charlie_secret) * bob_secret
+    expected = [(3 * 14 + 14 * 2) * (3 * 2) * 14]
+    for opening in ("broadcast", "king"):
+        suite(parties, [], expr, expected, party_kwargs={"dataflow": True, "dataflow_workers": 1, "opening": opening})
+
+
+class FailingTransport(InMemoryTransport):
+    """
+    In-memory transport whose retrievals of the openings of Alice fail.
+    """
+
+    def retrieve_public_message(self, sender_id, label):
+        if sender_id == "Alice":
+            raise requests.HTTPError("500 error")
+        return super().retrieve_public_message(sender_id, label)
+
+
+def test_dataflow_failure():
+    """
+    A failed retrieval stops the evaluation, and the retrievals still waiting for a party
+    which is gone do not keep the process alive.
+    """
+    alice_secret = Secret()
+    prot = ProtocolSpec(expr=alice_secret * alice_secret * Scalar(2), participant_ids=["Alice", "Bob"])
+    transport = FailingTransport(InMemoryHub(), "Alice", prot.participant_ids)
+    party = SMCParty(
+        "Alice", "localhost", 5000, protocol_spec=prot, value_dict={alice_secret: 3},
+        dataflow=True, dataflow_workers=2, transport=transport
+    )
+    with pytest.raises(requests.HTTPError):
+        party.run()
+    # Bob never publishes his opening.
+    assert all(thread.daemon for thread in threading.enumerate() if thread is not threading.main_thread())
+
+
+def test_parallel_evaluation():
+    """
+    f(a, b, c) = Σ (a + i) ∗ (b - i) + c ∗ i, with every batch evaluated by a process pool
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 14},
+        "Charlie": {charlie_secret: 2}
+    }
+
+    expr = Scalar(0)
+    for i in range(1, 20):
+        expr = expr + (alice_secret + Scalar(i)) * (bob_secret - Scalar(i)) + charlie_secret * Scalar(i)
+    expected = sum((3 + i) * (14 - i) + 2 * i for i in range(1, 20))
+    suite(parties, [], expr, [expected], party_kwargs={"parallel_workers": 2, "parallel_threshold": 1})
+
+
+def test_circuit_from_file(tmp_path):
+    """
+    f(a, b, c) = (a ∗ b - c, c ∗ K), compiled once and loaded by the parties from a file
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 14},
+        "Charlie": {charlie_secret: 2}
+    }
+
+    circuit = compile_circuit({
+        "diff": alice_secret * bob_secret - charlie_secret,
+        "scaled": charlie_secret * Scalar(6),
+    })
+    path = tmp_path / "protocol.circuit"
+    with open(path, "wb") as f:
+        circuit_hash = write_circuit(circuit, f)
+
+    participants = list(parties.keys())
+    prot = ProtocolSpec(participant_ids=participants, circuit_hash=circuit_hash, circuit_path=str(path))
+    clients = [(name, prot, value_dict, []) for name, value_dict in parties.items()]
+
+    results = run_processes(participants, {}, *clients)
+
+    for result in results:
+        assert result == [{"diff": 3 * 14 - 2, "scaled": 2 * 6}]
+
+
+def test_circuit_from_server():
+    """
+    f(a, b, c) = a ∗ b ∗ c + K, compiled once and loaded by the parties from the server
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 14},
+        "Charlie": {charlie_secret: 2}
+    }
+
+    data, circuit_hash = circuit_to_bytes(compile_circuit({
+        "result": alice_secret * bob_secret * charlie_secret + Scalar(1),
+    }))
+
+    def publish():
+        Communication("localhost", 5000, "Alice").publish_circuit(circuit_hash, data)
+
+    participants = list(parties.keys())
+    prot = ProtocolSpec(participant_ids=participants, circuit_hash=circuit_hash)
+    clients = [(name, prot, value_dict, [{}]) for name, value_dict in parties.items()]
+
+    results = run_processes(participants, {}, *clients, on_start=publish)
+
+    for result in results:
+        assert result == [{"result": 3 * 14 * 2 + 1}] * 2
+
+
+def fixed_point_suite(party_kwargs):
+    """
+    cost = price ∗ quantity in fixed point, compared to a budget, with the maximum of the
+    prices, over two windows
+    """
+    alice_price = Secret()
+    bob_quantity = Secret()
+    charlie_price = Secret()
+
+    parties = {
+        "Alice": {alice_price: encode(2.5)},
+        "Bob": {bob_quantity: encode(12.25)},
+        "Charlie": {charlie_price: encode(-3.75)}
+    }
+    windows = [{"Alice": {alice_price: encode(-4.0)}}]
+
+    cost = fixed_point.mul(alice_price, bob_quantity)
+    outputs = {
+        "cost": cost,
+        "over_budget": fixed_point.less_than(fixed(30.0), cost),
+        "max_price": fixed_point.maximum(alice_price, charlie_price),
+        "is_negative": fixed_point.less_than(charlie_price, Scalar(0)),
+    }
+
+    participants = list(parties.keys())
+    prot = ProtocolSpec(outputs=outputs, participant_ids=participants)
+    clients = [
+        (name, prot, value_dict, [window.get(name, {}) for window in windows])
+        for name, value_dict in parties.items()
+    ]
+
+    results = run_processes(participants, party_kwargs, *clients)
+
+    for result in results:
+        for res, (price, quantity, other) in zip(result, [(2.5, 12.25, -3.75), (-4.0, 12.25, -3.75)]):
+            # Truncations may round up by one unit in the last place.
+            assert abs(decode(res["cost"]) - price * quantity) <= 2 ** -FRACTIONAL_BITS
+            assert res["over_budget"] == int(price * quantity > 30.0)
+            assert decode(res["max_price"]) == max(price, other)
+            assert res["is_negative"] == 1
+
+
+def test_fixed_point():
+    fixed_point_suite({})
+
+
+def test_fixed_point_dataflow():
+    fixed_point_suite({"dataflow": True, "incremental": True})
+
+
+def test_squares_and_powers():
+    """
+    f(a, b, c) = (a ∗ a + b ** 3, (a - c) ** 6), also with the dataflow executor
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: -4},
+        "Charlie": {charlie_secret: 5}
+    }
+    windows = [{"Bob": {bob_secret: 2}}]
+
+    participants = list(parties.keys())
+    outputs = {
+        "sum": alice_secret * alice_secret + bob_secret ** 3,
+        "power": (alice_secret - charlie_secret) ** 6,
+    }
+    prot = ProtocolSpec(outputs=outputs, participant_ids=participants)
+    clients = [
+        (name, prot, value_dict, [window.get(name, {}) for window in windows])
+        for name, value_dict in parties.items()
+    ]
+    expected = [{"sum": 9 - 64, "power": 64}, {"sum": 9 + 8, "power": 64}]
+
+    for party_kwargs in ({}, {"dataflow": True, "incremental": True}):
+        results = run_processes(participants, party_kwargs, *clients)
+        for result in results:
+            assert result == expected
+
+
+def test_inner_product():
+    """
+    f = Σ patients_i ∗ time_i, as in Application.py, fused into a single inner product
+    """
+    patients = [Secret() for _ in range(3)]
+    times = [Secret() for _ in range(3)]
+    values = [(120, 5), (80, 7), (200, 3)]
+
+    parties = {
+        f"H{idx}": {patients[idx]: nb, times[idx]: time}
+        for idx, (nb, time) in enumerate(values)
+    }
+    windows = [{"H1": {patients[1]: 90}}]
+
+    expr = patients[0] * times[0] + patients[1] * times[1] + patients[2] * times[2]
+    expected = [120 * 5 + 80 * 7 + 200 * 3, 120 * 5 + 90 * 7 + 200 * 3]
+    suite(parties, windows, expr, expected)
+    suite(parties, windows, expr, expected, party_kwargs={"dataflow": True, "incremental": True})
+
+
+def test_king_opening():
+    """
+    f(a, b, c, d) = (a ∗ b + c ** 2, (a - d) ∗ K), opened through a king party
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+    david_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 14},
+        "Charlie": {charlie_secret: 2},
+        "David": {david_secret: 5}
+    }
+    windows = [{"Charlie": {charlie_secret: -6}}]
+
+    participants = list(parties.keys())
+    outputs = {
+        "sum": alice_secret * bob_secret + charlie_secret ** 2,
+        "scaled": (alice_secret - david_secret) * Scalar(10),
+    }
+    prot = ProtocolSpec(outputs=outputs, participant_ids=participants)
+    clients = [
+        (name, prot, value_dict, [window.get(name, {}) for window in windows])
+        for name, value_dict in parties.items()
+    ]
+    expected = [{"sum": 42 + 4, "scaled": -20}, {"sum": 42 + 36, "scaled": -20}]
+
+    for party_kwargs in ({"opening": "king"}, {"opening": "king", "dataflow": True}):
+        results = run_processes(participants, party_kwargs, *clients)
+        for result in results:
+            assert result == expected
+
+
+def test_aggregate_opening():
+    """
+    f(a, b, c) = (a ∗ b + c) ∗ (a - c), opened with sums aggregated by the server
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 14},
+        "Charlie": {charlie_secret: 2}
+    }
+    windows = [{"Bob": {bob_secret: -5}}]
+
+    expr = (alice_secret * bob_secret + charlie_secret) * (alice_secret - charlie_secret)
+    expected = [(3 * 14 + 2) * (3 - 2), (3 * -5 + 2) * (3 - 2)]
+    suite(parties, windows, expr, expected, party_kwargs={"opening": "aggregate"})
+    suite(parties, windows, expr, expected, party_kwargs={"opening": "aggregate", "dataflow": True})
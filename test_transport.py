@@ -0,0 +1,523 @@
+"""
+Integration tests running the protocol over the alternative transports.
+"""
+
+import email.utils
+import io
+import logging
+import os
+import queue as queue_module
+import stat
+import tempfile
+import threading
+import time
+from multiprocessing import AuthenticationError, Process, Queue
+from multiprocessing.connection import Client, answer_challenge, deliver_challenge
+
+import pytest
+
+import requests
+
+from communication import (
+    Communication,
+    InMemoryHub,
+    InMemoryTransport,
+    MessageTooLarge,
+    PeerToPeerCommunication,
+    UnixSocketCommunication,
+    compress,
+    decompress,
+    default_hubs,
+    make_transport,
+    negotiate_compression,
+    pack_peer_message,
+    peer_authkey,
+    parse_retry_after,
+    unpack_peer_message,
+    unix_socket_key_path,
+)
+from expression import Scalar, Secret
+from logs import disable_verbose_logging, enable_verbose_logging, get_logger
+from protocol import ProtocolSpec
+from server import app, run, serve_unix_socket
+
+from smc_party import SMCParty
+
+
+UNIX_SOCKET = os.path.join(tempfile.gettempdir(), "smc_test_server.sock")
+
+
+def smc_client(client_id, prot, value_dict, party_kwargs, queue):
+    cli = SMCParty(
+        client_id,
+        "localhost",
+        5000,
+        protocol_spec=prot,
+        value_dict=value_dict,
+        **party_kwargs
+    )
+    res = cli.run()
+    queue.put(res)
+    print(f"{client_id} has finished!")
+
+
+def smc_server(args, server_kwargs):
+    run("localhost", 5000, args, **server_kwargs)
+
+
+def run_processes(server_args, server_kwargs, party_kwargs, *client_args):
+    queue = Queue()
+
+    server = Process(target=smc_server, args=(server_args, server_kwargs))
+    clients = [
+        Process(target=smc_client, args=(*args, party_kwargs, queue))
+        for args in client_args
+    ]
+
+    server.start()
+    time.sleep(3)
+    for client in clients:
+        client.start()
+
+    results = list()
+    for client in clients:
+        client.join()
+
+    for client in clients:
+        results.append(queue.get())
+
+    server.terminate()
+    server.join()
+
+    # To "ensure" the workers are dead.
+    time.sleep(2)
+
+    print("Server stopped.")
+
+    return results
+
+
+def suite(parties, expr, expected, server_kwargs=None, party_kwargs=None):
+    participants = list(parties.keys())
+
+    prot = ProtocolSpec(expr=expr, participant_ids=participants)
+    clients = [(name, prot, value_dict) for name, value_dict in parties.items()]
+
+    results = run_processes(
+        participants, server_kwargs or {}, party_kwargs or {}, *clients
+    )
+
+    for result in results:
+        assert result == expected
+
+
+def test_unix_socket():
+    """
+    f(a, b, c) = (a + b + c) ∗ K
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 14},
+        "Charlie": {charlie_secret: 2}
+    }
+
+    expr = ((alice_secret + bob_secret + charlie_secret) * Scalar(5))
+    expected = (3 + 14 + 2) * 5
+    suite(
+        parties,
+        expr,
+        expected,
+        server_kwargs={"unix_socket": UNIX_SOCKET},
+        party_kwargs={"unix_socket": UNIX_SOCKET}
+    )
+
+
+def test_unix_socket_authentication(tmp_path):
+    path = str(tmp_path / "smc.sock")
+    serve_unix_socket(path)
+    # Only the user of the server can connect, or read the key.
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(unix_socket_key_path(path)).st_mode) == 0o600
+
+    with pytest.raises(AuthenticationError):
+        Client(path, family="AF_UNIX", authkey=b"other key")
+
+    comm = UnixSocketCommunication(path, "Alice")
+    comm.publish_message("unix_authentication", b"42")
+    assert comm.retrieve_public_message("Alice", "unix_authentication") == b"42"
+
+    # The methods outside of the allowlist close the connection.
+    conn = comm._connect()
+    conn.send(("run", ("localhost", 5000, [])))
+    with pytest.raises(EOFError):
+        conn.recv()
+
+
+def test_unix_socket_aggregate_opening():
+    """
+    f(a, b, c) = a ∗ b + c, opened with sums aggregated by the server
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 14},
+        "Charlie": {charlie_secret: 2}
+    }
+
+    expr = alice_secret * bob_secret + charlie_secret
+    suite(
+        parties,
+        expr,
+        3 * 14 + 2,
+        server_kwargs={"unix_socket": UNIX_SOCKET},
+        party_kwargs={"unix_socket": UNIX_SOCKET, "opening": "aggregate"}
+    )
+
+
+def test_aggregated_retrieval():
+    """
+    The server sums or concatenates the messages of all the participants for a label.
+    """
+    server = Process(target=smc_server, args=(["Alice", "Bob"], {}))
+    server.start()
+    time.sleep(3)
+    try:
+        alice = Communication("localhost", 5000, "Alice")
+        bob = Communication("localhost", 5000, "Bob")
+        alice.publish_message("opening", "1,20")
+        bob.publish_message("opening", "-4,5")
+        assert alice.retrieve_aggregated_message("opening") == b"-3,25"
+        assert bob.retrieve_aggregated_message("opening", mode="concat") == b"1,20\n-4,5"
+    finally:
+        server.terminate()
+        server.join()
+        time.sleep(2)
+
+
+def test_adaptive_polling():
+    """
+    The polls back off while a message is missing, and the server reports how many
+    messages are still missing.
+    """
+    server = Process(target=smc_server, args=(["Alice", "Bob"], {}))
+    server.start()
+    time.sleep(3)
+    try:
+        alice = Communication("localhost", 5000, "Alice")
+        bob = Communication("localhost", 5000, "Bob")
+        res = requests.get("http://localhost:5000/aggregate/Bob/late")
+        assert res.status_code == 404
+        assert res.headers["X-Missing-Messages"] == "2"
+
+        publisher = threading.Timer(1.0, alice.publish_message, ("late", "42"))
+        publisher.start()
+        assert bob.retrieve_public_message("Alice", "late") == b"42"
+        publisher.join()
+
+        stats = bob.stats.as_dict()
+        assert stats["polled"] == 1
+        # A fixed delay of 0.01 s would take about a hundred polls.
+        assert 1 <= stats["poll_misses"] == stats["max_poll_misses"] < 20
+        assert stats["poll_wait"] >= 0.5
+
+        # The errors other than a missing message are not retried.
+        with pytest.raises(requests.HTTPError):
+            bob._poll(f"{bob.base_url}/many/Bob")
+    finally:
+        server.terminate()
+        server.join()
+        time.sleep(2)
+
+
+def test_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("1.5") == 1.5
+    assert parse_retry_after("not a date") is None
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    later = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 < parse_retry_after(later) <= 60
+
+
+def test_wait_for_many():
+    """
+    Several messages are retrieved in one request, all at once or as they arrive.
+    """
+    server = Process(target=smc_server, args=(["Alice", "Bob"], {}))
+    server.start()
+    time.sleep(3)
+    try:
+        alice = Communication("localhost", 5000, "Alice")
+        bob = Communication("localhost", 5000, "Bob")
+        alice.publish_message("first", "1")
+        alice.send_private_message("Bob", "secret", "2")
+        publisher = threading.Timer(1.0, alice.publish_message, ("second", "3"))
+        publisher.start()
+
+        keys = [("Alice", "second"), ("Alice", "first"), ("", "secret")]
+        arrived = list(bob.iter_many(keys))
+        publisher.join()
+        assert arrived[-1] == (("Alice", "second"), b"3")
+        assert dict(arrived) == {("Alice", "first"): b"1", ("", "secret"): b"2", ("Alice", "second"): b"3"}
+        assert bob.wait_for_many(keys) == dict(arrived)
+    finally:
+        server.terminate()
+        server.join()
+        time.sleep(2)
+
+
+def test_compression():
+    """
+    Large messages are compressed both ways if the client asks for it, and only then.
+    """
+    assert negotiate_compression("gzip, deflate") == "zlib"
+    assert negotiate_compression("identity") is None
+    assert decompress(compress(b"1,2,3" * 100, "zlib"), "deflate") == b"1,2,3" * 100
+    bomb = compress(b"0" * 1000000, "zlib")
+    with pytest.raises(MessageTooLarge):
+        decompress(bomb, "deflate", 100000)
+    with pytest.raises(ValueError):
+        decompress(bomb[:len(bomb) // 2], "deflate", 100000)
+
+    server = Process(
+        target=smc_server,
+        args=(["Alice", "Bob"], {"compression_threshold": 512, "max_message_size": 100000})
+    )
+    server.start()
+    time.sleep(3)
+    try:
+        alice = Communication("localhost", 5000, "Alice", compression="zlib", compression_threshold=512)
+        bob = Communication("localhost", 5000, "Bob", compression="zlib", compression_level=9)
+        charlie = Communication("localhost", 5000, "Charlie")
+        message = ",".join(str(value) for value in range(2000))
+        alice.publish_message("large", message)
+        alice.publish_message("small", "42")
+
+        assert bob.retrieve_public_message("Alice", "large") == message.encode()
+        assert bob.retrieve_public_message("Alice", "small") == b"42"
+        assert charlie.retrieve_public_message("Alice", "large") == message.encode()
+
+        sent = alice.stats.as_dict()
+        assert sent["payload_sent"] == len(message) + 2
+        assert sent["bytes_sent"] < sent["payload_sent"] / 2
+        assert bob.stats.compression_ratio() > 2
+        assert charlie.stats.compression_ratio() == 1
+
+        # A small request which decompresses beyond the limit is refused.
+        res = requests.post(
+            "http://localhost:5000/public/Alice/bomb", data=bomb, headers={"Content-Encoding": "deflate"}
+        )
+        assert res.status_code == 413
+        # So is a message sent through the client, instead of being dropped silently.
+        with pytest.raises(requests.HTTPError):
+            charlie.publish_message("bomb", "0" * 200000)
+        with pytest.raises(requests.HTTPError):
+            charlie.send_private_message("Alice", "bomb", "0" * 200000)
+        # The client bounds the answers the same way.
+        dave = Communication("localhost", 5000, "Dave", compression="zlib", max_message_size=1000)
+        with pytest.raises(MessageTooLarge):
+            dave.retrieve_public_message("Alice", "large")
+    finally:
+        server.terminate()
+        server.join()
+        time.sleep(2)
+
+
+@pytest.mark.parametrize("url, body", [
+    ("/many/Alice", b"not json"),
+    ("/many/Alice", b'{"Alice": "label"}'),
+    ("/many/Alice", b'[["Alice"]]'),
+    ("/many/Alice", b'[["Alice", ["label"]]]'),
+    ("/shares/Alice", b"\xff"),
+    ("/shares/Alice", b'"op"'),
+    ("/shares/Alice", b'[["op"]]'),
+    ("/randomness/Alice", b"[1, 2]"),
+    ("/randomness/Alice", b'[["op", "dot"]]'),
+    ("/randomness/Alice", b'[["op", "unknown", 1]]'),
+])
+def test_malformed_batches(url, body):
+    """
+    The batch requests whose body is not the expected JSON are refused with 400.
+    """
+    assert app.test_client().post(url, data=body).status_code == 400
+
+
+def test_peer_to_peer():
+    """
+    f(a, b, c) = (a ∗ K0 + b - c) + K1
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 14},
+        "Charlie": {charlie_secret: 2}
+    }
+
+    expr = (((alice_secret * Scalar(5)) + bob_secret - charlie_secret) + Scalar(9))
+    expected = ((3 * 5) + 14 - 2) + 9
+    suite(
+        parties, expr, expected,
+        party_kwargs={"peer_to_peer": True, "transport_options": {"authkey": b"session key"}}
+    )
+
+
+def connect_peer(address, client_id, authkey):
+    conn = Client(address)
+    conn.send_bytes(client_id.encode())
+    answer_challenge(conn, authkey)
+    deliver_challenge(conn, authkey)
+    return conn
+
+
+def test_peer_to_peer_authentication():
+    with pytest.raises(ValueError):
+        PeerToPeerCommunication("localhost", 5000, "Alice", ["Alice", "Bob"])
+
+    participants = ["Alice", "Bob", "Charlie"]
+    comm = PeerToPeerCommunication("localhost", 5000, "Alice", participants, session="s1", authkey=b"key")
+    assert comm.address_label == "s1_p2p_address"
+    address = comm.listener.address
+
+    # A stalled peer does not hold up the others.
+    stalled = Client(address)
+
+    with pytest.raises(AuthenticationError):
+        connect_peer(address, "Bob", peer_authkey(b"other key", "Alice", "Bob"))
+    # Charlie cannot pass for Bob, since the key of each pair is different.
+    with pytest.raises(AuthenticationError):
+        connect_peer(address, "Bob", peer_authkey(b"key", "Alice", "Charlie"))
+
+    conn = connect_peer(address, "Bob", peer_authkey(b"key", "Bob", "Alice"))
+    conn.send_bytes(pack_peer_message("public", "share", b"42"))
+    assert comm._wait("public", "Bob", "share") == b"42"
+    stalled.close()
+
+    # Malformed frames are rejected, they are never unpickled.
+    with pytest.raises(ValueError):
+        unpack_peer_message(b'["shell", "share"]\n42')
+    with pytest.raises(ValueError):
+        unpack_peer_message(b"\x80\x04garbage")
+    conn.close()
+
+
+def test_long_poll():
+    """
+    f(a, b, c) = a ∗ b + c, with retrievals held by the server until their message is ready
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 14},
+        "Charlie": {charlie_secret: 2}
+    }
+
+    expr = alice_secret * bob_secret + charlie_secret
+    suite(parties, expr, 3 * 14 + 2, party_kwargs={"transport": "long-poll"})
+
+
+def test_in_memory():
+    """
+    f(a, b, c) = (a ∗ b + c) ∗ K, with parties running as threads sharing a hub
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 14},
+        "Charlie": {charlie_secret: 2}
+    }
+    participants = list(parties.keys())
+    prot = ProtocolSpec(
+        expr=(alice_secret * bob_secret + charlie_secret) * Scalar(5), participant_ids=participants
+    )
+
+    hub = InMemoryHub()
+    results = queue_module.Queue()
+    transports = {name: InMemoryTransport(hub, name, participants) for name in participants}
+
+    def client(name):
+        cli = SMCParty(
+            name, "localhost", 5000, protocol_spec=prot, value_dict=parties[name],
+            transport=transports[name]
+        )
+        results.put(cli.run())
+
+    threads = [threading.Thread(target=client, args=(name,)) for name in participants]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [results.get() for _ in participants] == [(3 * 14 + 2) * 5] * 3
+    for transport in transports.values():
+        stats = transport.stats.as_dict()
+        assert stats["requests"] > 0
+        assert stats["bytes_sent"] > 0 and stats["bytes_received"] > 0
+        assert sum(stats["latencies"].values()) == stats["requests"]
+
+
+def test_in_memory_hubs():
+    """
+    The in-memory transports created by name share a hub per session and participants,
+    so that a run does not see the messages of an earlier one.
+    """
+    default_hubs.clear()
+    try:
+        alice = make_transport("memory", "localhost", 5000, "Alice", ["Alice", "Bob"], session="s1")
+        bob = make_transport("memory", "localhost", 5000, "Bob", ["Alice", "Bob"], session="s1")
+        assert alice.hub is bob.hub
+        alice.publish_message("result", "42")
+        assert bob.retrieve_public_message("Alice", "result") == b"42"
+
+        later = make_transport("memory", "localhost", 5000, "Alice", ["Alice", "Bob"], session="s2")
+        others = make_transport("memory", "localhost", 5000, "Alice", ["Alice", "Charlie"], session="s1")
+        assert later.hub is not alice.hub and others.hub is not alice.hub
+        assert ("Alice", "result") not in later.hub.store["public"]
+        assert others.hub.participant_ids == ["Alice", "Charlie"]
+    finally:
+        default_hubs.clear()
+
+
+def test_sampled_logging():
+    """
+    Logging formats nothing by default, and samples each message in verbose mode.
+    """
+    class Probe:
+        formatted = 0
+
+        def __str__(self):
+            Probe.formatted += 1
+            return "probe"
+
+    logger = get_logger("test")
+    logger.debug("GET %s", Probe())
+    assert Probe.formatted == 0
+
+    stream = io.StringIO()
+    handler = enable_verbose_logging(sample_every=3, stream=stream)
+    try:
+        for _ in range(7):
+            logger.debug("GET %s", Probe())
+        logger.debug("POST %s", "rare")
+    finally:
+        disable_verbose_logging(handler)
+
+    lines = stream.getvalue().splitlines()
+    assert len([line for line in lines if "GET probe" in line]) == 3
+    assert any("POST rare" in line for line in lines)
+    assert Probe.formatted == 3
+    assert not logger.isEnabledFor(logging.DEBUG)
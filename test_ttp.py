@@ -4,3 +4,183 @@ Testing ttp is not obligatory.
 
 MODIFY THIS FILE.
 """
+
+import math
+import mmap
+import tempfile
+import time
+
+import pytest
+
+from secret_sharing import reconstruct_secret
+from ttp import (
+    STATISTICAL_SECURITY,
+    VALUE_BITS,
+    MappedTripleStore,
+    TripleFactory,
+    TripleStore,
+    TrustedParamGenerator,
+    pregenerate_triples,
+)
+
+
+def make_ttp(participants, factory=None, triples_path=None):
+    ttp = TrustedParamGenerator(factory, triples_path)
+    for participant in participants:
+        ttp.add_participant(participant)
+    return ttp
+
+
+def reconstruct_masks(ttp, participants, op_id, kind, bits=0):
+    shares = [ttp.retrieve_randomness(participant, op_id, kind, bits) for participant in participants]
+    return [reconstruct_secret(list(values)) for values in zip(*shares)]
+
+
+def test_truncation_masks():
+    participants = ["Alice", "Bob", "Charlie"]
+    ttp = make_ttp(participants)
+    for idx in range(20):
+        r_hi, r = reconstruct_masks(ttp, participants, f"trunc_{idx}", "trunc", 16)
+        assert 0 <= r - (r_hi << 16) < 1 << 16
+
+
+def test_bit_masks():
+    participants = ["Alice", "Bob", "Charlie"]
+    ttp = make_ttp(participants)
+    for idx in range(20):
+        r_hi, *bits = reconstruct_masks(ttp, participants, f"bits_{idx}", "bits", 16)
+        assert len(bits) == 16 and set(bits) <= {0, 1}
+        assert 0 <= r_hi < 1 << (VALUE_BITS + STATISTICAL_SECURITY)
+
+
+def test_square_masks_are_hidden():
+    participants = ["Alice", "Bob", "Charlie"]
+    ttp = make_ttp(participants)
+    for idx in range(20):
+        r, r_squared = reconstruct_masks(ttp, participants, f"square_{idx}", "square")
+        assert r * r == r_squared
+        # No share, the last one included, is close to r^2: its square root does not give r.
+        for participant in participants:
+            share = int(ttp.retrieve_randomness(participant, f"square_{idx}", "square")[1].value)
+            assert abs(share - r_squared) > r_squared << (STATISTICAL_SECURITY // 2)
+            assert abs(math.isqrt(abs(share)) - r) > 1 << 64
+
+
+def test_randomness_batch_matches_single_retrievals():
+    participants = ["Alice", "Bob"]
+    ttp = make_ttp(participants)
+    ops = [("a", "trunc", 8), ("b", "bits", 8)]
+    batch = ttp.retrieve_randomness_batch("Bob", ops)
+    assert [[share.value for share in masks] for masks in batch] == [
+        [share.value for share in ttp.retrieve_randomness("Bob", *op)] for op in ops
+    ]
+
+
+def test_inner_product_triples():
+    participants = ["Alice", "Bob", "Charlie"]
+    ttp = make_ttp(participants)
+    *pairs, c = reconstruct_masks(ttp, participants, "dot", "dot", 4)
+    assert len(pairs) == 8
+    assert c == sum(pairs[i] * pairs[i + 1] for i in range(0, 8, 2))
+
+    # Every share of c, the last one included, is STATISTICAL_SECURITY bits larger than c,
+    # so that no party learns it.
+    for idx in range(20):
+        *_, c = reconstruct_masks(ttp, participants, f"dot_{idx}", "dot", 1)
+        for participant in participants:
+            share = int(ttp.retrieve_randomness(participant, f"dot_{idx}", "dot", 1)[-1].value)
+            assert abs(share).bit_length() >= c.bit_length() + STATISTICAL_SECURITY - 16
+
+
+def reconstruct_triple(triples, participants, op_id):
+    shares = [triples.retrieve(participant, op_id) for participant in participants]
+    return [sum(values) for values in zip(*shares)]
+
+
+def test_beaver_triplets():
+    participants = ["Alice", "Bob", "Charlie"]
+    ttp = make_ttp(participants, TripleFactory(chunk_size=16))
+    op_ids = [f"mul_{idx}" for idx in range(40)]
+    batch = ttp.retrieve_share_batch("Bob", op_ids)
+    for op_id, triplet in zip(op_ids, batch):
+        shares = [ttp.retrieve_share(participant, op_id) for participant in participants]
+        a, b, c = [reconstruct_secret(list(values)) for values in zip(*shares)]
+        assert a * b == c
+        assert [share.value for share in triplet] == [share.value for share in shares[1]]
+    # Each operation gets its own triple, generated in chunks.
+    assert len(ttp.triples.slots) == 40
+    assert len(ttp.triples) == 48
+
+
+def test_triple_factory_pool():
+    participants = ["Alice", "Bob", "Charlie", "Dave"]
+    factory = TripleFactory(chunk_size=64, workers=2)
+    triples = TripleStore(participants)
+    start = time.perf_counter()
+    try:
+        factory.fill(triples, 100)
+        factory.fill(triples, 200)
+        pending = list(factory.pending)
+    finally:
+        factory.close()
+    throughput = factory.throughput()
+    elapsed = time.perf_counter() - start
+    # The chunks in progress are dropped, the ones not started yet are cancelled.
+    assert pending and not factory.pending and factory.pool is None
+    assert triples.available >= 200
+    reconstructed = [reconstruct_triple(triples, participants, f"op_{idx}") for idx in range(200)]
+    for a, b, c in reconstructed:
+        assert a * b == c
+    # The workers do not share the state of their random generator.
+    assert len(set(map(tuple, reconstructed))) > 100
+    assert factory.generated == len(triples)
+    # Over wall-clock time, not the time of the workers added up.
+    assert factory.generated / elapsed <= throughput < factory.generated / elapsed * 2
+
+
+def test_triple_factory_party_change():
+    factory = TripleFactory(chunk_size=20000, workers=1, prefetch=3)
+    try:
+        factory.fill(TripleStore(["Alice", "Bob", "Charlie", "Dave"]), 1)
+        stale = list(factory.pending)
+        triples = TripleStore(["Alice", "Bob"])
+        factory.fill(triples, 1)
+        # The chunks for four parties are not waited for, nor used.
+        assert any(future.cancelled() for future in stale)
+        assert not set(stale) & set(factory.pending)
+        a, b, c = reconstruct_triple(triples, ["Alice", "Bob"], "op")
+        assert a * b == c
+    finally:
+        factory.close()
+
+
+def test_mapped_triple_store():
+    participants = ["Alice", "Bob", "Charlie"]
+    with tempfile.TemporaryDirectory() as path:
+        pregenerate_triples(path, participants, 100, TripleFactory(chunk_size=32))
+
+        ttp = make_ttp(participants, TripleFactory(chunk_size=32), path)
+        first = [
+            [reconstruct_secret(list(values)) for values in zip(*(
+                ttp.retrieve_share(participant, f"op_{idx}") for participant in participants
+            ))]
+            for idx in range(60)
+        ]
+        assert all(a * b == c for a, b, c in first)
+        assert len(ttp.triples) == 128 and ttp.triples.consumed == 60
+        shares = ttp.triples.party_shares("Bob", 0, 60)
+        assert isinstance(shares.obj, mmap.mmap) and len(shares) == 180
+        ttp.triples.close()
+
+        # The consumed triples are not handed out again after a restart, and the store
+        # grows when they run out.
+        ttp = make_ttp(participants, TripleFactory(chunk_size=32), path)
+        second = ttp.retrieve_share_batch("Alice", [f"op_{idx}" for idx in range(100)])
+        assert ttp.triples.consumed == 160 and len(ttp.triples) == 160
+        assert [triplet[0].value for triplet in second[:68]] == [
+            str(value) for value in ttp.triples.party_shares("Alice", 60, 68)[0::3]
+        ]
+        ttp.triples.close()
+
+        with pytest.raises(ValueError):
+            MappedTripleStore(path, ["Alice", "Bob"])
@@ -5,60 +5,490 @@ MODIFY THIS FILE.
 """
 
 import collections
+import logging
+import mmap
+import os
+import struct
+import time
+from array import array
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import chain
+from operator import mul, sub
 from typing import (
+    Deque,
     Dict,
+    List,
+    Optional,
     Set,
     Tuple,
 )
-from random import randint
+from random import Random, getrandbits
 
 
 from communication import Communication
-from secret_sharing import(
-    share_secret,
-    Share,
-)
+from logs import get_logger
+from secret_sharing import Share
 
 # Feel free to add as many imports as you want.
 
 
+logger: logging.Logger = get_logger("ttp")
+
+
+# Random masks hide values of up to VALUE_BITS bits, with STATISTICAL_SECURITY bits of
+# statistical security.
+VALUE_BITS = 64
+STATISTICAL_SECURITY = 40
+
+
+class TripleStore:
+    """
+    Shares of Beaver triplets in a flat array of 64-bit integers, where the share of
+    component k (a, b or c) of triple i for party p is at ((i * parties) + p) * 3 + k.
+    Each triple is assigned to an operation the first time it is requested.
+
+    Attributes:
+        participant_ids: participants, in the order of their shares
+        shares: shares of all the triples
+        slots: index of the triple assigned to each operation
+        consumed: number of triples assigned so far; the next one is the first free one
+    """
+
+    def __init__(self, participant_ids: List[str]):
+        self.participant_ids = participant_ids
+        self.party_index = {pid: idx for idx, pid in enumerate(participant_ids)}
+        self.shares = array("q")
+        self.slots: Dict[str, int] = {}
+        self.consumed = 0
+
+
+    def __len__(self) -> int:
+        return len(self.shares) // (3 * len(self.participant_ids))
+
+
+    @property
+    def available(self) -> int:
+        """
+        Number of triples not assigned yet.
+        """
+        return len(self) - self.consumed
+
+
+    def extend(self, chunk: array) -> None:
+        """
+        Add triples, laid out as the shares.
+        """
+        self.shares.extend(chunk)
+
+
+    def assign(self, op_id: str) -> int:
+        """
+        Index of the triple of an operation, assigning it the next free one if needed.
+        """
+        slot = self.slots.get(op_id)
+        if slot is None:
+            if self.available == 0:
+                raise IndexError("No Beaver triplet left")
+            slot = self.slots[op_id] = self.consumed
+            self.consumed += 1
+        return slot
+
+
+    def retrieve(self, client_id: str, op_id: str) -> Tuple[int, int, int]:
+        """
+        Shares of the triple of an operation for a client.
+        """
+        start = (self.assign(op_id) * len(self.participant_ids) + self.party_index[client_id]) * 3
+        return tuple(self.shares[start:start + 3]) # type: ignore
+
+
+class MappedTripleStore(TripleStore):
+    """
+    Shares of Beaver triplets in memory-mapped files, so that large batches generated
+    offline are not capped by the memory, and survive the restarts of the server.
+
+    The directory holds one file per party, with the (a, b, c) shares of its triples as
+    native 64-bit integers, so that the shares of a party are served as zero-copy slices
+    (see `party_shares`). A header file keeps the number of triples and the number of
+    triples consumed: a triple is never handed out twice, even across restarts. The
+    assignments of the operations in progress are lost on restart.
+
+    Attributes:
+        path: directory of the store
+        participant_ids: participants, in the order of their files
+        slots: index of the triple assigned to each operation since the store was opened
+    """
+
+    MAGIC = b"SMCT"
+    VERSION = 1
+    # Magic, version, number of parties, number of triples, number of triples consumed.
+    HEADER = struct.Struct(">4sBIQQ")
+
+    def __init__(self, path: str, participant_ids: List[str]):
+        self.participant_ids = participant_ids
+        self.party_index = {pid: idx for idx, pid in enumerate(participant_ids)}
+        self.slots: Dict[str, int] = {}
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        parties_path = os.path.join(path, "parties")
+        header_path = os.path.join(path, "header")
+        if os.path.exists(header_path):
+            with open(parties_path) as f:
+                if f.read().splitlines() != participant_ids:
+                    raise ValueError(f"The triples of {path} are shared between other participants")
+        else:
+            with open(parties_path, "w") as f:
+                f.write("\n".join(participant_ids) + "\n")
+            with open(header_path, "wb") as f:
+                f.write(self.HEADER.pack(self.MAGIC, self.VERSION, len(participant_ids), 0, 0))
+
+        self.header_file = open(header_path, "r+b")
+        self.header = mmap.mmap(self.header_file.fileno(), self.HEADER.size)
+        magic, version, num_parties, _, _ = self.HEADER.unpack_from(self.header)
+        if magic != self.MAGIC or version != self.VERSION or num_parties != len(participant_ids):
+            raise ValueError(f"Invalid triple store {path}")
+
+        self.party_files = [
+            open(os.path.join(path, f"party_{idx}.bin"), "a+b") for idx in range(num_parties)
+        ]
+        # Drop the triples written by an interrupted `extend`.
+        for f in self.party_files:
+            f.truncate(len(self) * 3 * 8)
+        self.views: List[memoryview] = []
+        self._map()
+
+
+    def _map(self) -> None:
+        """
+        Map the files of the parties, up to the number of triples in the header.
+        """
+        size = len(self) * 3 * 8
+        self.views = []
+        for f in self.party_files:
+            if size == 0:
+                self.views.append(memoryview(array("q")))
+                continue
+            # The previous maps stay alive as long as slices of them are in use.
+            mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self.views.append(memoryview(mapped).cast("q"))
+
+
+    def __len__(self) -> int:
+        return self.HEADER.unpack_from(self.header)[3]
+
+
+    @property
+    def consumed(self) -> int: # type: ignore
+        return self.HEADER.unpack_from(self.header)[4]
+
+
+    @consumed.setter
+    def consumed(self, value: int) -> None:
+        struct.pack_into(">Q", self.header, self.HEADER.size - 8, value)
+
+
+    def extend(self, chunk: array) -> None:
+        """
+        Append triples, laid out as in a `TripleStore`, to the files of the parties.
+        """
+        num_parties = len(self.participant_ids)
+        count = len(chunk) // (3 * num_parties)
+        for idx, f in enumerate(self.party_files):
+            shares = array("q", bytes(8 * 3 * count))
+            for component in range(3):
+                shares[component::3] = chunk[3 * idx + component::3 * num_parties]
+            f.write(shares.tobytes())
+            f.flush()
+        # The triples only count once they are all written.
+        struct.pack_into(">Q", self.header, self.HEADER.size - 16, len(self) + count)
+        self._map()
+
+
+    def party_shares(self, client_id: str, start: int, count: int) -> memoryview:
+        """
+        Zero-copy slice of the shares of a client for `count` triples from index `start`,
+        as 3 * count integers.
+        """
+        return self.views[self.party_index[client_id]][3 * start:3 * (start + count)]
+
+
+    def retrieve(self, client_id: str, op_id: str) -> Tuple[int, int, int]:
+        """
+        Shares of the triple of an operation for a client.
+        """
+        return tuple(self.party_shares(client_id, self.assign(op_id), 1)) # type: ignore
+
+
+    def close(self) -> None:
+        """
+        Write the header to disk and close the files. Slices still in use keep their maps.
+        """
+        self.header.flush()
+        self.header.close()
+        self.header_file.close()
+        for f in self.party_files:
+            f.close()
+
+
+class TripleFactory:
+    """
+    Generate Beaver triplets ahead of their use, in chunks computed by a pool of worker
+    processes, and fill a `TripleStore` with them.
+
+    Each chunk is generated and shared in one call (see `generate_triple_chunk`) and comes
+    back as a flat array, so the workers exchange compact arrays rather than shares. While
+    the store is being consumed, the next chunks are already generated in the background.
+
+    Attributes:
+        chunk_size: number of triples of a chunk (default: 1024)
+        workers: number of worker processes (default: 0, the chunks are generated by the
+            calling thread)
+        prefetch: number of chunks generated in the background (default: `workers`)
+        generated: number of triples generated so far
+        generation_time: time spent by the workers generating them in seconds, added up
+        started: wall-clock time at which the generation started, if it did
+    """
+
+    def __init__(self, chunk_size: int = 1024, workers: int = 0, prefetch: Optional[int] = None):
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.prefetch = workers if prefetch is None else prefetch
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.pending: Deque[Future] = collections.deque()
+        self.pending_parties = 0  # Number of parties of the pending chunks
+        self.generated = 0
+        self.generation_time = 0.0
+        self.started: Optional[float] = None
+
+
+    def fill(self, store: TripleStore, count: int) -> None:
+        """
+        Make sure that the store has at least `count` free triples, and keep the next
+        chunks generating.
+        """
+        if self.started is None:
+            self.started = time.perf_counter()
+        num_parties = len(store.participant_ids)
+        if self.pending_parties != num_parties:
+            self._drop_pending()
+            self.pending_parties = num_parties
+        while store.available < count:
+            if self.pending:
+                chunk, elapsed = self.pending.popleft().result()
+            else:
+                chunk, elapsed = generate_triple_chunk(self.chunk_size, num_parties, getrandbits(64))
+            store.extend(chunk)
+            self.generated += self.chunk_size
+            self.generation_time += elapsed
+            logger.info(
+                "Generated %d Beaver triplets for %d parties (%.0f triplets/s)",
+                self.chunk_size, num_parties, self.throughput()
+            )
+
+        if self.workers > 0:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            while len(self.pending) < self.prefetch:
+                self.pending.append(
+                    self.pool.submit(generate_triple_chunk, self.chunk_size, num_parties, getrandbits(64))
+                )
+
+
+    def throughput(self) -> float:
+        """
+        Triples generated per second of wall-clock time since the generation started, by
+        all the workers together.
+        """
+        if self.started is None:
+            return 0.0
+        elapsed = time.perf_counter() - self.started
+        return self.generated / elapsed if elapsed > 0 else 0.0
+
+
+    def close(self) -> None:
+        """
+        Stop the workers, dropping the chunks in progress.
+        """
+        self._drop_pending()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+
+    def _drop_pending(self) -> None:
+        """
+        Drop the chunks in progress, cancelling the ones not started yet.
+        """
+        # Executor.shutdown only cancels the pending futures itself from Python 3.9 on.
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+
+
+def pregenerate_triples(
+        path: str,
+        participant_ids: List[str],
+        count: int,
+        factory: Optional[TripleFactory] = None
+    ) -> None:
+    """
+    Generate at least `count` free Beaver triplets offline into a `MappedTripleStore`, for
+    a server started with the same participants and `triples_path`.
+    """
+    store = MappedTripleStore(path, sorted(participant_ids))
+    factory = factory if factory is not None else TripleFactory()
+    try:
+        factory.fill(store, count)
+    finally:
+        factory.close()
+        store.close()
+
+
+def generate_triple_chunk(count: int, num_parties: int, seed: int) -> Tuple[array, float]:
+    """
+    Generate `count` Beaver triplets and share them between `num_parties` parties, as laid
+    out in a `TripleStore`, and the time it took in seconds.
+
+    The triplets are generated a column at a time: all the a, then all the b, then the
+    share of each party for all of them, so that the loops run in comprehensions rather
+    than once per triplet. The shares are drawn as in `share_secret`.
+
+    The seed is drawn by the caller, since forked workers share the state of `random`.
+    """
+    start = time.perf_counter()
+    rng = Random(seed)
+    rand = rng.random
+    a = rng.choices(range(1, 1001), k=count)
+    b = rng.choices(range(1, 1001), k=count)
+    # Shares of each party for the a, b and c of all the triplets.
+    columns = []
+    for secrets in (a, b, list(map(mul, a, b))):
+        remaining = secrets
+        parties = []
+        for i in range(num_parties - 1):
+            # Leave at least 1 to each of the next parties, as `share_secret` does.
+            left = num_parties - 1 - i
+            values = [int(rand() * (value - left + 1)) if value > left else 0 for value in remaining]
+            parties.append(values)
+            remaining = list(map(sub, remaining, values))
+        parties.append(remaining)
+        columns.append(parties)
+    # Triplet by triplet, the (a, b, c) shares of each party.
+    shares = array("q", chain.from_iterable(zip(*(
+        column[party] for party in range(num_parties) for column in columns
+    ))))
+    return shares, time.perf_counter() - start
+
+
 class TrustedParamGenerator:
     """
     A trusted third party that generates random values for the Beaver triplet multiplication scheme.
+
+    The Beaver triplets are generated in chunks by a `TripleFactory` (given, or generating
+    them in the calling thread), into a `TripleStore` created once the participants are
+    known. If `triples_path` is given, the store is a `MappedTripleStore` in that
+    directory, e.g. filled offline by `pregenerate_triples`.
     """
 
 
-    def __init__(self):
+    def __init__(self, factory: Optional[TripleFactory] = None, triples_path: Optional[str] = None):
         self.participant_ids: Set[str] = set()
-        self.dict_castor: Dict = {}
+        self.factory = factory if factory is not None else TripleFactory()
+        self.triples_path = triples_path
+        self.triples: Optional[TripleStore] = None
+        self.dict_randomness: Dict = {}
 
 
     def add_participant(self, participant_id: str) -> None:
         """
         Add a participant.
         """
+        if participant_id not in self.participant_ids:
+            # The triples already generated are not shared with the new participant.
+            if isinstance(self.triples, MappedTripleStore):
+                self.triples.close()
+            self.triples = None
         self.participant_ids.add(participant_id)
 
     def retrieve_share(self, client_id: str, op_id: str) -> Tuple[Share, Share, Share]:
         """
         Retrieve a triplet of shares for a given client_id.
         """
-        if op_id not in self.dict_castor.keys():
-            a,b,c = self.generate_beaver()
-            a_shares = share_secret(a,len(self.participant_ids))
-            b_shares = share_secret(b,len(self.participant_ids))
-            c_shares = share_secret(c,len(self.participant_ids))
+        return self.retrieve_share_batch(client_id, [op_id])[0]
+
+    def retrieve_share_batch(self, client_id: str, op_ids: List[str]) -> List[Tuple[Share, Share, Share]]:
+        """
+        Retrieve the triplets of shares of several operations for a given client_id.
+        """
+        if self.triples is None:
+            if self.triples_path is not None:
+                self.triples = MappedTripleStore(self.triples_path, sorted(self.participant_ids))
+            else:
+                self.triples = TripleStore(sorted(self.participant_ids))
+        missing = sum(op_id not in self.triples.slots for op_id in set(op_ids))
+        self.factory.fill(self.triples, missing)
+        return [
+            tuple(Share(str(value)) for value in self.triples.retrieve(client_id, op_id)) # type: ignore
+            for op_id in op_ids
+        ]
 
-            self.dict_castor[op_id] = {}
+    def retrieve_randomness(self, client_id: str, op_id: str, kind: str, size: int = 0) -> Tuple[Share, ...]:
+        """
+        Retrieve the shares of the random masks of a given kind ("dot", "square", "trunc"
+        or "bits") and size for a given client_id.
+        """
+        if op_id not in self.dict_randomness.keys():
+            values = self.generate_randomness(kind, size)
+            shares = [self.share_mask(value) for value in values]
+
+            self.dict_randomness[op_id] = {}
             for idx,cid in enumerate(self.participant_ids):
-                self.dict_castor[op_id][cid] = (a_shares[idx], b_shares[idx], c_shares[idx])
+                self.dict_randomness[op_id][cid] = tuple(value_shares[idx] for value_shares in shares)
+
+        return self.dict_randomness[op_id][client_id]
 
-        return self.dict_castor[op_id][client_id]
+    def retrieve_randomness_batch(self, client_id: str, ops: List[Tuple[str, str, int]]) -> List[Tuple[Share, ...]]:
+        """
+        Retrieve the random masks of several operations, given as (op_id, kind, size).
+        """
+        return [self.retrieve_randomness(client_id, op_id, kind, size) for op_id, kind, size in ops]
 
     # Feel free to add as many methods as you want.
-    def generate_beaver(self):
-        a = randint(1,1000)
-        b = randint(1,1000)
-        c = a*b
-        return a,b,c
+    def generate_randomness(self, kind: str, size: int) -> Tuple[int, ...]:
+        """
+        Generate the random masks of an operation:
+        - "dot": (a_1, b_1, ..., a_size, b_size, c) with c = sum of the a_i * b_i, to
+          compute the inner product of x and y by opening the x_i - a_i and y_i - b_i.
+        - "square": (r, r^2), to square x by opening x - r.
+        - "trunc": (r_hi, r) with r = r_hi * 2^size + r_lo and r_lo of `size` bits, to
+          truncate x by opening x + r.
+        - "bits": (r_hi, r_0, ..., r_(size - 1)) with random bits r_i, for the mask
+          r = r_hi * 2^size + sum of the r_i * 2^i, to compare x + r with r bit by bit
+          after opening it.
+        """
+        if kind == "dot":
+            values = [getrandbits(VALUE_BITS + STATISTICAL_SECURITY) for _ in range(2 * size)]
+            return (*values, sum(values[i] * values[i + 1] for i in range(0, 2 * size, 2)))
+        if kind == "square":
+            r = getrandbits(VALUE_BITS + STATISTICAL_SECURITY)
+            return r, r * r
+        if kind == "trunc":
+            r_hi = getrandbits(VALUE_BITS + STATISTICAL_SECURITY)
+            return r_hi, (r_hi << size) + getrandbits(size)
+        if kind == "bits":
+            return (getrandbits(VALUE_BITS + STATISTICAL_SECURITY), *(getrandbits(1) for _ in range(size)))
+        raise ValueError(f"Unknown randomness {kind}")
+
+    def share_mask(self, value: int) -> List[Share]:
+        """
+        Share a random mask, which may be negative, with uniformly random shares.
+
+        The shares have STATISTICAL_SECURITY more bits than the mask, so that each of them,
+        the last one included, statistically hides it: the products of masks (r^2, or the
+        c of the inner products) are much larger than the masks themselves.
+        """
+        bound = max(abs(value).bit_length(), VALUE_BITS) + STATISTICAL_SECURITY
+        shares = [getrandbits(bound) for _ in range(len(self.participant_ids) - 1)]
+        shares.append(value - sum(shares))
+        return [Share(str(share)) for share in shares]
 